@@ -0,0 +1,328 @@
+"""Retainn parser and import benchmarks.
+
+Generates synthetic decks and reports the throughput (MB/s, cards/s) and peak
+memory of each stage of turning markdown into cards.
+
+With --compression, instead reports the database size, insert time and
+card fetch latency with card compression off and at several zlib levels.
+
+Usage:
+  python3 bench.py [--cards 1000,10000,100000] [--card-size 200]
+                   [--code-density 0.2] [--stages lex,parse,...]
+                   [--repeat 3] [--no-memory] [--output results.json]
+  python3 bench.py --compression [--cards 10000] [--card-size 2000]
+                   [--code-density 0.8]
+"""
+
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import platform
+import random
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+sys.path.insert(0, "./lib")
+from retainn import db
+from retainn import parse
+from retainn import util
+
+
+words = [
+    b'the', b'function', b'returns', b'a', b'pointer', b'to', b'an', b'int',
+    b'which', b'declare', b'struct', b'value', b'map', b'of', b'string',
+    b'slice', b'channel', b'goroutine', b'interface', b'method', b'receiver',
+]
+
+
+def make_text(rng, size):
+    """Return roughly size bytes of markdown prose."""
+    chunks = []
+    length = 0
+    while length < size:
+        word = rng.choice(words)
+        chunks.append(word)
+        length += len(word) + 1
+        continue
+    return b' '.join(chunks)
+
+
+def make_code(rng, size):
+    """Return a fenced code block of roughly size bytes."""
+    lines = []
+    length = 0
+    while length < size:
+        line = b'    ' + make_text(rng, 40) + b';'
+        lines.append(line)
+        length += len(line) + 1
+        continue
+    return b'```go\n' + b'\n'.join(lines) + b'\n```'
+
+
+def make_deck(card_count, card_size=200, code_density=0.2, seed=0):
+    """Generate the markdown of a synthetic deck.
+    card_size is the approximate size of each card (front plus back) in bytes,
+    and code_density is the fraction of cards whose back is a code block."""
+    rng = random.Random(seed)
+    chunks = [b'format: md1\n\n# Synthetic Deck\n\nA generated deck.']
+    for _ in range(card_count):
+        front_size = rng.randint(card_size // 4, card_size // 2)
+        back_size = max(card_size - front_size, 1)
+        chunks.append(b'\n\n---\n\n')
+        chunks.append(make_text(rng, front_size))
+        chunks.append(b'\n\n%\n\n')
+        if rng.random() < code_density:
+            chunks.append(make_code(rng, back_size))
+        else:
+            chunks.append(make_text(rng, back_size))
+        continue
+    chunks.append(b'\n\n---\n')
+    return b''.join(chunks)
+
+
+def make_memory_db():
+    """Create an in-memory database with our schema."""
+    return db.create_memory_db('lib/retainn/sql')
+
+
+def bench_lex(markdown, sql_templates):
+    """Return a function which lexes the deck."""
+    def run():
+        parse.lex_deck(markdown)
+    return run
+
+
+def bench_parse(markdown, sql_templates):
+    """Return a function which parses the (already lexed) deck."""
+    tokens = parse.lex_deck(markdown)
+    def run():
+        (deck_ast, _) = parse.parse_deck(tokens)
+        assert deck_ast is not None
+    return run
+
+
+def bench_flatten(markdown, sql_templates):
+    """Return a function which flattens the (already parsed) deck."""
+    (deck_ast, _) = parse.parse_deck(parse.lex_deck(markdown))
+    def run():
+        parse.flatten_deck(deck_ast)
+    return run
+
+
+def bench_iter(markdown, sql_templates):
+    """Return a function which stream-parses the deck."""
+    def run():
+        for node in parse.iter_deck(io.BytesIO(markdown)):
+            assert node.type != 'ERROR'
+            continue
+    return run
+
+
+def bench_import(markdown, sql_templates):
+    """Return a function which imports the deck into an in-memory database."""
+    def run():
+        db_conn = make_memory_db()
+        util.import_deck_md(db_conn, sql_templates, 'bench', None, markdown)
+        db_conn.close()
+    return run
+
+
+stages = [
+    ('lex', bench_lex),
+    ('parse', bench_parse),
+    ('flatten', bench_flatten),
+    ('iter', bench_iter),
+    ('import', bench_import),
+]
+
+
+def measure(run, repeat, measure_memory):
+    """Time run() (best of repeat runs), and optionally measure its peak
+    memory allocation.
+    Returns (seconds, peak bytes or None)."""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        run()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+        continue
+    peak = None
+    if measure_memory and tracemalloc is not None:
+        tracemalloc.start()
+        run()
+        (_, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return (best, peak)
+
+
+def bench_compression(card_count, card_size, code_density, seed, sql_templates):
+    """Measure the card compression size versus latency tradeoff.
+    Returns a list of result dicts, one per compression level."""
+    markdown = make_deck(card_count, card_size, code_density, seed)
+    (_, _, cards) = util.scan_deck_cards(markdown)
+    cards = list(util.unique_cards(cards))
+    rng = random.Random(seed)
+    results = []
+    for level in [None, 1, 6, 9]:
+        db_conn = make_memory_db()
+        if level is not None:
+            db.compress_level = level
+            db.replace_setting(db_conn, sql_templates, 'compress_cards', '1')
+        start = time.time()
+        db.insert_cards_bulk(db_conn, sql_templates, 1, cards)
+        insert_seconds = time.time() - start
+        size = db.select_db_size(db_conn)
+        card_ids = [rng.randint(1, card_count) for _ in range(1000)]
+        start = time.time()
+        for card_id in card_ids:
+            db.select_card_back(db_conn, sql_templates, card_id)
+            continue
+        fetch_seconds = (time.time() - start) / len(card_ids)
+        db_conn.close()
+        results.append({
+            'level': level,
+            'cards': card_count,
+            'db_bytes': size,
+            'insert_seconds': insert_seconds,
+            'fetch_seconds': fetch_seconds,
+        })
+        continue
+    db.compress_level = 6
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Retainn benchmarks.")
+    parser.add_argument(
+        '--cards', default='1000,10000,100000',
+        help="comma-separated deck sizes, in cards (default: %(default)s)"
+    )
+    parser.add_argument(
+        '--card-size', type=int, default=200,
+        help="approximate bytes per card (default: %(default)s)"
+    )
+    parser.add_argument(
+        '--code-density', type=float, default=0.2,
+        help="fraction of cards with a code block (default: %(default)s)"
+    )
+    parser.add_argument(
+        '--stages', default=','.join([name for (name, _) in stages]),
+        help="comma-separated stages to run (default: %(default)s)"
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help="runs per measurement, best time wins (default: %(default)s)"
+    )
+    parser.add_argument(
+        '--no-memory', action='store_true',
+        help="skip the (slow) peak memory measurement"
+    )
+    parser.add_argument(
+        '--compression', action='store_true',
+        help="measure card compression instead of the parsing stages"
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the results to a JSON file")
+    args = parser.parse_args()
+
+    card_counts = [int(n) for n in args.cards.split(',')]
+    stage_names = args.stages.split(',')
+    stage_funcs = dict(stages)
+    for name in stage_names:
+        if name not in stage_funcs:
+            parser.error("unknown stage '%s'" % name)
+        continue
+    sql_templates = db.load_sql_templates(path='lib/retainn/sql')
+
+    if args.compression:
+        results = []
+        print("%-6s %9s %9s %10s %12s" % (
+            'level', 'cards', 'DB MB', 'insert s', 'fetch us'
+        ))
+        for card_count in card_counts:
+            level_results = bench_compression(
+                card_count, args.card_size, args.code_density, args.seed,
+                sql_templates
+            )
+            for result in level_results:
+                if result['level'] is None:
+                    level = 'off'
+                else:
+                    level = str(result['level'])
+                print("%-6s %9d %9.1f %10.2f %12.1f" % (
+                    level, card_count, result['db_bytes'] / 1e6,
+                    result['insert_seconds'], result['fetch_seconds'] * 1e6
+                ))
+                sys.stdout.flush()
+                continue
+            results.extend(level_results)
+            continue
+        write_report(args, results)
+        return
+
+    results = []
+    print("%-8s %9s %9s %10s %12s %12s" % (
+        'stage', 'cards', 'MB', 'MB/s', 'cards/s', 'peak MB'
+    ))
+    for card_count in card_counts:
+        markdown = make_deck(
+            card_count, args.card_size, args.code_density, args.seed
+        )
+        megabytes = len(markdown) / 1e6
+        for name in stage_names:
+            run = stage_funcs[name](markdown, sql_templates)
+            (seconds, peak) = measure(run, args.repeat, not args.no_memory)
+            seconds = max(seconds, 1e-9)
+            result = {
+                'stage': name,
+                'cards': card_count,
+                'bytes': len(markdown),
+                'seconds': seconds,
+                'mb_per_sec': megabytes / seconds,
+                'cards_per_sec': card_count / seconds,
+                'peak_bytes': peak,
+            }
+            results.append(result)
+            if peak is None:
+                peak_mb = '-'
+            else:
+                peak_mb = '%.1f' % (peak / 1e6)
+            print("%-8s %9d %9.1f %10.1f %12.0f %12s" % (
+                name, card_count, megabytes, result['mb_per_sec'],
+                result['cards_per_sec'], peak_mb
+            ))
+            sys.stdout.flush()
+            continue
+        continue
+
+    write_report(args, results)
+
+
+def write_report(args, results):
+    """Write the results to args.output as JSON, if requested."""
+    if args.output:
+        report = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'card_size': args.card_size,
+            'code_density': args.code_density,
+            'seed': args.seed,
+            'results': results,
+        }
+        with open(args.output, 'w') as fd:
+            json.dump(report, fd, indent=2, sort_keys=True)
+            fd.write('\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@
 
 import sys
 import os
+import sqlite3
 
 from . import help
 from . import db
@@ -10,6 +11,29 @@ from . import prompt
 from . import webapp
 from . import curl
 from . import py23
+from . import rdeck
+from . import journal
+from . import scheduler
+
+
+def pop_profile_option(argv):
+    """Remove a leading '--profile <name>' or '--profile=<name>' option from
+    argv (after the executable name).
+    Returns the storage profile name, or None if the option wasn't given."""
+    if len(argv) < 2:
+        return None
+    if argv[1].startswith('--profile='):
+        profile = argv[1][len('--profile='):]
+        del argv[1]
+        return profile
+    if argv[1] == '--profile':
+        if len(argv) < 3:
+            help.print_help(sys.stderr)
+            sys.exit(1)
+        profile = argv[2]
+        del argv[1:3]
+        return profile
+    return None
 
 
 def run_help_command():
@@ -40,6 +64,24 @@ def run_help_command():
         elif help_command == 'serve':
             help.print_serve_help(sys.stdout)
             sys.exit(0)
+        elif help_command == 'compile':
+            help.print_compile_help(sys.stdout)
+            sys.exit(0)
+        elif help_command == 'export':
+            help.print_export_help(sys.stdout)
+            sys.exit(0)
+        elif help_command == 'search':
+            help.print_search_help(sys.stdout)
+            sys.exit(0)
+        elif help_command == 'backup':
+            help.print_backup_help(sys.stdout)
+            sys.exit(0)
+        elif help_command == 'restore':
+            help.print_restore_help(sys.stdout)
+            sys.exit(0)
+        elif help_command == 'db':
+            help.print_db_help(sys.stdout)
+            sys.exit(0)
         else:
             sys.stderr.write(
                 "Error: no help for unknown command '%s'\n" % help_command
@@ -59,8 +101,23 @@ def run_review_command(db_conn, sql_templates):
         return
     
     session_start = db.make_tstamp()
+    grade_journal = journal.GradeJournal()
+    queue = scheduler.Scheduler(
+        db_conn, sql_templates, session_start, grade_journal
+    )
+    try:
+        review_cards(db_conn, sql_templates, queue)
+    finally:
+        # this also runs on SIGINT, as the handler exits via SystemExit.
+        grade_journal.flush(db_conn, sql_templates)
+
+
+def review_cards(db_conn, sql_templates, queue):
+    """Review the cards of the queue until it is empty or the user quits."""
+    w = sys.stdout.write
+    exe = os.path.basename(sys.argv[0])
     while True:
-        card = db.select_next_card(db_conn, sql_templates, session_start)
+        card = queue.next_card(db_conn, sql_templates)
         if card is None:
             w("You're done!  No more cards to review in this session.\n")
             w("Run %s again to start a new session.\n" % exe)
@@ -69,26 +126,27 @@ def run_review_command(db_conn, sql_templates):
             w(
                 '----------------------------------------------------------------\n'
             )
-            w('Deck: %s\n' % card.deck_title)
+            w('Deck: %s\n' % py23.to_str(card.deck_title))
             w('card_id: %s, score: %s\n\n' % (card.card_id, card.score))
-            w(card.front)
+            w(py23.to_str(card.front))
             w('\n\n')
             prompt.prompt('--- (press any key to reveal back of card) ---')
             w('\n')
-            w(card.back)
+            back = db.select_card_back(db_conn, sql_templates, card.card_id)
+            w(py23.to_str(back))
             w('\n\n')
             answer = prompt.prompt_Ynsq(
                 "Were you able recall the answer (Yes, no, skip, quit)? [Y/n/s/q] "
             )
             if answer in ['y', 'n', 's']:
                 if answer == 'y':
-                    score = db.did_recall_card(db_conn, sql_templates, card.card_id)
+                    score = queue.grade(db_conn, sql_templates, card.card_id, 'recall')
                     w("Updating score: %s.\n\n" % score)
                 elif answer == 'n':
-                    score = db.did_not_recall_card(db_conn, sql_templates, card.card_id)
+                    score = queue.grade(db_conn, sql_templates, card.card_id, 'not_recall')
                     w("Updating score: %s.\n\n" % score)
                 elif answer == 's':
-                    db.skip_card(db_conn, sql_templates, card.card_id)
+                    queue.grade(db_conn, sql_templates, card.card_id, 'skip')
                     w("Skipping card (score: %s).\n\n" % card.score)
                 continue
             elif answer == 'q':
@@ -120,10 +178,33 @@ def run_import_command(db_conn, sql_templates):
     if len(sys.argv) < 3:
         help.print_import_help(sys.stderr)
         sys.exit(1)
-    gist_url = sys.argv[2]
-    deck_id = util.import_deck_url(db_conn, sql_templates, gist_url)
-    sys.stdout.write("Imported deck_id: %s\n" % deck_id)
-    sys.exit(0)
+    sources = util.deck_sources(sys.argv[2:])
+    if len(sources) == 0:
+        sys.stderr.write("Error: no decks found.\n")
+        sys.exit(1)
+    elif len(sources) == 1:
+        source = sources[0]
+        if util.is_url(source):
+            deck_id = util.import_deck_url(db_conn, sql_templates, source)
+        elif rdeck.is_rdeck_path(source):
+            deck_id = util.import_deck_rdeck(db_conn, sql_templates, source)
+        else:
+            deck_id = util.import_deck_file(db_conn, sql_templates, source)
+        sys.stdout.write("Imported deck_id: %s\n" % deck_id)
+        sys.exit(0)
+    else:
+        failed = 0
+        results = util.import_decks(db_conn, sql_templates, sources)
+        for (source, deck_id, error) in results:
+            if error is None:
+                sys.stdout.write("Imported deck_id: %s (%s)\n" % (deck_id, source))
+            else:
+                sys.stderr.write("Error: couldn't import %s: %s\n" % (source, error))
+                failed += 1
+            continue
+        if failed > 0:
+            sys.exit(1)
+        sys.exit(0)
 
 
 def run_update_decks_command(db_conn, sql_templates):
@@ -136,7 +217,23 @@ def run_update_decks_command(db_conn, sql_templates):
         for deck in decks:
             w("Checking deck %s '%s'... " % (deck.deck_id, deck.title))
             sys.stdout.flush()
-            (markdown, new_etag) = curl.http_get_deck_if_needed(deck.gist_url, deck.etag)
+            if util.is_url(deck.gist_url):
+                (markdown, new_etag) = curl.http_get_deck_if_needed(deck.gist_url, deck.etag)
+            elif rdeck.is_rdeck_path(deck.gist_url):
+                # a compiled deck file.
+                with rdeck.CompiledDeck(deck.gist_url) as compiled:
+                    is_up_to_date = compiled.hash == deck.hash
+                if is_up_to_date:
+                    w("up to date, skipping.\n")
+                else:
+                    w("updating.\n")
+                    util.update_deck_rdeck(db_conn, sql_templates, deck.deck_id, deck.gist_url)
+                continue
+            else:
+                # a local deck file.
+                (markdown, new_etag) = (db.read_file_bytes(deck.gist_url), None)
+                if db.md5(markdown) == deck.hash:
+                    markdown = None
             if markdown is None:
                 w("up to date, skipping.\n")
                 continue
@@ -161,9 +258,135 @@ def run_remove_command(db_conn, sql_templates):
     assert False, 'Not implemented.'
 
 
-def run_serve_command(db_conn, sql_templates):
+def run_compile_command():
+    """Execute the 'compile' command."""
+    if len(sys.argv) < 4:
+        help.print_compile_help(sys.stderr)
+        sys.exit(1)
+    md_path = sys.argv[2]
+    rdeck_path = sys.argv[3]
+    rdeck.compile_deck_file(md_path, rdeck_path)
+    sys.stdout.write("Compiled %s to %s\n" % (md_path, rdeck_path))
+    sys.exit(0)
+
+
+def run_export_command(db_conn, sql_templates):
+    """Execute the 'export' command."""
+    if len(sys.argv) < 3 or not py23.isnumeric(sys.argv[2]):
+        help.print_export_help(sys.stderr)
+        sys.exit(1)
+    deck_id = int(sys.argv[2])
+    if len(sys.argv) < 4:
+        if sys.version_info[0] == 2:
+            fd = sys.stdout
+        else:
+            fd = sys.stdout.buffer
+        util.export_deck(db_conn, sql_templates, deck_id, fd)
+        fd.flush()
+        sys.exit(0)
+    path = sys.argv[3]
+    if path.endswith(os.sep) or os.path.isdir(path):
+        util.export_deck_to_disk(db_conn, sql_templates, deck_id, path)
+    else:
+        with open(path, 'wb') as fd:
+            util.export_deck(db_conn, sql_templates, deck_id, fd)
+    sys.stdout.write("Exported deck_id %s to %s\n" % (deck_id, path))
+    sys.exit(0)
+
+
+def run_search_command(db_conn, sql_templates):
+    """Execute the 'search' command."""
+    if len(sys.argv) < 3:
+        help.print_search_help(sys.stderr)
+        sys.exit(1)
+    w = sys.stdout.write
+    text = ' '.join(sys.argv[2:])
+    results = db.search_cards(db_conn, sql_templates, text)
+    if len(results) == 0:
+        w("No cards match '%s'.\n" % text)
+        sys.exit(1)
+    for result in results:
+        w("card_id: %s, deck: %s\n" % (
+            result.card_id, py23.to_str(result.deck_title)
+        ))
+        snippet = ' '.join(py23.to_str(result.snippet).split())
+        w("  %s\n\n" % snippet)
+        continue
+    sys.exit(0)
+
+
+def run_backup_command(db_conn, sql_templates):
+    """Execute the 'backup' command."""
+    if len(sys.argv) not in [3, 4]:
+        help.print_backup_help(sys.stderr)
+        sys.exit(1)
+    path = sys.argv[2]
+    pages_per_step = None
+    if len(sys.argv) == 4:
+        if not py23.isnumeric(sys.argv[3]) or int(sys.argv[3]) < 1:
+            help.print_backup_help(sys.stderr)
+            sys.exit(1)
+        pages_per_step = int(sys.argv[3])
+    w = sys.stdout.write
+
+    def progress(remaining, total):
+        w("\rBacked up %s of %s pages." % (total - remaining, total))
+        sys.stdout.flush()
+
+    db.backup_db(db_conn, path, pages_per_step, progress)
+    w("\rBacked up the database to %s\n" % path)
+    sys.exit(0)
+
+
+def run_restore_command(db_conn, sql_templates):
+    """Execute the 'restore' command."""
+    if len(sys.argv) != 3:
+        help.print_restore_help(sys.stderr)
+        sys.exit(1)
+    path = sys.argv[2]
+    try:
+        db.restore_db(db_conn, path)
+    except (AssertionError, sqlite3.DatabaseError) as e:
+        sys.stderr.write("Error: not restoring from %s: %s\n" % (path, e))
+        sys.exit(1)
+    sys.stdout.write("Restored the database from %s\n" % path)
+    sys.exit(0)
+
+
+def run_db_command(db_conn, sql_templates):
+    """Execute the 'db' command."""
+    if len(sys.argv) < 3:
+        help.print_db_help(sys.stderr)
+        sys.exit(1)
+    db_command = sys.argv[2]
+    if db_command == 'compress':
+        run_db_compress_command(db_conn, sql_templates)
+    else:
+        sys.stderr.write("Error: unknown db command '%s'\n" % db_command)
+        help.print_db_help(sys.stderr)
+        sys.exit(1)
+
+
+def run_db_compress_command(db_conn, sql_templates):
+    """Execute the 'db compress' command."""
+    w = sys.stdout.write
+
+    def progress(count):
+        w("\rCompressed %s cards." % count)
+        sys.stdout.flush()
+
+    size_before = db.select_db_size(db_conn)
+    count = db.compress_cards(db_conn, sql_templates, progress=progress)
+    w("\rCompressed %s cards.\n" % count)
+    w("Reclaiming free space...\n")
+    sys.stdout.flush()
+    db_conn.execute("VACUUM;")
+    size_after = db.select_db_size(db_conn)
+    w("Database size: %s bytes -> %s bytes.\n" % (size_before, size_after))
+
+
+def run_serve_command(db_conn, sql_templates, profile=None):
     """Run the Retainn webapp locally."""
-    import wsgiref.simple_server
     if len(sys.argv) == 2:
         host = 'localhost'
         port = 8080
@@ -178,8 +401,37 @@ def run_serve_command(db_conn, sql_templates):
     elif len(sys.argv) == 4:
         host = sys.argv[2]
         port = int(sys.argv[3])
+    # each request thread gets its own connection, except to an in-memory
+    # database, which can only be served from this thread.
+    fname = db.select_db_fname(db_conn)
+    if fname is None:
+        pool = db.ConnectionPool(None, db_conn=db_conn)
+        threads = 1
+    else:
+        pool = db.ConnectionPool(fname, profile)
+        threads = webapp.default_threads
     session_start = db.make_tstamp()
-    application = webapp.make_application(db_conn, sql_templates, session_start)
-    server = wsgiref.simple_server.make_server(host, port, application)
+    grade_journal = journal.GradeJournal()
+    application = webapp.make_application(
+        pool, sql_templates, session_start, grade_journal
+    )
+    server = webapp.make_server(host, port, application, threads)
+    # an in-memory database can't be flushed from another thread, but is
+    # polled on each request anyway.
+    if fname is None:
+        timer = None
+    else:
+        timer = journal.FlushTimer(grade_journal, pool, sql_templates)
+        timer.start()
     sys.stdout.write("Starting webapp on http://%s:%s\n" % (host, port))
-    server.serve_forever()
+    try:
+        server.serve_forever()
+    finally:
+        # this also runs on SIGINT, as the handler exits via SystemExit.
+        # this waits for the request threads to finish, so no grade (and no
+        # pooled connection) is in use after it.
+        server.server_close()
+        if timer is not None:
+            timer.stop()
+        grade_journal.flush(db_conn, sql_templates)
+        pool.close()
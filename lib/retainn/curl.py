@@ -8,11 +8,22 @@ except ImportError:
     from urllib2 import Request, urlopen
 
 
-def http_get_deck_and_etag(gist_url):
-    """Download the markdown and etag of a deck URL."""
+def http_open_deck(gist_url):
+    """Start downloading a deck URL.
+    Returns (response, etag), where response is a file-like object from which
+    the markdown can be read.  The caller must close the response."""
     response = urlopen(gist_url + "/raw")
-    markdown = response.read()
     etag = response.headers['etag']
+    return (response, etag)
+
+
+def http_get_deck_and_etag(gist_url):
+    """Download the markdown and etag of a deck URL."""
+    (response, etag) = http_open_deck(gist_url)
+    try:
+        markdown = response.read()
+    finally:
+        response.close()
     return (markdown, etag)
 
 
@@ -1,25 +1,97 @@
 """Retainn database functions."""
 
+import collections
+import contextlib
 import errno
 import hashlib
+import itertools
 import os
 import sqlite3
-import subprocess
 import sys
+import threading
 import time
+import zlib
 
 from . import py23
 
 
 templates = None
 
+# Storage profiles: the pragmas set on each connection, by profile name.
+# All of them use WAL, so that the webapp's reads aren't blocked while decks
+# are being imported or updated.
+#   durable:      fsync every commit.
+#   fast:         fsync only at checkpoints (a power loss may lose the last
+#                 few commits, but can't corrupt the database).
+#   bulk-import:  never fsync, with a large cache, for loading many decks.
+storage_profiles = {
+    'durable': [
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'FULL'),
+        ('mmap_size', 0),
+        ('cache_size', -2000),
+        ('temp_store', 'DEFAULT'),
+        ('busy_timeout', 5000),
+    ],
+    'fast': [
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('mmap_size', 256 * 1024 * 1024),
+        ('cache_size', -16000),
+        ('temp_store', 'MEMORY'),
+        ('busy_timeout', 5000),
+    ],
+    'bulk-import': [
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'OFF'),
+        ('mmap_size', 256 * 1024 * 1024),
+        ('cache_size', -64000),
+        ('temp_store', 'MEMORY'),
+        ('busy_timeout', 30000),
+    ],
+}
+default_storage_profile = 'durable'
 
-# Thanks to https://stackoverflow.com/q/4984647
-class Obj(dict):
-    def __getattr__(self, attr):
-        return self[attr]
-    def __setattr__(self, attr, value):
-        self[attr] = value
+
+# Row records.  The field order matches the columns of the queries which
+# produce them, so that a row can be turned into a record in one call (see
+# the *_row_factory functions).
+Deck = collections.namedtuple('Deck', [
+    'deck_id', 'gist_url', 'last_fetched', 'etag', 'hash', 'title', 'preamble'
+])
+Card = collections.namedtuple('Card', [
+    'card_id', 'score', 'front', 'back', 'deck_id', 'deck_title', 'last_seen'
+])
+CardFront = collections.namedtuple('CardFront', [
+    'card_id', 'score', 'front', 'deck_id', 'deck_title', 'last_seen'
+])
+SearchResult = collections.namedtuple('SearchResult', [
+    'card_id', 'deck_id', 'deck_title', 'snippet'
+])
+
+
+def deck_row_factory(cursor, row):
+    """An sqlite3 row_factory which makes a Deck of each row."""
+    return Deck._make(row)
+
+
+def card_row_factory(cursor, row):
+    """An sqlite3 row_factory which makes a Card of each row, decompressing
+    the front and back."""
+    (card_id, score, front, back, deck_id, deck_title, last_seen) = row
+    return Card(
+        card_id, score, decompress_body(front), decompress_body(back),
+        deck_id, deck_title, last_seen
+    )
+
+
+def card_front_row_factory(cursor, row):
+    """An sqlite3 row_factory which makes a CardFront of each row,
+    decompressing the front."""
+    (card_id, score, front, deck_id, deck_title, last_seen) = row
+    return CardFront(
+        card_id, score, decompress_body(front), deck_id, deck_title, last_seen
+    )
 
 
 def make_tstamp():
@@ -34,6 +106,13 @@ def read_file(fname):
     return contents
 
 
+def read_file_bytes(fname):
+    """Return the contents of a file, as bytes."""
+    with open(fname, 'rb') as fd:
+        contents = fd.read()
+    return contents
+
+
 # thanks to https://stackoverflow.com/a/600612
 def mkdir_p(path):
     """Create a directory, creating any necessary parent directories."""
@@ -46,32 +125,196 @@ def mkdir_p(path):
             raise
 
 
-def create_db(sql_templates_path, fname):
-    """Create an Sqlite3 database, initialized with the retainn schema."""
-    db_path = os.path.dirname(fname)
-    if db_path not in ['', '.', './']:
-        mkdir_p(db_path)
-    schema = "%s/schema.sql" % sql_templates_path
-    cmd = ['sqlite3', fname]
-    stdin = open(schema)
-    # FIXME: handle sqlite3 not being installed
-    if sys.version_info[0] == 2:
-        subprocess.check_call(cmd, stdin=stdin)
-    else:
-        subprocess.run(cmd, stdin=stdin, check=True)
-    stdin.close()
+def create_db(sql_templates_path, fname, profile=None):
+    """Create an Sqlite3 database, initialized with the retainn schema.
+    Returns a connection to the new database.
+    fname may be ':memory:' for a throwaway in-memory database."""
+    if fname != ':memory:':
+        db_path = os.path.dirname(fname)
+        if db_path not in ['', '.', './']:
+            mkdir_p(db_path)
+    db_conn = open_db(fname, profile)
+    init_db(db_conn, sql_templates_path)
+    return db_conn
+
+
+def create_memory_db(sql_templates_path, profile=None):
+    """Create an in-memory Sqlite3 database, initialized with the retainn
+    schema.
+    Returns a connection to the new database."""
+    return create_db(sql_templates_path, ':memory:', profile)
 
 
-def open_db(fname):
-    """Connect to a Sqlite3 database file."""
-    db_conn = sqlite3.connect(fname, isolation_level=None)
+# The contents of schema.sql, by path, so that creating many databases only
+# reads it once.
+schema_scripts = {}
+
+
+def init_db(db_conn, sql_templates_path):
+    """Create the retainn schema in an empty database, in one transaction."""
+    fname = "%s/schema.sql" % sql_templates_path
+    if fname not in schema_scripts:
+        schema_scripts[fname] = "BEGIN;\n%s\nCOMMIT;\n" % read_file(fname)
+    db_conn.executescript(schema_scripts[fname])
+
+
+# The version of the schema in schema.sql.  Older databases are upgraded by
+# running each of migrate_to_N.sql in turn.
+schema_version = 7
+
+
+def select_schema_version(db_conn):
+    """Return the schema version of the database, as an int."""
+    cursor = db_conn.cursor()
+    result = cursor.execute("SELECT schema_version FROM retainn_schema;")
+    row = result.fetchone()
+    cursor.close()
+    assert row is not None, "Database has no schema version."
+    return int(row[0])
+
+
+def migrate_db(db_conn, sql_templates_path):
+    """Upgrade the database schema in place to the latest version.
+    Each migration runs in its own transaction.
+    Returns the list of versions which were migrated to."""
+    register_functions(db_conn)
+    version = select_schema_version(db_conn)
+    assert version <= schema_version, \
+        "Database schema version %s is newer than this retainn." % version
+    migrated = []
+    while version < schema_version:
+        version += 1
+        fname = "%s/migrate_to_%d.sql" % (sql_templates_path, version)
+        script = read_file(fname)
+        try:
+            db_conn.executescript(script)
+        except sqlite3.Error:
+            try:
+                db_conn.execute("ROLLBACK;")
+            except sqlite3.OperationalError:
+                # the transaction was never started.
+                pass
+            raise
+        migrated.append(version)
+        continue
+    return migrated
+
+
+def open_db(fname, profile=None, check_same_thread=True):
+    """Connect to a Sqlite3 database file, configured with the named storage
+    profile (see storage_profiles)."""
+    db_conn = sqlite3.connect(
+        fname, isolation_level=None, check_same_thread=check_same_thread
+    )
+    if profile is None:
+        profile = default_storage_profile
+    set_storage_profile(db_conn, profile)
     return db_conn
 
 
+class ConnectionPool(object):
+    """Hands each thread its own connection to a database file, opened on the
+    thread's first call to connection(), as an sqlite3 connection can't be
+    used by several threads at once.  Under WAL, the threads can then read in
+    parallel.
+    An in-memory database (fname None) exists only within its connection, so
+    there the pool hands out db_conn to every thread, and the caller must
+    keep to a single thread."""
+    __slots__ = ('fname', 'profile', 'db_conn', 'local', 'lock', 'connections')
+
+    def __init__(self, fname, profile=None, db_conn=None):
+        assert fname is not None or db_conn is not None
+        self.fname = fname
+        self.profile = profile
+        self.db_conn = db_conn
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+
+    def connection(self):
+        """Return the calling thread's connection."""
+        if self.fname is None:
+            return self.db_conn
+        db_conn = getattr(self.local, 'db_conn', None)
+        if db_conn is None:
+            # the connection is only used by this thread, but close() may be
+            # called from another.
+            db_conn = open_db(self.fname, self.profile, check_same_thread=False)
+            self.local.db_conn = db_conn
+            with self.lock:
+                self.connections.append(db_conn)
+        return db_conn
+
+    def close(self):
+        """Close the connections opened by the pool.  The threads which used
+        them must have stopped (e.g. by webapp.PooledWSGIServer.server_close),
+        as closing a connection breaks any request still using it."""
+        with self.lock:
+            for db_conn in self.connections:
+                db_conn.close()
+                continue
+            self.connections = []
+        self.local = threading.local()
+
+
+def select_db_fname(db_conn):
+    """Return the file name of the connection's main database, or None if it
+    is an in-memory database."""
+    cursor = db_conn.cursor()
+    result = cursor.execute("PRAGMA database_list;")
+    rows = result.fetchall()
+    cursor.close()
+    for (_, name, fname) in rows:
+        if name == 'main' and fname:
+            return fname
+        continue
+    return None
+
+
+def register_functions(db_conn):
+    """Register the SQL functions which the migrations use on a connection:
+      retainn_decompress(body): as per decompress_body (used to index the
+        text of existing card content)."""
+    db_conn.create_function('retainn_decompress', 1, decompress_body)
+
+
+def set_storage_profile(db_conn, profile):
+    """Set the pragmas of the named storage profile on a connection."""
+    assert profile in storage_profiles, \
+        "Unknown storage profile '%s'." % profile
+    cursor = db_conn.cursor()
+    for (pragma, value) in storage_profiles[profile]:
+        # pragmas can't take bound parameters.
+        cursor.execute("PRAGMA %s = %s;" % (pragma, value))
+        cursor.fetchall()
+        continue
+    cursor.close()
+
+
+@contextlib.contextmanager
+def transaction(db_conn):
+    """Run the body of a 'with' block in a single transaction, which is
+    committed at the end of the block or rolled back if it raises.
+    Connections are opened in autocommit mode, where each statement would
+    otherwise be its own transaction (and fsync).  Transactions may be nested,
+    as they are implemented with savepoints."""
+    db_conn.execute("SAVEPOINT retainn_transaction;")
+    try:
+        yield db_conn
+    except BaseException:
+        db_conn.execute("ROLLBACK TO SAVEPOINT retainn_transaction;")
+        db_conn.execute("RELEASE SAVEPOINT retainn_transaction;")
+        raise
+    db_conn.execute("RELEASE SAVEPOINT retainn_transaction;")
+
+
 def md5(s):
     """Return the md5 sum (as a hex string) of the given string."""
     if sys.version_info[0] == 2:
-        return hashlib.md5(s.encode('utf-8')).hexdigest()
+        if isinstance(s, unicode):
+            return hashlib.md5(s.encode('utf-8')).hexdigest()
+        else:
+            return hashlib.md5(s).hexdigest()
     else:
         if isinstance(s, str):
             return hashlib.md5(s.encode('utf-8')).hexdigest()
@@ -99,14 +342,49 @@ def load_sql_templates(names=None, path='./sql'):
     if names is None:
         names = [
             'insert_card',
+            'insert_card_content',
+            'insert_card_fts',
+            'delete_card_fts',
+            'select_compressed_content_for_deck',
+            'select_compressed_content_by_hash',
             'insert_deck',
             'delete_deck',
             'select_decks',
             'select_card_by_id',
+            'select_card_front_by_id',
+            'select_card_back_by_id',
+            'select_setting',
+            'replace_setting',
+            'select_card_content_batch',
+            'update_card_content',
             'select_next_card',
             'select_count_card',
+            'select_max_card_id',
             'update_card_score_last_seen',
+            'grade_card',
+            'select_card_score',
+            'select_card_schedule',
+            'insert_review',
+            'insert_graded_review',
+            'select_reviews_by_card_id',
+            'search_cards',
+            'create_temp_card_snippet',
+            'insert_temp_card_snippet',
+            'select_temp_card_snippet',
+            'clear_temp_card_snippet',
             'delete_cards_for_deck',
+            'update_deck',
+            'select_card_hashes_by_deck_id',
+            'delete_cards_by_hash',
+            'create_temp_card_hash',
+            'insert_temp_card_hash',
+            'clear_temp_card_hash',
+            'select_deck_markdown',
+            'replace_deck_markdown',
+            'select_deck_by_id',
+            'select_deck_by_gist_url',
+            'update_deck_fetched',
+            'select_cards_by_deck_id',
         ]
     templates = {}
     for name in names:
@@ -181,28 +459,298 @@ def update_deck(
     cursor.close()
 
 
+def select_deck_markdown(db_conn, sql_templates, deck_id):
+    """Return the markdown of a deck as of its last import or update, or None
+    if it wasn't recorded."""
+    assert py23.is_int(deck_id)
+    sql = sql_templates['select_deck_markdown']
+    params = {'deck_id': deck_id}
+    cursor = db_conn.cursor()
+    result = cursor.execute(sql, params)
+    row = result.fetchone()
+    cursor.close()
+    if row is None:
+        return None
+    else:
+        return row[0]
+
+
+def replace_deck_markdown(db_conn, sql_templates, deck_id, markdown):
+    """Record the markdown of a deck, replacing any previous markdown.
+    markdown may be a memoryview, which sqlite stores as a blob."""
+    assert py23.is_int(deck_id)
+    assert py23.is_str(markdown) or py23.is_buffer(markdown)
+    sql = sql_templates['replace_deck_markdown']
+    params = {'deck_id': deck_id, 'markdown': markdown}
+    cursor = db_conn.cursor()
+    cursor.execute(sql, params)
+    cursor.close()
+
+
 def select_decks(db_conn, sql_templates):
     """Select all of the decks.
-    Returns a list of objects with keys: deck_id, gist_url, last_fetched, etag,
-    hash, title, preamble."""
+    Returns a list of Decks."""
     sql = sql_templates['select_decks']
     cursor = db_conn.cursor()
+    cursor.row_factory = deck_row_factory
     result = cursor.execute(sql)
-    rows = result.fetchall()
-    objs = []
-    for row in rows:
-        obj = Obj()
-        obj.deck_id = row[0]
-        obj.gist_url = row[1]
-        obj.last_fetched = row[2]
-        obj.etag = row[3]
-        obj.hash = row[4]
-        obj.title = row[5]
-        obj.preamble = row[6]
-        objs.append(obj)
+    decks = result.fetchall()
+    cursor.close()
+    return decks
+
+
+def select_deck(db_conn, sql_templates, deck_id):
+    """Select a deck by its deck_id.
+    Returns a Deck, or None if there is no such deck."""
+    assert py23.is_int(deck_id)
+    sql = sql_templates['select_deck_by_id']
+    params = {'deck_id': deck_id}
+    cursor = db_conn.cursor()
+    cursor.row_factory = deck_row_factory
+    result = cursor.execute(sql, params)
+    deck = result.fetchone()
+    cursor.close()
+    return deck
+
+
+def select_deck_by_gist_url(db_conn, sql_templates, gist_url):
+    """Select a deck by its gist URL (or file path).
+    Returns a Deck, or None if there is no such deck."""
+    assert py23.is_str(gist_url)
+    sql = sql_templates['select_deck_by_gist_url']
+    params = {'gist_url': gist_url}
+    cursor = db_conn.cursor()
+    cursor.row_factory = deck_row_factory
+    result = cursor.execute(sql, params)
+    deck = result.fetchone()
+    cursor.close()
+    return deck
+
+
+def update_deck_fetched(db_conn, sql_templates, deck_id, last_fetched, etag):
+    """Record that a deck was fetched again and found unchanged."""
+    for var in [deck_id, last_fetched]:
+        assert py23.is_int(var)
+        continue
+    if etag is not None:
+        assert py23.is_str(etag)
+    sql = sql_templates['update_deck_fetched']
+    params = {
+        'deck_id': deck_id,
+        'last_fetched': last_fetched,
+        'etag': etag
+    }
+    cursor = db_conn.cursor()
+    cursor.execute(sql, params)
+    cursor.close()
+
+
+def select_setting(db_conn, sql_templates, name, default=None):
+    """Return the value of a database-wide setting, or default if unset."""
+    assert py23.is_str(name)
+    sql = sql_templates['select_setting']
+    params = {'name': name}
+    cursor = db_conn.cursor()
+    result = cursor.execute(sql, params)
+    row = result.fetchone()
+    cursor.close()
+    if row is None:
+        return default
+    else:
+        return row[0]
+
+
+def replace_setting(db_conn, sql_templates, name, value):
+    """Set a database-wide setting."""
+    assert py23.is_str(name)
+    assert py23.is_str(value)
+    sql = sql_templates['replace_setting']
+    params = {'name': name, 'value': value}
+    cursor = db_conn.cursor()
+    cursor.execute(sql, params)
+    cursor.close()
+
+
+# Compressed card bodies are stored as a blob of this marker followed by the
+# zlib stream.  Markdown never contains a NUL, so the marker can't be mistaken
+# for an uncompressed body.
+compressed_marker = b'\x00RZ1'
+
+# Bodies shorter than this are never compressed.
+compress_min_size = 64
+
+compress_level = 6
+
+
+def is_compressing(db_conn, sql_templates):
+    """Return whether new card bodies should be stored compressed."""
+    value = select_setting(db_conn, sql_templates, 'compress_cards', '0')
+    return value == '1'
+
+
+def compress_body(body):
+    """Return a card body in its compressed form, or unchanged if it is
+    small or doesn't compress."""
+    if is_compressed(body) or len(body) < compress_min_size:
+        return body
+    data = py23.to_bytes(body)
+    packed = compressed_marker + zlib.compress(data, compress_level)
+    if len(packed) >= len(data):
+        return body
+    return py23.to_blob(packed)
+
+
+def body_text(body):
+    """Return an uncompressed card body as unicode text, for the full-text
+    index."""
+    return py23.to_bytes(body).decode('utf-8', 'replace')
+
+
+def is_compressed(body):
+    """Return whether a card body (as read from sqlite) is compressed."""
+    body = py23.from_blob(body)
+    return isinstance(body, bytes) and body.startswith(compressed_marker)
+
+
+def decompress_body(body):
+    """Return a card body (as read from sqlite) in its uncompressed form."""
+    body = py23.from_blob(body)
+    if isinstance(body, bytes) and body.startswith(compressed_marker):
+        return zlib.decompress(body[len(compressed_marker):])
+    return body
+
+
+def compress_cards(db_conn, sql_templates, batch_size=1000, progress=None):
+    """Turn on the 'compress_cards' setting, and compress the bodies of the
+    cards already in the database, batch_size cards per transaction.
+    progress, if given, is called with the number of cards compressed so far
+    after each batch.
+    Returns the number of cards compressed."""
+    replace_setting(db_conn, sql_templates, 'compress_cards', '1')
+    select_sql = sql_templates['select_card_content_batch']
+    update_sql = sql_templates['update_card_content']
+    after_rowid = -1
+    count = 0
+    while True:
+        cursor = db_conn.cursor()
+        params = {'after_rowid': after_rowid, 'limit': batch_size}
+        rows = cursor.execute(select_sql, params).fetchall()
+        if len(rows) == 0:
+            cursor.close()
+            break
+        updates = []
+        for (rowid, hash, front, back) in rows:
+            after_rowid = rowid
+            packed_front = compress_body(front)
+            packed_back = compress_body(back)
+            if packed_front is front and packed_back is back:
+                continue
+            updates.append(
+                {'hash': hash, 'front': packed_front, 'back': packed_back}
+            )
+            continue
+        with transaction(db_conn):
+            cursor.executemany(update_sql, updates)
+        cursor.close()
+        count += len(updates)
+        if progress is not None:
+            progress(count)
         continue
+    return count
+
+
+def select_db_size(db_conn):
+    """Return the size of the database, in bytes."""
+    cursor = db_conn.cursor()
+    page_count = cursor.execute("PRAGMA page_count;").fetchone()[0]
+    page_size = cursor.execute("PRAGMA page_size;").fetchone()[0]
     cursor.close()
-    return objs
+    return page_count * page_size
+
+
+# The number of pages copied per step of a backup.  Each step is a separate
+# read of the source, so writers are never locked out for long.
+backup_pages_per_step = 256
+
+
+def backup_db(db_conn, dest_fname, pages_per_step=None, progress=None):
+    """Copy the database to dest_fname while it stays in use, using the
+    sqlite backup API, pages_per_step pages at a time.  The copy is written
+    alongside dest_fname and then renamed over it, so dest_fname is never
+    left half-written.
+    progress, if given, is called with (pages remaining, total pages) after
+    each step."""
+    if pages_per_step is None:
+        pages_per_step = backup_pages_per_step
+    assert py23.is_int(pages_per_step) and pages_per_step > 0
+    assert select_db_fname(db_conn) != os.path.realpath(dest_fname), \
+        "Can't back up the database over itself."
+    tmp_fname = "%s.tmp" % dest_fname
+    if os.path.exists(tmp_fname):
+        os.remove(tmp_fname)
+    if hasattr(db_conn, 'backup'):
+        dest_conn = sqlite3.connect(tmp_fname)
+        try:
+            def on_step(status, remaining, total):
+                if progress is not None:
+                    progress(remaining, total)
+            db_conn.backup(dest_conn, pages=pages_per_step, progress=on_step)
+        finally:
+            dest_conn.close()
+    else:
+        # Python 2 lacks Connection.backup.  VACUUM INTO (sqlite 3.27.0 or
+        # later) instead copies a snapshot in a single read transaction,
+        # which under WAL doesn't block writers either.
+        assert sqlite3.sqlite_version_info >= (3, 27, 0), \
+            "Backups need Python 3.7 or sqlite 3.27.0 or later."
+        db_conn.execute("VACUUM INTO ?;", (tmp_fname,))
+    replace_file(tmp_fname, dest_fname)
+
+
+def replace_file(src, dst):
+    """Rename src over dst, atomically where the OS allows."""
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        # Python 2.  On POSIX, rename() replaces dst atomically.
+        os.rename(src, dst)
+
+
+def check_integrity(db_conn):
+    """Check the database for corruption.
+    Returns a list of the problems found, which is empty if there are none."""
+    cursor = db_conn.cursor()
+    result = cursor.execute("PRAGMA integrity_check;")
+    rows = result.fetchall()
+    cursor.close()
+    problems = [row[0] for row in rows]
+    if problems == ['ok']:
+        return []
+    return problems
+
+
+def restore_db(db_conn, src_fname):
+    """Replace the contents of the database with a backup of it, after
+    checking that the backup is an intact retainn database.
+    The backup is copied in with a single step of the sqlite backup API, so
+    the swap is atomic: other connections see either the old database or the
+    restored one.  (Renaming the file into place would not be safe, as the
+    old database's WAL file, and any open connections, would outlive it.)
+    The restored database may need migrating (see migrate_db)."""
+    assert hasattr(db_conn, 'backup'), "Restoring needs Python 3.7 or later."
+    assert os.path.isfile(src_fname), "No such file: %s" % src_fname
+    src_conn = sqlite3.connect(src_fname)
+    try:
+        problems = check_integrity(src_conn)
+        assert len(problems) == 0, \
+            "%s is corrupt: %s" % (src_fname, '; '.join(problems))
+        version = select_schema_version(src_conn)
+        assert version <= schema_version, \
+            "%s has schema version %s, which is newer than this retainn." \
+            % (src_fname, version)
+        src_conn.backup(db_conn, pages=-1)
+    finally:
+        src_conn.close()
 
 
 def make_card_hash(front, back):
@@ -215,33 +763,112 @@ def insert_card(
     db_conn, sql_templates, front, back, deck_id, last_seen=None, score=0
 ):
     """Insert a new card into the database.
+    front and back may be memoryviews, which sqlite stores as blobs.  They are
+    stored compressed if the 'compress_cards' setting is on.
     Returns the card_id of the inserted card."""
     for var in [front, back]:
-        assert py23.is_str(var)
+        assert py23.is_str(var) or py23.is_buffer(var)
         continue
     for var in [deck_id, score]:
         assert py23.is_int(var)
         continue
     if last_seen is not None:
         assert py23.is_int(last_seen)
-    sql = sql_templates['insert_card']
     hash = make_card_hash(front, back)
     params = {
         'score': score,
         'last_seen': last_seen,
-        'front': front,
-        'back': back,
         'hash': hash,
         'deck_id': deck_id
     }
-    cursor = db_conn.cursor()
-    cursor.execute(sql, params)
-    card_id = cursor.lastrowid
-    assert card_id is not None
-    cursor.close()
+    if is_compressing(db_conn, sql_templates):
+        params.update(compressed_card_params(front, back))
+    else:
+        params.update({'front': front, 'back': back})
+    with transaction(db_conn):
+        cursor = db_conn.cursor()
+        cursor.execute(sql_templates['insert_card_content'], params)
+        cursor.execute(sql_templates['insert_card'], params)
+        card_id = cursor.lastrowid
+        assert card_id is not None
+        if 'front_text' in params:
+            cursor.execute(sql_templates['insert_card_fts'], params)
+        cursor.close()
     return card_id
 
 
+def compressed_card_params(front, back):
+    """Return the 'front' and 'back' params of a card in their compressed
+    form, plus, if either is compressed (and so can't be indexed by the
+    card_content_insert_fts trigger), its 'front_text' and 'back_text' to be
+    indexed by insert_card_fts."""
+    params = {'front': compress_body(front), 'back': compress_body(back)}
+    if is_compressed(params['front']) or is_compressed(params['back']):
+        params['front_text'] = body_text(front)
+        params['back_text'] = body_text(back)
+    return params
+
+
+def insert_cards_bulk(db_conn, sql_templates, deck_id, cards):
+    """Insert many new cards into a deck, and index their text for search,
+    in a single transaction.
+    cards is an iterable of (front, back, card hash) tuples, where the card
+    hash may be None to have it computed here.  front and back may be
+    memoryviews.  They are stored compressed if the 'compress_cards' setting is
+    on.
+    Returns the number of cards inserted."""
+    assert py23.is_int(deck_id)
+    compress = is_compressing(db_conn, sql_templates)
+
+    def card_params():
+        for (front, back, hash) in cards:
+            if hash is None:
+                hash = make_card_hash(front, back)
+            params = {
+                'score': 0,
+                'last_seen': None,
+                'hash': hash,
+                'deck_id': deck_id
+            }
+            if compress:
+                params.update(compressed_card_params(front, back))
+            else:
+                params.update({'front': front, 'back': back})
+            yield params
+            continue
+
+    # uncompressed content is indexed by a trigger as it is inserted; the
+    # compressed content of each batch has to be inserted before it is indexed.
+    count = 0
+    with transaction(db_conn):
+        cursor = db_conn.cursor()
+        for batch in iter_batches(card_params(), bulk_batch_size):
+            cursor.executemany(sql_templates['insert_card_content'], batch)
+            cursor.executemany(sql_templates['insert_card'], batch)
+            compressed = [params for params in batch if 'front_text' in params]
+            if len(compressed) > 0:
+                cursor.executemany(sql_templates['insert_card_fts'], compressed)
+            count += len(batch)
+            continue
+        cursor.close()
+    return count
+
+
+# The number of rows handed to each executemany by the bulk inserts.
+bulk_batch_size = 1000
+
+
+def iter_batches(iterable, size):
+    """Yield lists of up to size items from iterable."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if len(batch) == 0:
+            break
+        yield batch
+        continue
+
+
 def select_count_card(db_conn, sql_templates):
     """Return the number of cards."""
     sql = sql_templates['select_count_card']
@@ -252,51 +879,107 @@ def select_count_card(db_conn, sql_templates):
     return int(count)
 
 
+def select_max_card_id(db_conn, sql_templates):
+    """Return the greatest card_id, or 0 if there are no cards.  As card_ids
+    are never reused, this changes whenever cards are added."""
+    sql = sql_templates['select_max_card_id']
+    cursor = db_conn.cursor()
+    result = cursor.execute(sql)
+    (card_id,) = result.fetchone()
+    cursor.close()
+    return int(card_id)
+
+
 def select_next_card(db_conn, sql_templates, session_start):
     """Select the best next card to show the user.
-    Returns an object with keys: card_id, score, last_seen, front, back,
-    deck_id, deck_title."""
+    Returns a CardFront (see select_card_back for the back of the card), or
+    None."""
     assert py23.is_int(session_start)
     sql = sql_templates['select_next_card']
     params = {
         'session_start': session_start
     }
     cursor = db_conn.cursor()
+    cursor.row_factory = card_front_row_factory
+    results = cursor.execute(sql, params)
+    card = results.fetchone()
+    cursor.close()
+    return card
+
+
+def find_card_front(db_conn, sql_templates, card_id):
+    """Select a card by its card_id, without its back, if it exists.
+    Returns a CardFront, or None."""
+    assert py23.is_int(card_id)
+    sql = sql_templates['select_card_front_by_id']
+    params = {
+        'card_id': card_id
+    }
+    cursor = db_conn.cursor()
+    cursor.row_factory = card_front_row_factory
+    results = cursor.execute(sql, params)
+    card = results.fetchone()
+    cursor.close()
+    return card
+
+
+def select_card_back(db_conn, sql_templates, card_id):
+    """Return the back of a card."""
+    assert py23.is_int(card_id)
+    sql = sql_templates['select_card_back_by_id']
+    params = {
+        'card_id': card_id
+    }
+    cursor = db_conn.cursor()
     results = cursor.execute(sql, params)
     row = results.fetchone()
     cursor.close()
-    if row is None:
-        return None
-    else:
-        obj = Obj()
-        obj.card_id = row[0]
-        obj.score = row[1]
-        obj.front = row[2]
-        obj.back = row[3]
-        obj.deck_id = row[4]
-        obj.deck_title = row[5]
-        return obj
+    assert row is not None
+    return decompress_body(row[0])
 
 
 def select_card(db_conn, sql_templates, card_id):
+    """Select a card by its card_id.
+    Returns a Card."""
+    card = find_card(db_conn, sql_templates, card_id)
+    assert card is not None
+    return card
+
+
+def find_card(db_conn, sql_templates, card_id):
+    """Select a card by its card_id, if it exists.
+    Returns a Card, or None."""
     assert py23.is_int(card_id)
     sql = sql_templates['select_card_by_id']
     params = {
         'card_id': card_id
     }
     cursor = db_conn.cursor()
+    cursor.row_factory = card_row_factory
     results = cursor.execute(sql, params)
-    row = results.fetchone()
+    card = results.fetchone()
     cursor.close()
-    assert row is not None
-    obj = Obj()
-    obj.card_id = row[0]
-    obj.score = row[1]
-    obj.front = row[2]
-    obj.back = row[3]
-    obj.deck_id = row[4]
-    obj.deck_title = row[5]
-    return obj
+    return card
+
+
+def select_card_schedule(
+    db_conn, sql_templates, session_start, after_card_id=0
+):
+    """Select the cards after after_card_id which haven't been seen since
+    session_start.
+    Returns a list of (card_id, score, last_seen) tuples."""
+    assert py23.is_int(session_start)
+    assert py23.is_int(after_card_id)
+    sql = sql_templates['select_card_schedule']
+    params = {
+        'session_start': session_start,
+        'after_card_id': after_card_id
+    }
+    cursor = db_conn.cursor()
+    results = cursor.execute(sql, params)
+    rows = results.fetchall()
+    cursor.close()
+    return rows
 
 
 def select_card_hashes_by_deck_id(db_conn, sql_templates, deck_id):
@@ -313,6 +996,29 @@ def select_card_hashes_by_deck_id(db_conn, sql_templates, deck_id):
     return hashes
 
 
+def iter_cards_by_deck_id(db_conn, sql_templates, deck_id, batch_size=1000):
+    """Yield the (front, back) of each card of a deck, fetching batch_size
+    rows at a time rather than the whole deck at once."""
+    assert py23.is_int(deck_id)
+    sql = sql_templates['select_cards_by_deck_id']
+    params = {
+        'deck_id': deck_id
+    }
+    cursor = db_conn.cursor()
+    try:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+            for row in rows:
+                yield (decompress_body(row[0]), decompress_body(row[1]))
+                continue
+            continue
+    finally:
+        cursor.close()
+
+
 def update_card_score_last_seen(
     db_conn, sql_templates, card_id, score, last_seen
 ):
@@ -332,42 +1038,154 @@ def update_card_score_last_seen(
     cursor.close()
 
 
-def did_recall_card(db_conn, sql_templates, card_id):
-    card = select_card(db_conn, sql_templates, card_id)
-    if card.score < 1:
-        score = 1
+# UPDATE ... RETURNING needs sqlite 3.35.0 or later.
+sqlite_has_returning = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+def grade_card(db_conn, sql_templates, card_id, grade):
+    """Move a card's score according to grade ('recall', 'not_recall' or
+    'skip'), mark it as seen now and log the review, in one transaction.
+    Returns the card's new score."""
+    assert py23.is_int(card_id)
+    assert grade in ['recall', 'not_recall', 'skip']
+    sql = sql_templates['grade_card']
+    params = {
+        'card_id': card_id,
+        'grade': grade,
+        'last_seen': make_tstamp()
+    }
+    cursor = db_conn.cursor()
+    with transaction(db_conn):
+        if sqlite_has_returning:
+            sql = "%s\nRETURNING score;" % sql.rstrip().rstrip(';')
+            result = cursor.execute(sql, params)
+            row = result.fetchone()
+        else:
+            # the transaction keeps another writer from grading the card
+            # between the UPDATE and the SELECT.
+            cursor.execute(sql, params)
+            sql = sql_templates['select_card_score']
+            result = cursor.execute(sql, {'card_id': card_id})
+            row = result.fetchone()
+        assert row is not None, "No card with card_id %s." % card_id
+        review = {
+            'card_id': card_id,
+            'grade': grade,
+            'score': row[0],
+            'reviewed_at': params['last_seen']
+        }
+        cursor.execute(sql_templates['insert_review'], review)
+    cursor.close()
+    return row[0]
+
+
+def graded_score(score, grade):
+    """Return the score a card moves to when graded, as per grade_card.sql."""
+    assert grade in ['recall', 'not_recall', 'skip']
+    if grade == 'recall':
+        if score < 1:
+            return 1
+        else:
+            return score + 1
+    elif grade == 'not_recall':
+        if score > 1:
+            return -1
+        else:
+            return score - 1
     else:
-        score = card.score + 1
-    now = make_tstamp()
-    last_seen = now
-    update_card_score_last_seen(
-        db_conn, sql_templates, card_id, score, last_seen
-    )
-    return score
+        return score
+
+
+def select_card_score(db_conn, sql_templates, card_id):
+    """Select the score of a card.
+    Returns the score, or None if there is no such card."""
+    assert py23.is_int(card_id)
+    sql = sql_templates['select_card_score']
+    params = {'card_id': card_id}
+    cursor = db_conn.cursor()
+    result = cursor.execute(sql, params)
+    row = result.fetchone()
+    cursor.close()
+    if row is None:
+        return None
+    return row[0]
+
+
+def write_reviews(db_conn, sql_templates, reviews):
+    """Apply a batch of grades, given as (card_id, grade, reviewed_at) tuples,
+    oldest first, and append them to the review log, in a single transaction.
+    Each grade moves the card's score as per grade_card.sql, so grades made
+    elsewhere since the batch was queued are not overwritten."""
+    # a card graded more than once in the batch must have its grades applied
+    # (and its scores logged) in turn, so the batch is split into rounds in
+    # which each card appears at most once.
+    rounds = []
+    counts = {}
+    for (card_id, grade, reviewed_at) in reviews:
+        assert grade in ['recall', 'not_recall', 'skip']
+        i = counts.get(card_id, 0)
+        counts[card_id] = i + 1
+        if i == len(rounds):
+            rounds.append([])
+        rounds[i].append((card_id, grade, reviewed_at))
+        continue
+    cursor = db_conn.cursor()
+    with transaction(db_conn):
+        for batch in rounds:
+            grades = [
+                {'card_id': card_id, 'grade': grade, 'last_seen': reviewed_at}
+                for (card_id, grade, reviewed_at) in batch
+            ]
+            cursor.executemany(sql_templates['grade_card'], grades)
+            logs = [
+                {'card_id': card_id, 'grade': grade, 'reviewed_at': reviewed_at}
+                for (card_id, grade, reviewed_at) in batch
+            ]
+            cursor.executemany(sql_templates['insert_graded_review'], logs)
+            continue
+    cursor.close()
+
+
+def select_reviews(db_conn, sql_templates, card_id):
+    """Select the review history of a card, oldest first.
+    Returns a list of (grade, score, reviewed_at) tuples."""
+    assert py23.is_int(card_id)
+    sql = sql_templates['select_reviews_by_card_id']
+    params = {'card_id': card_id}
+    cursor = db_conn.cursor()
+    result = cursor.execute(sql, params)
+    rows = result.fetchall()
+    cursor.close()
+    return rows
+
+
+def did_recall_card(db_conn, sql_templates, card_id):
+    return grade_card(db_conn, sql_templates, card_id, 'recall')
 
 
 def did_not_recall_card(db_conn, sql_templates, card_id):
-    card = select_card(db_conn, sql_templates, card_id)
-    if card.score > 1:
-        score = -1
-    else:
-        score = card.score - 1
-    now = make_tstamp()
-    last_seen = now
-    update_card_score_last_seen(
-        db_conn, sql_templates, card_id, score, last_seen
-    )
-    return score
+    return grade_card(db_conn, sql_templates, card_id, 'not_recall')
 
 
 def skip_card(db_conn, sql_templates, card_id):
-    card = select_card(db_conn, sql_templates, card_id)
-    score = card.score
-    now = make_tstamp()
-    last_seen = now
-    update_card_score_last_seen(
-        db_conn, sql_templates, card_id, score, last_seen
-    )
+    return grade_card(db_conn, sql_templates, card_id, 'skip')
+
+
+def unindex_compressed_content(cursor, sql_templates, select_sql, params):
+    """Unindex the compressed content selected by select_sql (one of the
+    select_compressed_content_* templates), which is about to be
+    garbage-collected.  The card_content_delete_fts trigger can't, as a
+    contentless index has to be given the text which it indexed."""
+    rows = cursor.execute(select_sql, params).fetchall()
+    deletes = []
+    for (content_id, front, back) in rows:
+        deletes.append({
+            'content_id': content_id,
+            'front_text': body_text(decompress_body(front)),
+            'back_text': body_text(decompress_body(back))
+        })
+        continue
+    cursor.executemany(sql_templates['delete_card_fts'], deletes)
 
 
 def delete_cards_for_deck(db_conn, sql_templates, deck_id):
@@ -376,26 +1194,106 @@ def delete_cards_for_deck(db_conn, sql_templates, deck_id):
     sql = sql_templates['delete_cards_for_deck']
     params = {'deck_id': deck_id}
     cursor = db_conn.cursor()
-    cursor.execute(sql, params)
+    with transaction(db_conn):
+        unindex_compressed_content(
+            cursor, sql_templates,
+            sql_templates['select_compressed_content_for_deck'], params
+        )
+        cursor.execute(sql, params)
     cursor.close()
 
 
 def delete_cards_by_hash(db_conn, sql_templates, deck_id, card_hashes):
-    """Delete the cards from a deck matching the given set of hashes."""
+    """Delete the cards from a deck matching the given set of hashes.
+    The hashes are loaded into a temporary table and the cards removed with a
+    single join-delete, so there is no limit on the number of hashes (as there
+    would be on the number of placeholders in an 'IN (?,?,...)' list)."""
     assert py23.is_int(deck_id)
     assert isinstance(card_hashes, set)
-    assert len(card_hashes) > 0
-    sql = sql_templates['delete_cards_by_hash']
-    sql = sql_replace_where_in(sql, len(card_hashes))
-    params = [deck_id] + list(card_hashes)
+    if len(card_hashes) == 0:
+        return
     cursor = db_conn.cursor()
-    cursor.execute(sql, params)
+    with transaction(db_conn):
+        cursor.execute(sql_templates['create_temp_card_hash'])
+        cursor.execute(sql_templates['clear_temp_card_hash'])
+        cursor.executemany(
+            sql_templates['insert_temp_card_hash'],
+            ((card_hash,) for card_hash in card_hashes)
+        )
+        params = {'deck_id': deck_id}
+        unindex_compressed_content(
+            cursor, sql_templates,
+            sql_templates['select_compressed_content_by_hash'], params
+        )
+        cursor.execute(sql_templates['delete_cards_by_hash'], params)
+        cursor.execute(sql_templates['clear_temp_card_hash'])
     cursor.close()
 
 
-def sql_replace_where_in(sql, q_count):
-    """Support 'WHERE IN' SQL templates.  Replace the first occurence of the
-    string '(?...?)' with some number of qmarks, e.g. '(?,?,?)'."""
-    qs = ','.join('?' * q_count)
-    sql2 = sql.replace('?...?', qs)
-    return sql2
+def make_fts_query(text):
+    """Turn search text into an FTS5 query which matches cards containing all
+    of its words.  Each word is quoted, so that punctuation (e.g. 'c++' or
+    'os.path') isn't taken as query syntax, except for a trailing '*', which
+    makes a prefix search."""
+    terms = []
+    for word in text.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if len(word) == 0:
+            continue
+        term = '"%s"' % word.replace('"', '""')
+        if prefix:
+            term += '*'
+        terms.append(term)
+        continue
+    return ' '.join(terms)
+
+
+def search_cards(
+    db_conn, sql_templates, text, limit=20, mark_start='[', mark_end=']'
+):
+    """Search the fronts and backs of the cards for text (see
+    make_fts_query).
+    Returns a list of up to limit SearchResults, best match first, whose
+    snippets have the matching words between mark_start and mark_end."""
+    query = make_fts_query(py23.to_unicode(text))
+    if len(query) == 0:
+        return []
+    sql = sql_templates['search_cards']
+    params = {
+        'query': query,
+        'limit': limit,
+        'mark_start': mark_start,
+        'mark_end': mark_end
+    }
+    cursor = db_conn.cursor()
+    rows = cursor.execute(sql, params).fetchall()
+    snippets = select_snippets(cursor, sql_templates, rows, params)
+    cursor.close()
+    results = []
+    for (i, (card_id, deck_id, title, _, _)) in enumerate(rows):
+        results.append(SearchResult(card_id, deck_id, title, snippets.get(i)))
+        continue
+    return results
+
+
+def select_snippets(cursor, sql_templates, rows, params):
+    """Return a snippet of the best matching side of each search_cards row,
+    as a dict by row index.
+    The index of card_content has no copy of the text, so the rows' bodies are
+    decompressed into a scratch index, and matched again there."""
+    texts = []
+    for (i, row) in enumerate(rows):
+        texts.append({
+            'rowid': i,
+            'front_text': body_text(decompress_body(row[3])),
+            'back_text': body_text(decompress_body(row[4]))
+        })
+        continue
+    cursor.execute(sql_templates['create_temp_card_snippet'])
+    cursor.execute(sql_templates['clear_temp_card_snippet'])
+    cursor.executemany(sql_templates['insert_temp_card_snippet'], texts)
+    sql = sql_templates['select_temp_card_snippet']
+    snippets = dict(cursor.execute(sql, params).fetchall())
+    cursor.execute(sql_templates['clear_temp_card_snippet'])
+    return snippets
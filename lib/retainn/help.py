@@ -12,14 +12,32 @@ def print_help(fd):
     w("See https://retainn.org\n")
     w("\n")
     w("Usage:\n")
+    w("  %s [--profile <profile>] <command> ...\n" % exe)
     w("  %s help [command]\n" % exe)
     w("  %s review\n" % exe)
     w("  %s decks\n" % exe)
-    w("  %s import <gist URL>\n" % exe)
+    w("  %s import <gist URL | file | directory>...\n" % exe)
     w("  %s update-decks\n" % exe)
     w("  %s update-deck <deck id>\n" % exe)
     w("  %s remove <deck_id | gist URL>\n" % exe)
     w("  %s serve [host] [port]\n" % exe)
+    w("  %s compile <deck.md> <deck.rdeck>\n" % exe)
+    w("  %s export <deck_id> [file | directory/]\n" % exe)
+    w("  %s search <words>...\n" % exe)
+    w("  %s backup <file> [pages per step]\n" % exe)
+    w("  %s restore <file>\n" % exe)
+    w("  %s db compress\n" % exe)
+    w("\n")
+    w("Environment:\n")
+    w("  RETAINN_DB  the database file (default: ~/.retainn/db.sqlite3),\n")
+    w("              or ':memory:' for a throwaway in-memory database.\n")
+    w("  RETAINN_STORAGE_PROFILE  the default for --profile.\n")
+    w("\n")
+    w("Storage profiles:\n")
+    w("  durable      (the default) fsync on every change.\n")
+    w("  fast         fsync less often; a power loss may lose the last\n")
+    w("               few changes, but won't corrupt the database.\n")
+    w("  bulk-import  never fsync.  For importing many decks at once.\n")
 
 
 def print_review_help(fd):
@@ -48,11 +66,19 @@ def print_import_help(fd):
     """Print the 'import' command usage to the file descriptor."""
     w = fd.write
     w("Command 'import':\n")
-    w("  Download and import a flashcard deck from a github gist URL.\n")
+    w("  Download and import a flashcard deck from a github gist URL,\n")
+    w("  or import a local markdown deck file.\n")
+    w("\n")
+    w("  Several decks (or a directory of '.md' decks) can be imported at\n")
+    w("  once, in which case they are parsed in parallel.\n")
     w("\n")
     exe = os.path.basename(sys.argv[0])
     w("Usage:\n")
     w("  %s import https://gist.github.com/...\n" % exe)
+    w("  %s import deck.md\n" % exe)
+    w("  %s import deck1.md deck2.md https://gist.github.com/...\n" % exe)
+    w("  %s import decks/\n" % exe)
+    w("  %s import deck.rdeck\n" % exe)
 
 
 def print_update_decks_help(fd):
@@ -100,3 +126,99 @@ def print_serve_help(fd):
     w("  %s serve 8081\n" % exe)
     w("  %s serve 0.0.0.0\n" % exe)
     w("  %s serve 0.0.0.0 8081\n" % exe)
+
+
+def print_compile_help(fd):
+    """Print the 'compile' command usage to the file descriptor."""
+    w = fd.write
+    w("Command 'compile':\n")
+    w("  Compile a markdown deck into a '.rdeck' file, which holds the\n")
+    w("  already parsed and hashed cards and can be imported without\n")
+    w("  parsing the markdown again.\n")
+    w("\n")
+    exe = os.path.basename(sys.argv[0])
+    w("Usage:\n")
+    w("  %s compile deck.md deck.rdeck\n" % exe)
+
+
+def print_export_help(fd):
+    """Print the 'export' command usage to the file descriptor."""
+    w = fd.write
+    w("Command 'export':\n")
+    w("  Write an imported deck back out as markdown, to stdout or a file.\n")
+    w("  If given a directory, the deck is instead exploded into\n")
+    w("  preamble.md and a N-front.md and N-back.md file per card.\n")
+    w("\n")
+    exe = os.path.basename(sys.argv[0])
+    w("Usage:\n")
+    w("  %s export <deck_id> [file | directory/]\n" % exe)
+    w("\n")
+    w("Examples:\n")
+    w("  %s export 3\n" % exe)
+    w("  %s export 3 deck.md\n" % exe)
+    w("  %s export 3 deck-cards/\n" % exe)
+
+
+def print_search_help(fd):
+    """Print the 'search' command usage to the file descriptor."""
+    w = fd.write
+    w("Command 'search':\n")
+    w("  Find the cards whose front or back contains all of the words,\n")
+    w("  best matches first.  A word ending in '*' matches any word which\n")
+    w("  starts with it.\n")
+    w("\n")
+    exe = os.path.basename(sys.argv[0])
+    w("Usage:\n")
+    w("  %s search <words>...\n" % exe)
+    w("\n")
+    w("Examples:\n")
+    w("  %s search goroutine\n" % exe)
+    w("  %s search 'channel buffer*'\n" % exe)
+
+
+def print_backup_help(fd):
+    """Print the 'backup' command usage to the file descriptor."""
+    w = fd.write
+    w("Command 'backup':\n")
+    w("  Copy the database to a file.  This is safe to run while the\n")
+    w("  database is in use (e.g. by '%s serve'), as the copy is made a\n"
+        % os.path.basename(sys.argv[0]))
+    w("  few pages at a time (default: 256), without locking out writers.\n")
+    w("\n")
+    exe = os.path.basename(sys.argv[0])
+    w("Usage:\n")
+    w("  %s backup <file> [pages per step]\n" % exe)
+    w("\n")
+    w("Examples:\n")
+    w("  %s backup retainn-backup.sqlite3\n" % exe)
+    w("  %s backup retainn-backup.sqlite3 1024\n" % exe)
+
+
+def print_restore_help(fd):
+    """Print the 'restore' command usage to the file descriptor."""
+    w = fd.write
+    w("Command 'restore':\n")
+    w("  Replace the database with a backup made by 'backup'.  The backup\n")
+    w("  is checked for corruption first, and swapped in all at once.\n")
+    w("\n")
+    exe = os.path.basename(sys.argv[0])
+    w("Usage:\n")
+    w("  %s restore <file>\n" % exe)
+    w("\n")
+    w("Examples:\n")
+    w("  %s restore retainn-backup.sqlite3\n" % exe)
+
+
+def print_db_help(fd):
+    """Print the 'db' command usage to the file descriptor."""
+    w = fd.write
+    w("Command 'db':\n")
+    w("  Database maintenance.\n")
+    w("\n")
+    exe = os.path.basename(sys.argv[0])
+    w("Usage:\n")
+    w("  %s db compress\n" % exe)
+    w("\n")
+    w("'compress' stores the front and back of each card zlib-compressed,\n")
+    w("both for the cards already in the database and for cards imported\n")
+    w("later.  Compressed cards are decompressed transparently.\n")
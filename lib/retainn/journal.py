@@ -0,0 +1,131 @@
+"""Retainn write-behind grade journal."""
+
+import sqlite3
+import threading
+import time
+
+from . import db
+
+
+# flush after this many grades...
+default_max_reviews = 32
+# ...or once the oldest pending grade is this many milliseconds old.
+default_max_delay_ms = 500
+
+
+class GradeJournal(object):
+    """A write-behind buffer of grades.
+    Grading a card computes its new score in memory and queues the grade; the
+    queued grades are then applied to the database (card scores and the
+    review log) in a single transaction, and so a single fsync, once
+    max_reviews are pending or the oldest is max_delay_ms old.  As the grades
+    are applied relative to the scores in the database at that time, grades
+    made elsewhere in the meantime are not lost.  flush() must be called
+    before the process exits, or the pending grades are lost.
+    The delay is checked whenever the journal is used (see poll()), and by a
+    FlushTimer, if one is running.  The journal may be shared by several
+    threads, each passing its own connection."""
+    __slots__ = (
+        'max_reviews', 'max_delay_ms', 'pending', 'scores', 'oldest', 'lock'
+    )
+
+    def __init__(
+        self, max_reviews=default_max_reviews,
+        max_delay_ms=default_max_delay_ms
+    ):
+        self.max_reviews = max_reviews
+        self.max_delay_ms = max_delay_ms
+        # (card_id, grade, reviewed_at) tuples, oldest first.
+        self.pending = []
+        # the expected score of each card in self.pending.
+        self.scores = {}
+        # the time.time() of the oldest pending grade, or None.
+        self.oldest = None
+        # re-entrant, as grade() flushes through poll().
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def grade(self, db_conn, sql_templates, card_id, grade):
+        """Grade a card ('recall', 'not_recall' or 'skip'), as per
+        db.grade_card, flushing the journal if it is due.
+        Returns the card's new score."""
+        with self.lock:
+            score = self.scores.get(card_id)
+            if score is None:
+                score = db.select_card_score(db_conn, sql_templates, card_id)
+                assert score is not None, "No card with card_id %s." % card_id
+            score = db.graded_score(score, grade)
+            self.pending.append((card_id, grade, db.make_tstamp()))
+            self.scores[card_id] = score
+            if self.oldest is None:
+                self.oldest = time.time()
+            self.poll(db_conn, sql_templates)
+        return score
+
+    def is_due(self):
+        """Return whether the pending grades should be written."""
+        with self.lock:
+            if len(self.pending) == 0:
+                return False
+            if len(self.pending) >= self.max_reviews:
+                return True
+            age_ms = (time.time() - self.oldest) * 1000
+            return age_ms >= self.max_delay_ms
+
+    def poll(self, db_conn, sql_templates):
+        """Flush the journal if it is due."""
+        with self.lock:
+            if self.is_due():
+                self.flush(db_conn, sql_templates)
+
+    def flush(self, db_conn, sql_templates):
+        """Write all of the pending grades to the database."""
+        with self.lock:
+            if len(self.pending) == 0:
+                return
+            db.write_reviews(db_conn, sql_templates, self.pending)
+            self.pending = []
+            self.scores = {}
+            self.oldest = None
+
+
+class FlushTimer(object):
+    """Polls a journal from a thread of its own (using that thread's
+    connection from pool, a db.ConnectionPool of a database file), so that
+    pending grades are written within about max_delay_ms even once no more
+    grades come in."""
+    __slots__ = ('journal', 'pool', 'sql_templates', 'stopped', 'thread')
+
+    def __init__(self, grade_journal, pool, sql_templates):
+        assert pool.fname is not None, \
+            "An in-memory database can't be used from a timer thread."
+        self.journal = grade_journal
+        self.pool = pool
+        self.sql_templates = sql_templates
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        """Start polling."""
+        self.thread.start()
+
+    def run(self):
+        """Poll the journal every half max_delay_ms, until stopped."""
+        db_conn = self.pool.connection()
+        interval = self.journal.max_delay_ms / 2000.0
+        while not self.stopped.wait(interval):
+            try:
+                self.journal.poll(db_conn, self.sql_templates)
+            except sqlite3.OperationalError:
+                # e.g. the database is locked: the grades stay pending, and
+                # the next poll tries again.
+                pass
+            continue
+
+    def stop(self):
+        """Stop polling, and wait for the thread to finish."""
+        self.stopped.set()
+        self.thread.join()
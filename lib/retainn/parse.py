@@ -1,84 +1,215 @@
 """Retainn markdown parsing functions."""
 
+import io
+import os
 import re
+from array import array
 
 
-# Thanks to https://stackoverflow.com/q/4984647
-class Obj(dict):
-    def __getattr__(self, attr):
-        return self[attr]
-    def __setattr__(self, attr, value):
-        self[attr] = value
-
 # TODO refactor to split these up, into '\n\n', '---', and '%'
 
+# The delimiter tokens, in order of precedence.  Anything which falls between
+# two delimiters is lexed as a single 'TOK_OTHER' token.
+pattern_table = [
+    ('TOK_CODE',  b'\n```'),
+    ('TOK_FRONT', b'\n\n---\n\n'),
+    ('TOK_BACK',  b'\n\n%\n\n'),
+    ('TOK_LAST',  b'\n\n---\n'),
+]
+
+# The demarcators used when writing a deck back out as markdown.
+front_demarcator = pattern_table[1][1]
+back_demarcator = pattern_table[2][1]
+last_demarcator = pattern_table[3][1]
+
+# The token type codes stored in a TokenTable.
+# The delimiter codes are their index into pattern_table.
+TOK_CODE = 0
+TOK_FRONT = 1
+TOK_BACK = 2
+TOK_LAST = 3
+TOK_OTHER = 4
+
+token_names = [label for (label, _) in pattern_table] + ['TOK_OTHER']
+
+# All of the delimiters as one alternation (one group per delimiter), so that
+# the regex engine can scan for the next delimiter without dropping back into
+# Python for every byte.  The leading newline which they all share is
+# factored out, which lets the regex engine skip ahead to the next newline
+# rather than trying every alternative at every byte.
+assert all([pattern.startswith(b'\n') for (_, pattern) in pattern_table])
+delimiter_regex = re.compile(
+    b'\n(?:'
+    + b'|'.join([b'(' + pattern[1:] + b')' for (_, pattern) in pattern_table])
+    + b')'
+)
+
+# A delimiter match which starts within this many bytes of the end of the
+# input seen so far might still change once more input arrives (e.g. a
+# 'TOK_LAST' which turns out to be the start of a 'TOK_FRONT').
+max_delimiter_len = max([len(pattern) for (_, pattern) in pattern_table])
+
+
+class TokenTable(object):
+    """The tokens of a lexed buffer, stored as parallel arrays of
+    (type code, start offset, end offset)."""
+    __slots__ = ('buf', 'types', 'starts', 'ends')
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.types = array('B')
+        self.starts = array('l')
+        self.ends = array('l')
+
+    def __len__(self):
+        return len(self.types)
+
+    def append(self, type_code, start, end):
+        """Append a token to the table."""
+        self.types.append(type_code)
+        self.starts.append(start)
+        self.ends.append(end)
+
+    def type_name(self, index):
+        """Return the name (e.g. 'TOK_FRONT') of the token at index."""
+        return token_names[self.types[index]]
+
+    def text(self, index):
+        """Return the text of the token at index."""
+        return self.buf[self.starts[index]:self.ends[index]]
+
+
+class Code(object):
+    """A code AST node: a fenced code block, as offsets into buf."""
+    __slots__ = ('buf', 'start', 'end')
+    type = 'AST_CODE'
+
+    def __init__(self, buf, start, end):
+        self.buf = buf
+        self.start = start
+        self.end = end
+
+    @property
+    def text(self):
+        return self.buf[self.start:self.end]
+
+
+class Preamble(object):
+    """A preamble AST node: everything before the first card, as offsets into
+    buf."""
+    __slots__ = ('buf', 'start', 'end')
+    type = 'AST_PREAMBLE'
+
+    def __init__(self, buf, start, end):
+        self.buf = buf
+        self.start = start
+        self.end = end
+
+    @property
+    def text(self):
+        return self.buf[self.start:self.end]
+
+
+class Card(object):
+    """A card AST node, as offsets into buf.
+    The front demarcator runs from start to front_start, the front text from
+    front_start to front_end, the back demarcator from front_end to
+    back_start, and the back text from back_start to back_end."""
+    __slots__ = (
+        'buf', 'start', 'front_start', 'front_end', 'back_start', 'back_end'
+    )
+    type = 'AST_CARD'
+
+    def __init__(self, buf, start, front_start, front_end, back_start, back_end):
+        self.buf = buf
+        self.start = start
+        self.front_start = front_start
+        self.front_end = front_end
+        self.back_start = back_start
+        self.back_end = back_end
+
+    @property
+    def front_demarcator(self):
+        return self.buf[self.start:self.front_start]
+
+    @property
+    def front_text(self):
+        return self.buf[self.front_start:self.front_end]
+
+    @property
+    def back_demarcator(self):
+        return self.buf[self.front_end:self.back_start]
+
+    @property
+    def back_text(self):
+        return self.buf[self.back_start:self.back_end]
+
+    @property
+    def text(self):
+        return self.buf[self.start:self.back_end]
+
+
+class Deck(object):
+    """A deck AST node: a preamble, a list of cards, and the offsets of the
+    closing 'TOK_LAST' token."""
+    __slots__ = ('buf', 'preamble', 'cards', 'last_start', 'last_end')
+    type = 'AST_DECK'
+
+    def __init__(self, buf, preamble, cards, last_start, last_end):
+        self.buf = buf
+        self.preamble = preamble
+        self.cards = cards
+        self.last_start = last_start
+        self.last_end = last_end
+
+    @property
+    def last_text(self):
+        return self.buf[self.last_start:self.last_end]
+
+
+class Error(object):
+    """A parse error node."""
+    __slots__ = ('message',)
+    type = 'ERROR'
+
+    def __init__(self, message):
+        self.message = message
+
 
 def lex_deck(text):
     """Lex the markdown text into tokens.
-    Returns an array of tokens (objects with keys: type, text).
-    On failure, returns an error (object with keys: type, message)."""
-    pattern_table = [
-        ('TOK_CODE',  b'\n```'),
-        ('TOK_FRONT', b'\n\n---\n\n'),
-        ('TOK_BACK',  b'\n\n%\n\n'),
-        ('TOK_LAST',  b'\n\n---\n'),
-        ('TOK_OTHER', b'[\s\S]'),
-    ]
-
-    regex_table = []
-    for label, pattern in pattern_table:
-        regex = re.compile(pattern)
-        pair = (label, regex)
-        regex_table.append(pair)
-        continue
-
-    tokens = []
+    Returns a TokenTable of the tokens.
+    Consecutive non-delimiter bytes are coalesced into one 'TOK_OTHER' token."""
+    tokens = TokenTable(text)
     index = 0
-    input_len = len(text)
-    while index < input_len:
-        for label, regex in regex_table:
-            match = regex.match(text, index)
-            if match:
-                matched_text = match.group()
-                token = Obj()
-                token.type = label
-                token.text = matched_text
-                tokens.append(token)
-                index += len(matched_text)
-                break
-            else:
-                continue
-        else:
-            context = text[index:index+16]
-            error = Obj()
-            error.type = 'ERROR'
-            error.message = "Couldn't match any token (index %s, context: )" \
-                % (index, context)
-            return error
+    for match in delimiter_regex.finditer(text):
+        start = match.start()
+        if start > index:
+            tokens.append(TOK_OTHER, index, start)
+        end = match.end()
+        tokens.append(match.lastindex - 1, start, end)
+        index = end
         continue
+    if index < len(text):
+        tokens.append(TOK_OTHER, index, len(text))
     return tokens
 
 
 def parse_code(tokens, index):
     """Parse a code AST node.
     Returns (AST node, next token index).
-    AST node is an object with keys: type, text.
     Returns (None, original index) on failure."""
     failure = (None, index)
-    code_text = ''
-    saved_tokens = tokens[index:]  # DEBUG
-
-    token = tokens[index]
-    assert token.type == 'TOK_CODE'
-    code_text += token.text
+    types = tokens.types
+    assert types[index] == TOK_CODE
+    start = tokens.starts[index]
     index += 1
 
     did_find_closing = False
-    while index < len(tokens):
-        token = tokens[index]
-        code_text += token.text
+    while index < len(types):
+        type_code = types[index]
         index += 1
-        if token.type == 'TOK_CODE':
+        if type_code == TOK_CODE:
             did_find_closing = True
             break
         else:
@@ -86,36 +217,37 @@ def parse_code(tokens, index):
     if did_find_closing == False:
         return failure
 
-    ast = Obj()
-    ast.type = 'AST_CODE'
-    ast.text = code_text
+    ast = Code(tokens.buf, start, tokens.ends[index - 1])
     return (ast, index)
 
 
 def parse_preamble(tokens, index):
     """Parse a preamble AST node.
     Returns (AST node, next token index).
-    AST node is an object with keys: type, text."""
+    Returns (None, original index) on failure."""
     failure = (None, index)
-    preamble_text = b''
-    while index < len(tokens):
-        token = tokens[index]
-        if token.type == 'TOK_CODE':
+    types = tokens.types
+    if index < len(types):
+        start = tokens.starts[index]
+    else:
+        start = len(tokens.buf)
+    end = start
+    while index < len(types):
+        type_code = types[index]
+        if type_code == TOK_CODE:
             ast, index = parse_code(tokens, index)
             if ast is None:
                 return failure
-            preamble_text += ast.text
+            end = ast.end
             continue
-        elif token.type == 'TOK_FRONT':
+        elif type_code == TOK_FRONT:
             # this signals the start of the first card.
             break
         else:
-            preamble_text += token.text
+            end = tokens.ends[index]
             index += 1
             continue
-    ast = Obj()
-    ast.type = 'AST_PREAMBLE'
-    ast.text = preamble_text
+    ast = Preamble(tokens.buf, start, end)
     return (ast, index)
 
 
@@ -125,13 +257,15 @@ def flatten_preamble(ast):
     return ast.text
 
 
+# title regex: some number of hashes followed by a non-hash.
+title_regex = re.compile(b'^#+[^#]\s*(.*)$')
+
+
 def extract_title(preamble_md):
     """Extract the title from preamble markdown.
     Returns None on failure."""
-    # title regex: some number of hashes followed by a non-hash.
-    regex = re.compile(b'^#+[^#]\s*(.*)$')
     for line in preamble_md.splitlines():
-        m = regex.match(line)
+        m = title_regex.match(line)
         if m:
             title = m.group(1)
             return title
@@ -143,118 +277,385 @@ def extract_title(preamble_md):
 def parse_card(tokens, index):
     """Parse a card AST node.
     Returns (AST node, next token index).
-    AST node is an object with keys: type, front_demarcator_token, front_text,
-    back_demarcator_token, back_text.
     Returns (None, original index) on failure."""
     failure = (None, index)
-    ast = None
-    front_demarcator_token = tokens[index]
-    assert front_demarcator_token.type == 'TOK_FRONT'
+    types = tokens.types
+    assert types[index] == TOK_FRONT
+    start = tokens.starts[index]
+    front_start = tokens.ends[index]
     index += 1
 
-    front_text = b''
-    back_demarcator_token = None
-    while index < len(tokens):
-        token = tokens[index]
-        index += 1
-        if token.type == 'TOK_BACK':
-            back_demarcator_token = token
+    back_demarcator_index = None
+    while index < len(types):
+        if types[index] == TOK_BACK:
+            back_demarcator_index = index
+            index += 1
             break
         else:
-            front_text += token.text
+            index += 1
             continue
-    if back_demarcator_token is None:
+    if back_demarcator_index is None:
         return failure
+    front_end = tokens.starts[back_demarcator_index]
+    back_start = tokens.ends[back_demarcator_index]
 
-    back_text = b''
-    while index < len(tokens):
-        token = tokens[index]
-        if token.type in ['TOK_FRONT', 'TOK_LAST']:
+    back_end = back_start
+    while index < len(types):
+        type_code = types[index]
+        if type_code in (TOK_FRONT, TOK_LAST):
             break
         else:
-            back_text += token.text
+            back_end = tokens.ends[index]
             index += 1
             continue
 
-    ast = Obj()
-    ast.type = 'AST_CARD'
-    ast.front_demarcator_token = front_demarcator_token
-    ast.front_text = front_text
-    ast.back_demarcator_token = back_demarcator_token
-    ast.back_text = back_text
+    ast = Card(tokens.buf, start, front_start, front_end, back_start, back_end)
     return (ast, index)
 
 
 def flatten_card(ast):
     """Flatten a card AST node into a string."""
-    string = ast.front_demarcator_token.text \
-        + ast.front_text \
-        + ast.back_demarcator_token.text \
-        + ast.back_text
-    return string
+    return ast.text
 
 
 def parse_deck(tokens, index=0):
     """Parse a deck AST node.
     Returns (AST node, next token index).
-    AST node is an object with keys: type, preamble, cards, last_token.
     Returns (None, original index) on failure."""
     failure = (None, index)
     preamble, index = parse_preamble(tokens, index)
     if preamble is None:
         return failure
 
+    types = tokens.types
     card_nodes = []
-    last_token = None
-    while index < len(tokens):
+    last_index = None
+    while index < len(types):
         card_node, index = parse_card(tokens, index)
         if card_node is None:
             return failure
         else:
             card_nodes.append(card_node)
-        
-        next_token = tokens[index]
-        if next_token.type == 'TOK_LAST':
-            last_token = next_token
+
+        if index >= len(types):
+            break
+        if types[index] == TOK_LAST:
+            last_index = index
             index += 1
             break
         else:
             continue
-    if last_token is None:
+    if last_index is None:
         return failure
 
-    ast = Obj()
-    ast.type = 'AST_DECK'
-    ast.preamble = preamble
-    ast.cards = card_nodes
-    ast.last_token = last_token
+    ast = Deck(
+        tokens.buf, preamble, card_nodes,
+        tokens.starts[last_index], tokens.ends[last_index]
+    )
     return (ast, index)
 
 
 def flatten_deck(ast):
     """Flatten a deck AST into a string."""
-    string = flatten_preamble(ast.preamble)
+    buf = io.BytesIO()
+    write_deck(ast, buf)
+    return buf.getvalue()
+
+
+def write_deck(ast, fd):
+    """Write a deck AST as markdown to the (binary) file object fd, in one
+    pass and without building the whole deck in memory."""
+    assert ast.type == 'AST_DECK'
+    w = fd.write
+    w(flatten_preamble(ast.preamble))
     for card in ast.cards:
-        string += flatten_card(card)
+        w(flatten_card(card))
         continue
-    string += ast.last_token.text
-    return string
+    w(ast.last_text)
+
+
+def write_cards(preamble_md, cards, fd):
+    """Write a deck as markdown to the (binary) file object fd, given its
+    preamble and an iterable of (front, back) pairs, e.g. straight from the
+    database."""
+    w = fd.write
+    w(preamble_md)
+    for (front, back) in cards:
+        w(front_demarcator)
+        w(front)
+        w(back_demarcator)
+        w(back)
+        continue
+    w(last_demarcator)
+
+
+def iter_deck(stream, chunk_size=65536):
+    """Parse a deck from a file-like object, reading chunk_size bytes at a time.
+    Yields the preamble AST node, then each card AST node as soon as the
+    delimiter which ends it has been read.  Each node only holds on to the
+    bytes read since the end of the previous node.
+    On failure, yields an error node (with keys: type, message) and stops."""
+    buf = b''
+    pos = 0
+    eof = False
+    state = 'AST_PREAMBLE'
+    in_code = False
+    front_start = front_end = back_start = None
+    while True:
+        match = delimiter_regex.search(buf, pos)
+        if match is None or \
+                (not eof and match.start() + max_delimiter_len > len(buf)):
+            if eof:
+                break
+            if match is None:
+                # no delimiter can start before this point.
+                pos = max(pos, len(buf) - max_delimiter_len + 1)
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                eof = True
+            else:
+                buf += chunk
+            continue
+
+        type_code = match.lastindex - 1
+        start = match.start()
+        pos = match.end()
+        if state == 'AST_PREAMBLE':
+            if type_code == TOK_CODE:
+                in_code = not in_code
+                continue
+            elif type_code == TOK_FRONT and not in_code:
+                yield Preamble(buf, 0, start)
+                state = 'AST_CARD'
+            else:
+                continue
+        elif state == 'AST_CARD':
+            if type_code == TOK_BACK and front_end is None:
+                front_end = start
+                back_start = pos
+                continue
+            elif type_code in (TOK_FRONT, TOK_LAST) and front_end is not None:
+                yield Card(buf, 0, front_start, front_end, back_start, start)
+                if type_code == TOK_LAST:
+                    return
+            else:
+                continue
+
+        # this is the start of a new card, so drop everything before it.
+        buf = buf[start:]
+        pos -= start
+        front_start = pos
+        front_end = back_start = None
+        continue
+
+    if state == 'AST_PREAMBLE':
+        if in_code:
+            yield Error("Unterminated code block in preamble")
+        else:
+            yield Error("Deck has no cards")
+    elif front_end is None:
+        yield Error("Card has no back (missing '%')")
+    else:
+        yield Error("Deck doesn't end with '---'")
+
+
+def scan_deck(text, card_start=None):
+    """Lazily parse the deck held in text, scanning only as far as the caller
+    consumes.
+    If card_start is None, yields the preamble AST node first.  Otherwise,
+    card_start must be the offset of a card's front demarcator, and scanning
+    begins with that card.
+    Yields each card AST node as soon as the delimiter which ends it has been
+    found.  On failure, yields an error node and stops."""
+    if card_start is None:
+        state = 'AST_PREAMBLE'
+        pos = 0
+    else:
+        state = 'AST_CARD'
+        match = delimiter_regex.match(text, card_start)
+        assert match is not None and match.lastindex - 1 == TOK_FRONT
+        pos = match.end()
+    in_code = False
+    start = card_start
+    front_start = pos
+    front_end = back_start = None
+    for match in delimiter_regex.finditer(text, pos):
+        type_code = match.lastindex - 1
+        if state == 'AST_PREAMBLE':
+            if type_code == TOK_CODE:
+                in_code = not in_code
+                continue
+            elif type_code == TOK_FRONT and not in_code:
+                yield Preamble(text, 0, match.start())
+                state = 'AST_CARD'
+            else:
+                continue
+        elif state == 'AST_CARD':
+            if type_code == TOK_BACK and front_end is None:
+                front_end = match.start()
+                back_start = match.end()
+                continue
+            elif type_code in (TOK_FRONT, TOK_LAST) and front_end is not None:
+                yield Card(
+                    text, start, front_start, front_end, back_start,
+                    match.start()
+                )
+                if type_code == TOK_LAST:
+                    return
+            else:
+                continue
+
+        start = match.start()
+        front_start = match.end()
+        front_end = back_start = None
+        continue
+
+    if state == 'AST_PREAMBLE':
+        if in_code:
+            yield Error("Unterminated code block in preamble")
+        else:
+            yield Error("Deck has no cards")
+    elif front_end is None:
+        yield Error("Card has no back (missing '%')")
+    else:
+        yield Error("Deck doesn't end with '---'")
+
+
+def common_prefix_len(a, b, block_size=65536):
+    """Return the length of the longest common prefix of two strings."""
+    n = min(len(a), len(b))
+    i = 0
+    while i < n:
+        j = min(i + block_size, n)
+        if a[i:j] != b[i:j]:
+            # a[:lo] == b[:lo], and the first difference is before hi.
+            (lo, hi) = (i, j)
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if a[lo:mid] == b[lo:mid]:
+                    lo = mid
+                else:
+                    hi = mid
+                continue
+            return lo
+        i = j
+        continue
+    return n
+
+
+def common_suffix_len(a, b, limit, block_size=65536):
+    """Return the length of the longest common suffix of two strings, up to
+    limit bytes."""
+    (len_a, len_b) = (len(a), len(b))
+    n = min(len_a, len_b, limit)
+    i = 0
+    while i < n:
+        j = min(i + block_size, n)
+        if a[len_a - j:len_a - i] != b[len_b - j:len_b - i]:
+            # the last lo bytes match, and the first difference is within the
+            # last hi bytes.
+            (lo, hi) = (i, j)
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if a[len_a - mid:len_a - lo] == b[len_b - mid:len_b - lo]:
+                    lo = mid
+                else:
+                    hi = mid
+                continue
+            return lo
+        i = j
+        continue
+    return n
+
+
+def diff_decks(old_text, new_text):
+    """Find the cards which changed between two versions of a deck, parsing
+    only the region between their common prefix and common suffix.
+    Returns (preamble, removed, added), where preamble is the preamble AST
+    node (which is unchanged) and removed and added are lists of the card AST
+    nodes in the changed region of the old and new versions.  A card which
+    only moved within that region appears in both lists.
+    Returns None if the preamble changed or either version fails to parse, in
+    which case the whole deck needs to be parsed."""
+    prefix_len = common_prefix_len(old_text, new_text)
+    suffix_len = common_suffix_len(
+        old_text, new_text, min(len(old_text), len(new_text)) - prefix_len
+    )
+    delta = len(new_text) - len(old_text)
+
+    # Find the last card whose front demarcator lies entirely within the
+    # common prefix.  Everything before it lexes and parses identically in
+    # both versions.
+    nodes = scan_deck(old_text)
+    preamble = next(nodes)
+    if preamble.type == 'ERROR':
+        return None
+    card_start = None
+    for card in nodes:
+        if card.type == 'ERROR':
+            return None
+        if card.start + max_delimiter_len > prefix_len:
+            break
+        card_start = card.start
+        continue
+    if card_start is None:
+        return None
+
+    # Parse both versions from there until a card starts at the same place in
+    # both of them within the common suffix, after which they are identical.
+    old_cards = scan_deck(old_text, card_start)
+    old_card = next(old_cards, None)
+    removed = []
+    added = []
+    for new_card in scan_deck(new_text, card_start):
+        if new_card.type == 'ERROR':
+            return None
+        if new_card.start >= len(new_text) - suffix_len:
+            old_start = new_card.start - delta
+            while old_card is not None:
+                if old_card.type == 'ERROR':
+                    return None
+                if old_card.start >= old_start:
+                    break
+                removed.append(old_card)
+                old_card = next(old_cards, None)
+                continue
+            if old_card is not None and old_card.start == old_start:
+                return (preamble, removed, added)
+        added.append(new_card)
+        continue
+    while old_card is not None:
+        if old_card.type == 'ERROR':
+            return None
+        removed.append(old_card)
+        old_card = next(old_cards, None)
+        continue
+    return (preamble, removed, added)
 
 
 def write_deck_to_disk(ast, outdir_path):
     """Write each card in the deck to disk as individual files."""
     assert ast.type == 'AST_DECK'
-    text = flatten_preamble(ast.preamble) + '\n'  # FIXME refactor out this cheat
-    outfile = "%s/preamble.md" % outdir_path
-    with open(outfile, "w+") as fd:
-        fd.write(text)
-    for i, card in enumerate(deck.cards):
-        front_text = card.front_text + '\n'  # FIXME refactor out this cheat
-        outfile = "%s/%d-front.md" % (outdir_path, i)
-        with open(outfile, "w+") as fd:
-            fd.write(front_text)
-        back_text = card.back_text + '\n'  # FIXME refactor out this cheat
-        outfile = "%s/%d-back.md" % (outdir_path, i)
-        with open(outfile, "w+") as fd:
-            fd.write(back_text)
+    cards = ((card.front_text, card.back_text) for card in ast.cards)
+    write_cards_to_disk(flatten_preamble(ast.preamble), cards, outdir_path)
+
+
+def write_cards_to_disk(preamble_md, cards, outdir_path):
+    """Explode a deck into a directory: preamble.md, then N-front.md and
+    N-back.md for each (front, back) pair in the iterable cards, each written
+    as it is read."""
+    write_file(outdir_path, 'preamble.md', preamble_md)
+    for (i, (front, back)) in enumerate(cards):
+        write_file(outdir_path, '%d-front.md' % i, front)
+        write_file(outdir_path, '%d-back.md' % i, back)
         continue
+
+
+def write_file(outdir_path, fname, contents):
+    """Write contents, and a trailing newline, to a file in a directory.
+    They are written separately (the file object buffers them), rather than
+    copying contents to append the newline."""
+    outfile = os.path.join(outdir_path, fname)
+    with open(outfile, 'wb') as fd:
+        fd.write(contents)
+        fd.write(b'\n')
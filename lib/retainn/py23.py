@@ -31,8 +31,71 @@ def is_int(x):
 
 def is_str(x):
     if sys.version_info[0] == 2:
-        # Python 2
-        return isinstance(x, str)
+        # Python 2 (sqlite3 returns TEXT columns as unicode)
+        return isinstance(x, basestring)
     else:
         # Python 3
         return isinstance(x, (str, bytes))
+
+
+def is_buffer(x):
+    """Return whether x is a memoryview (e.g. a zero-copy slice of a file)."""
+    return isinstance(x, memoryview)
+
+
+def to_bytes(x):
+    """Return x as bytes, encoding text as utf-8."""
+    if sys.version_info[0] == 2:
+        # Python 2
+        if isinstance(x, unicode):
+            return x.encode('utf-8')
+        if isinstance(x, memoryview):
+            return x.tobytes()
+        return bytes(x)
+    else:
+        # Python 3
+        if isinstance(x, str):
+            return x.encode('utf-8')
+        return bytes(x)
+
+
+def to_str(x):
+    """Return x (e.g. card text from the database) as a native str, decoding
+    bytes as utf-8 under Python 3."""
+    if sys.version_info[0] == 2:
+        # Python 2
+        return x
+    else:
+        # Python 3
+        if isinstance(x, bytes):
+            return x.decode('utf-8')
+        return x
+
+
+def to_unicode(x):
+    """Return x as unicode text, decoding bytes as utf-8."""
+    if isinstance(x, bytes):
+        return x.decode('utf-8')
+    return x
+
+
+def to_blob(b):
+    """Return bytes in the form which sqlite3 stores as a BLOB."""
+    if sys.version_info[0] == 2:
+        # Python 2 stores str as TEXT.
+        return buffer(b)
+    else:
+        # Python 3
+        return b
+
+
+def from_blob(x):
+    """Return a value read from sqlite3, with BLOBs as bytes."""
+    if sys.version_info[0] == 2:
+        # Python 2 returns BLOBs as buffers.
+        if isinstance(x, buffer):
+            return str(x)
+        return x
+    else:
+        # Python 3
+        return x
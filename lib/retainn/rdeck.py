@@ -0,0 +1,190 @@
+"""Retainn compiled deck ('.rdeck') functions.
+
+A compiled deck holds an already parsed and hashed deck, laid out so that it
+can be memory-mapped and imported without any markdown lexing:
+
+  header:  magic, card count, flags, deck hash, and the offset and length of
+           the title, the preamble and the card index.
+  data:    the preamble, the title, and the front and back of each card.
+  index:   for each card, the offset and length of its front and back, and
+           its card hash.
+
+All integers are little-endian."""
+
+import mmap
+import os
+import struct
+
+from . import db
+from . import parse
+
+
+magic = b'RDECK\x00\x00\x01'
+
+# magic, card count, flags, deck hash, title offset, title length,
+# preamble offset, preamble length, index offset.
+header_struct = struct.Struct('<8sII32sQQQQQ')
+
+# front offset, front length, back offset, back length, card hash.
+card_struct = struct.Struct('<QQQQ65s')
+
+# header flags.
+FLAG_HAS_TITLE = 0x1
+
+
+def compile_deck(markdown, fd):
+    """Parse and hash the deck markdown, and write it in compiled form to the
+    (binary, seekable) file object fd."""
+    tokens = parse.lex_deck(markdown)
+    (deck_ast, _) = parse.parse_deck(tokens)
+    assert deck_ast is not None, "Couldn't parse the deck markdown."
+    preamble_md = deck_ast.preamble.text
+    title = parse.extract_title(preamble_md)
+    deck_hash = db.md5(markdown).encode('ascii')
+
+    # leave room for the header, which is written last.
+    base = fd.tell()
+    fd.write(b'\x00' * header_struct.size)
+    offset = header_struct.size
+
+    preamble_offset = offset
+    fd.write(preamble_md)
+    offset += len(preamble_md)
+    flags = 0
+    title_offset = offset
+    title_len = 0
+    if title is not None:
+        flags |= FLAG_HAS_TITLE
+        fd.write(title)
+        title_len = len(title)
+        offset += title_len
+
+    index = []
+    for card_ast in deck_ast.cards:
+        front = card_ast.front_text
+        back = card_ast.back_text
+        fd.write(front)
+        fd.write(back)
+        card_hash = db.make_card_hash(front, back).encode('ascii')
+        entry = card_struct.pack(
+            offset, len(front), offset + len(front), len(back), card_hash
+        )
+        index.append(entry)
+        offset += len(front) + len(back)
+        continue
+
+    index_offset = offset
+    fd.write(b''.join(index))
+
+    header = header_struct.pack(
+        magic, len(index), flags, deck_hash, title_offset, title_len,
+        preamble_offset, len(preamble_md), index_offset
+    )
+    fd.seek(base)
+    fd.write(header)
+    fd.seek(0, 2)
+
+
+def compile_deck_file(md_path, rdeck_path):
+    """Compile the markdown deck at md_path into rdeck_path.
+    The deck is compiled into a temporary file which is then renamed, so that
+    a deck which fails to parse leaves any existing rdeck_path as it was."""
+    markdown = db.read_file_bytes(md_path)
+    tmp_path = rdeck_path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as fd:
+            compile_deck(markdown, fd)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.rename(tmp_path, rdeck_path)
+
+
+def is_rdeck_path(path):
+    """Return whether path names a compiled deck file."""
+    return path.endswith('.rdeck')
+
+
+class CompiledDeck(object):
+    """A memory-mapped compiled deck.
+    Card fronts and backs are returned as memoryview slices of the mapping,
+    which remain valid until close() is called."""
+    __slots__ = (
+        'mapping', 'buf', 'card_count', 'hash', 'title', 'preamble',
+        'index_offset'
+    )
+
+    def __init__(self, path):
+        with open(path, 'rb') as fd:
+            # check the file before mapping it: an empty file can't be mapped.
+            size = os.fstat(fd.fileno()).st_size
+            assert size >= header_struct.size, "Truncated compiled deck."
+            assert fd.read(len(magic)) == magic, \
+                "Not a compiled deck (bad magic)."
+            self.mapping = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.buf = memoryview(self.mapping)
+        except TypeError:
+            # Python 2's mmap doesn't support memoryview.
+            self.buf = self.mapping
+        try:
+            self.read_header()
+        except BaseException:
+            self.close()
+            raise
+
+    def read_header(self):
+        """Unpack and check the header."""
+        (
+            _, self.card_count, flags, deck_hash, title_offset, title_len,
+            preamble_offset, preamble_len, self.index_offset
+        ) = header_struct.unpack_from(self.mapping, 0)
+        index_end = self.index_offset + self.card_count * card_struct.size
+        assert index_end <= len(self.mapping), "Truncated compiled deck."
+        self.hash = deck_hash.decode('ascii')
+        self.preamble = self.read_bytes(preamble_offset, preamble_len)
+        if flags & FLAG_HAS_TITLE:
+            self.title = self.read_bytes(title_offset, title_len)
+        else:
+            self.title = None
+
+    def read_bytes(self, offset, length):
+        """Return length bytes of the mapping at offset, which must lie within
+        the file."""
+        assert offset + length <= len(self.mapping), \
+            "Truncated compiled deck."
+        return self.mapping[offset:offset + length]
+
+    def __len__(self):
+        return self.card_count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def card(self, i):
+        """Return card i as a (front, back, card hash) tuple."""
+        assert 0 <= i < self.card_count
+        offset = self.index_offset + i * card_struct.size
+        (front_offset, front_len, back_offset, back_len, card_hash) = \
+            card_struct.unpack_from(self.mapping, offset)
+        size = len(self.mapping)
+        assert front_offset + front_len <= size, "Truncated compiled deck."
+        assert back_offset + back_len <= size, "Truncated compiled deck."
+        front = self.buf[front_offset:front_offset + front_len]
+        back = self.buf[back_offset:back_offset + back_len]
+        return (front, back, card_hash.decode('ascii'))
+
+    def cards(self):
+        """Yield each card as a (front, back, card hash) tuple."""
+        for i in range(self.card_count):
+            yield self.card(i)
+            continue
+
+    def close(self):
+        """Unmap the file.  Any card slices must no longer be in use."""
+        if isinstance(self.buf, memoryview):
+            self.buf.release()
+        self.mapping.close()
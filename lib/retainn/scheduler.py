@@ -0,0 +1,121 @@
+"""Retainn review session scheduling."""
+
+import heapq
+import threading
+
+from . import db
+
+
+def schedule_key(card_id, score, last_seen):
+    """Return the heap key of a card.
+    This must order cards the same as select_next_card.sql: by score, then
+    last_seen (with "never seen" first), then card_id."""
+    if last_seen is None:
+        # timestamps are never negative.
+        last_seen = -1
+    return (score, last_seen, card_id)
+
+
+class Scheduler(object):
+    """The queue of cards to review in a session.
+    The schedule of every card not yet seen in the session is loaded into a
+    heap when the session starts.  next_card() then takes O(log n) rather than
+    sorting the card table, and grading a card writes through to the database
+    (or to journal, a journal.GradeJournal, if given) and removes it from the
+    queue.  Cards added since (e.g. by importing or updating a deck) have
+    greater card_ids, and are loaded by next_card() once it sees that
+    max(card_id) has changed.  Deleted cards are skipped as they reach the
+    front of the queue.
+    A scheduler may be shared by several threads, each passing its own
+    connection.  Its lock is only held while the heap is used, not while the
+    database is."""
+    __slots__ = (
+        'session_start', 'heap', 'graded', 'max_card_id', 'journal', 'lock'
+    )
+
+    def __init__(self, db_conn, sql_templates, session_start, journal=None):
+        self.session_start = session_start
+        self.journal = journal
+        self.heap = []
+        # cards graded while not at the top of the heap, which are discarded
+        # when they reach it.
+        self.graded = set()
+        # the max(card_id) as of the last load.
+        self.max_card_id = 0
+        self.lock = threading.Lock()
+        self.load_new_cards(db_conn, sql_templates)
+
+    def load_new_cards(self, db_conn, sql_templates):
+        """Add the cards after self.max_card_id to the queue."""
+        with self.lock:
+            after_card_id = self.max_card_id
+        with db.transaction(db_conn):
+            # in one transaction, so that max_card_id covers exactly the rows.
+            max_card_id = db.select_max_card_id(db_conn, sql_templates)
+            rows = db.select_card_schedule(
+                db_conn, sql_templates, self.session_start, after_card_id
+            )
+        with self.lock:
+            if self.max_card_id != after_card_id:
+                # another thread loaded them first.
+                return
+            self.heap.extend([schedule_key(*row) for row in rows])
+            heapq.heapify(self.heap)
+            self.max_card_id = max_card_id
+
+    def next_card(self, db_conn, sql_templates):
+        """Return the best next card to show the user (as per
+        db.find_card_front, so without its back), or None if the session is
+        done.
+        The card stays at the front of the queue until it is graded."""
+        max_card_id = db.select_max_card_id(db_conn, sql_templates)
+        if max_card_id != self.max_card_id:
+            self.load_new_cards(db_conn, sql_templates)
+        while True:
+            with self.lock:
+                card_id = self.front_card_id()
+            if card_id is None:
+                return None
+            card = db.find_card_front(db_conn, sql_templates, card_id)
+            if card is not None and \
+                    (card.last_seen or 0) < self.session_start:
+                return card
+            # the card was deleted, or seen elsewhere (e.g. in another
+            # browser tab) since the session started.
+            with self.lock:
+                self.remove(card_id)
+            continue
+
+    def front_card_id(self):
+        """Return the card_id at the front of the queue, or None if it is
+        empty, first dropping any cards which have already been graded.
+        The caller must hold self.lock."""
+        while len(self.heap) > 0:
+            card_id = self.heap[0][2]
+            if card_id in self.graded:
+                heapq.heappop(self.heap)
+                self.graded.discard(card_id)
+                continue
+            return card_id
+        return None
+
+    def remove(self, card_id):
+        """Remove a card from the queue.
+        The caller must hold self.lock."""
+        if len(self.heap) > 0 and self.heap[0][2] == card_id:
+            heapq.heappop(self.heap)
+        else:
+            self.graded.add(card_id)
+
+    def grade(self, db_conn, sql_templates, card_id, grade):
+        """Grade a card ('recall', 'not_recall' or 'skip'), writing the new
+        score through to the database or the journal, and remove it from the
+        queue.
+        Returns the card's new score."""
+        if self.journal is None:
+            score = db.grade_card(db_conn, sql_templates, card_id, grade)
+        else:
+            score = self.journal.grade(db_conn, sql_templates, card_id, grade)
+        with self.lock:
+            self.remove(card_id)
+        return score
@@ -0,0 +1,2 @@
+-- Empty temp_card_hash.
+DELETE FROM temp_card_hash;
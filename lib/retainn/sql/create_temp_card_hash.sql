@@ -0,0 +1,4 @@
+-- A per-connection scratch table of card hashes, for set-based statements.
+CREATE TEMP TABLE IF NOT EXISTS temp_card_hash (
+    hash TEXT PRIMARY KEY
+);
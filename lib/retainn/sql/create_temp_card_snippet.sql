@@ -0,0 +1,8 @@
+-- A per-connection scratch index of the text of search results, which
+-- snippets are taken from (card_fts has no text of its own).  Its tokenizer
+-- must match card_fts's.
+CREATE VIRTUAL TABLE IF NOT EXISTS temp.temp_card_snippet USING fts5(
+    front,
+    back,
+    tokenize='porter unicode61'
+);
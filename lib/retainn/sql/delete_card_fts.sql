@@ -0,0 +1,3 @@
+-- Unindex some compressed content, given the text it was indexed with.
+INSERT INTO card_fts (card_fts, rowid, front, back)
+VALUES ('delete', :content_id, :front_text, :back_text);
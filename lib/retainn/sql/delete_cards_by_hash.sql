@@ -1,3 +1,4 @@
--- Delete cards from a deck by hash.
+-- Delete the cards from a deck whose hashes are in temp_card_hash.
 DELETE FROM card
-WHERE deck_id = ? AND hash in (?...?)
+WHERE deck_id = :deck_id
+AND hash IN (SELECT hash FROM temp_card_hash);
@@ -0,0 +1,15 @@
+-- Grade a card, moving its score and setting last_seen in one statement.
+--   'recall': a negative (or zero) score becomes 1, otherwise it goes up by 1.
+--   'not_recall': a score above 1 drops to -1, otherwise it goes down by 1.
+--   'skip': the score is unchanged.
+UPDATE card
+SET
+    score = CASE :grade
+        WHEN 'recall' THEN
+            CASE WHEN score < 1 THEN 1 ELSE score + 1 END
+        WHEN 'not_recall' THEN
+            CASE WHEN score > 1 THEN -1 ELSE score - 1 END
+        ELSE score
+    END,
+    last_seen = :last_seen
+WHERE card_id = :card_id
@@ -1,5 +1,5 @@
--- Insert a card.
+-- Insert a card.  Its content must already be in card_content.
 INSERT INTO card
-(score, last_seen, front, back, hash, deck_id)
+(score, last_seen, hash, deck_id)
 VALUES
-(:score, :last_seen, :front, :back, :hash, :deck_id);
+(:score, :last_seen, :hash, :deck_id);
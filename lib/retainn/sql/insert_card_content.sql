@@ -0,0 +1,5 @@
+-- Insert the content of a card, unless identical content is already stored.
+INSERT OR IGNORE INTO card_content
+(hash, front, back)
+VALUES
+(:hash, :front, :back);
@@ -0,0 +1,7 @@
+-- Index the text of the compressed content with the given hash (which the
+-- card_content_insert_fts trigger can't read), unless already indexed.
+INSERT INTO card_fts (rowid, front, back)
+SELECT cc.content_id, :front_text, :back_text
+FROM card_content cc
+WHERE cc.hash = :hash
+AND NOT EXISTS (SELECT 1 FROM card_fts f WHERE f.rowid = cc.content_id);
@@ -0,0 +1,7 @@
+-- Append a review to the review log, with the score which grade_card.sql
+-- has just given the card.  Logs nothing if the card has been deleted.
+INSERT INTO review_log
+(card_id, grade, score, reviewed_at)
+SELECT card_id, :grade, score, :reviewed_at
+FROM card
+WHERE card_id = :card_id;
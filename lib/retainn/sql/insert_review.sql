@@ -0,0 +1,5 @@
+-- Append a review to the review log.
+INSERT INTO review_log
+(card_id, grade, score, reviewed_at)
+VALUES
+(:card_id, :grade, :score, :reviewed_at);
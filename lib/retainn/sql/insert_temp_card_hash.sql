@@ -0,0 +1,2 @@
+-- Add a card hash to temp_card_hash.
+INSERT OR IGNORE INTO temp_card_hash (hash) VALUES (?);
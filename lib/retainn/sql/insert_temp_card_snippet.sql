@@ -0,0 +1,3 @@
+-- Add the text of a search result to temp_card_snippet.
+INSERT INTO temp_card_snippet (rowid, front, back)
+VALUES (:rowid, :front_text, :back_text);
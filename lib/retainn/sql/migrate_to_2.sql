@@ -0,0 +1,18 @@
+-- Migrate the schema from version 1 to 2: record each deck's markdown.
+BEGIN;
+
+-- The markdown of each deck, as of its last import or update, which later
+-- updates are diffed against.
+CREATE TABLE IF NOT EXISTS deck_markdown (
+    deck_id INTEGER PRIMARY KEY,
+    markdown TEXT NOT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS deck_delete_markdown AFTER DELETE ON deck
+BEGIN
+    DELETE FROM deck_markdown WHERE deck_id = old.deck_id;
+END;
+
+UPDATE retainn_schema SET schema_version = '2';
+
+COMMIT;
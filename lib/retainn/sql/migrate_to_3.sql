@@ -0,0 +1,13 @@
+-- Migrate the schema from version 2 to 3: index the card table.
+BEGIN;
+
+-- Finding (or deleting) the cards of a deck, and diffing them by hash.
+CREATE INDEX IF NOT EXISTS card_deck_id_hash ON card (deck_id, hash);
+
+-- Selecting the next card in (score, last_seen, card_id) order.
+CREATE INDEX IF NOT EXISTS card_score_last_seen
+    ON card (score, last_seen, card_id);
+
+UPDATE retainn_schema SET schema_version = '3';
+
+COMMIT;
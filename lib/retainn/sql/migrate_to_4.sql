@@ -0,0 +1,46 @@
+-- Migrate the schema from version 3 to 4: move the front and back of cards
+-- out of the card table and into card_content.
+BEGIN;
+
+CREATE TABLE card_content (
+    hash TEXT PRIMARY KEY,
+    front TEXT NOT NULL,
+    back TEXT NOT NULL
+);
+
+INSERT OR IGNORE INTO card_content (hash, front, back)
+SELECT hash, front, back FROM card ORDER BY card_id;
+
+CREATE TABLE card_narrow (
+    card_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    score INTEGER NOT NULL,
+    last_seen INTEGER,  -- NULL indicates "never seen"
+    hash TEXT NOT NULL,  -- the card_content of this card.
+    deck_id INTEGER NOT NULL
+);
+
+INSERT INTO card_narrow (card_id, score, last_seen, hash, deck_id)
+SELECT card_id, score, last_seen, hash, deck_id FROM card;
+
+-- don't reuse the card_ids of previously deleted cards.
+UPDATE sqlite_sequence
+SET seq = (SELECT seq FROM sqlite_sequence WHERE name = 'card')
+WHERE name = 'card_narrow'
+AND EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'card');
+
+DROP TABLE card;
+ALTER TABLE card_narrow RENAME TO card;
+
+CREATE INDEX card_deck_id_hash ON card (deck_id, hash);
+CREATE INDEX card_score_last_seen ON card (score, last_seen, card_id);
+CREATE INDEX card_hash ON card (hash);
+
+CREATE TRIGGER card_delete_content AFTER DELETE ON card
+WHEN NOT EXISTS (SELECT 1 FROM card WHERE hash = old.hash)
+BEGIN
+    DELETE FROM card_content WHERE hash = old.hash;
+END;
+
+UPDATE retainn_schema SET schema_version = '4';
+
+COMMIT;
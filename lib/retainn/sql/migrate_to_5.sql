@@ -0,0 +1,11 @@
+-- Migrate the schema from version 4 to 5: add database-wide settings.
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS retainn_setting (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+UPDATE retainn_schema SET schema_version = '5';
+
+COMMIT;
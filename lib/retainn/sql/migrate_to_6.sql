@@ -0,0 +1,16 @@
+-- Migrate the schema from version 5 to 6: add the review log.
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS review_log (
+    review_id INTEGER PRIMARY KEY,
+    card_id INTEGER NOT NULL,
+    grade TEXT NOT NULL,
+    score INTEGER NOT NULL,
+    reviewed_at INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS review_log_card_id ON review_log (card_id);
+
+UPDATE retainn_schema SET schema_version = '6';
+
+COMMIT;
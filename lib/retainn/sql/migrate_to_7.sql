@@ -0,0 +1,57 @@
+-- Migrate the schema from version 6 to 7: give card_content a content_id, add
+-- the full-text index of card_content, and index the existing content.
+BEGIN;
+
+DROP TRIGGER IF EXISTS card_delete_content;
+
+CREATE TABLE card_content_new (
+    content_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    hash TEXT NOT NULL UNIQUE,
+    front TEXT NOT NULL,
+    back TEXT NOT NULL
+);
+
+INSERT INTO card_content_new (hash, front, back)
+SELECT hash, front, back FROM card_content ORDER BY rowid;
+
+DROP TABLE card_content;
+
+ALTER TABLE card_content_new RENAME TO card_content;
+
+CREATE TRIGGER card_delete_content AFTER DELETE ON card
+WHEN NOT EXISTS (SELECT 1 FROM card WHERE hash = old.hash)
+BEGIN
+    DELETE FROM card_content WHERE hash = old.hash;
+END;
+
+CREATE VIRTUAL TABLE card_fts USING fts5(
+    front,
+    back,
+    content='',
+    tokenize='porter unicode61'
+);
+
+CREATE TRIGGER card_content_insert_fts AFTER INSERT ON card_content
+WHEN substr(new.front, 1, 4) != X'00525A31'
+AND substr(new.back, 1, 4) != X'00525A31'
+BEGIN
+    INSERT INTO card_fts (rowid, front, back)
+    VALUES (new.content_id, new.front, new.back);
+END;
+
+CREATE TRIGGER card_content_delete_fts AFTER DELETE ON card_content
+WHEN substr(old.front, 1, 4) != X'00525A31'
+AND substr(old.back, 1, 4) != X'00525A31'
+BEGIN
+    INSERT INTO card_fts (card_fts, rowid, front, back)
+    VALUES ('delete', old.content_id, old.front, old.back);
+END;
+
+-- retainn_decompress is registered by db.migrate_db.
+INSERT INTO card_fts (rowid, front, back)
+SELECT content_id, retainn_decompress(front), retainn_decompress(back)
+FROM card_content;
+
+UPDATE retainn_schema SET schema_version = '7';
+
+COMMIT;
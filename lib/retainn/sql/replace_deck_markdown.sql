@@ -0,0 +1,5 @@
+-- Insert or replace the markdown of a deck.
+INSERT OR REPLACE INTO deck_markdown
+(deck_id, markdown)
+VALUES
+(:deck_id, :markdown);
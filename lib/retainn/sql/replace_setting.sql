@@ -0,0 +1,5 @@
+-- Set a setting, replacing any previous value.
+INSERT OR REPLACE INTO retainn_setting
+(name, value)
+VALUES
+(:name, :value);
@@ -4,19 +4,84 @@
 CREATE TABLE retainn_schema (
     schema_version TEXT NOT NULL
 );
-INSERT INTO retainn_schema (schema_version) VALUES ('1');
+INSERT INTO retainn_schema (schema_version) VALUES ('7');
 
--- A card is all of the data associated with an individual flashcard.
+-- Database-wide settings, e.g. 'compress_cards'.
+CREATE TABLE retainn_setting (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+-- A card is the scheduling state of an individual flashcard.  Its content
+-- lives in card_content, so that scheduling queries only touch this narrow
+-- table.
 CREATE TABLE card (
     card_id INTEGER PRIMARY KEY AUTOINCREMENT,
     score INTEGER NOT NULL,
     last_seen INTEGER,  -- NULL indicates "never seen"
-    front TEXT NOT NULL,
-    back TEXT NOT NULL,
-    hash TEXT NOT NULL,
+    hash TEXT NOT NULL,  -- the card_content of this card.
     deck_id INTEGER NOT NULL
 );
 
+-- Finding (or deleting) the cards of a deck, and diffing them by hash.
+CREATE INDEX card_deck_id_hash ON card (deck_id, hash);
+
+-- Selecting the next card in (score, last_seen, card_id) order.
+CREATE INDEX card_score_last_seen ON card (score, last_seen, card_id);
+
+-- Finding the cards which use a card_content.
+CREATE INDEX card_hash ON card (hash);
+
+-- The front and back of cards, keyed by card hash, so that identical cards
+-- (e.g. in several decks) are stored once.  With the 'compress_cards' setting,
+-- large bodies are stored as zlib-compressed blobs (see db.compress_body).
+-- content_id keys the full-text index; it is never reused, so that a stale
+-- index entry can't match other content.
+CREATE TABLE card_content (
+    content_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    hash TEXT NOT NULL UNIQUE,
+    front TEXT NOT NULL,
+    back TEXT NOT NULL
+);
+
+-- Garbage-collect content which no card uses any more.
+CREATE TRIGGER card_delete_content AFTER DELETE ON card
+WHEN NOT EXISTS (SELECT 1 FROM card WHERE hash = old.hash)
+BEGIN
+    DELETE FROM card_content WHERE hash = old.hash;
+END;
+
+-- The full-text index of card_content, by content_id.  It is contentless, so
+-- the text is stored once (in card_content, compressed or not); snippets are
+-- made by db.search_cards from the bodies.
+CREATE VIRTUAL TABLE card_fts USING fts5(
+    front,
+    back,
+    content='',
+    tokenize='porter unicode61'
+);
+
+-- Uncompressed content is (un)indexed by these triggers, whoever writes it.
+-- Compressed content (whose bodies start with db.compressed_marker) can only
+-- be read by retainn, and is (un)indexed by db.insert_cards_bulk and the
+-- db.delete_cards_* functions.  Content never changes its text (compressing it
+-- doesn't), so updates need nothing.
+CREATE TRIGGER card_content_insert_fts AFTER INSERT ON card_content
+WHEN substr(new.front, 1, 4) != X'00525A31'
+AND substr(new.back, 1, 4) != X'00525A31'
+BEGIN
+    INSERT INTO card_fts (rowid, front, back)
+    VALUES (new.content_id, new.front, new.back);
+END;
+
+CREATE TRIGGER card_content_delete_fts AFTER DELETE ON card_content
+WHEN substr(old.front, 1, 4) != X'00525A31'
+AND substr(old.back, 1, 4) != X'00525A31'
+BEGIN
+    INSERT INTO card_fts (card_fts, rowid, front, back)
+    VALUES ('delete', old.content_id, old.front, old.back);
+END;
+
 -- A deck is a group of flashcards.
 CREATE TABLE deck (
     deck_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -27,3 +92,27 @@ CREATE TABLE deck (
     title TEXT,  -- NULL indicates no title given in markdown.
     preamble TEXT  -- NULL indicates no preamble given in markdown.
 );
+
+-- The markdown of each deck, as of its last import or update, which later
+-- updates are diffed against.
+CREATE TABLE deck_markdown (
+    deck_id INTEGER PRIMARY KEY,
+    markdown TEXT NOT NULL
+);
+
+CREATE TRIGGER deck_delete_markdown AFTER DELETE ON deck
+BEGIN
+    DELETE FROM deck_markdown WHERE deck_id = old.deck_id;
+END;
+
+-- The history of every review, appended to as cards are graded.  Rows outlive
+-- their card, so that the history survives deck updates.
+CREATE TABLE review_log (
+    review_id INTEGER PRIMARY KEY,
+    card_id INTEGER NOT NULL,
+    grade TEXT NOT NULL,  -- 'recall', 'not_recall' or 'skip'.
+    score INTEGER NOT NULL,  -- the card's score after the review.
+    reviewed_at INTEGER NOT NULL
+);
+
+CREATE INDEX review_log_card_id ON review_log (card_id);
@@ -0,0 +1,15 @@
+-- Search the fronts and backs of the card content, best matches first, with
+-- the cards which use it.
+SELECT c.card_id, c.deck_id, d.title, cc.front, cc.back
+FROM (
+    SELECT rowid AS content_id, rank
+    FROM card_fts
+    WHERE card_fts MATCH :query
+    ORDER BY rank
+    LIMIT :limit
+) f
+JOIN card_content cc ON cc.content_id = f.content_id
+JOIN card c ON c.hash = cc.hash
+JOIN deck d ON d.deck_id = c.deck_id
+ORDER BY f.rank, c.card_id
+LIMIT :limit;
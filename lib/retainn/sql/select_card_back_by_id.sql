@@ -0,0 +1,6 @@
+-- Select the back of a card by its card_id.
+SELECT cc.back
+FROM card c
+JOIN card_content cc USING (hash)
+WHERE c.card_id = :card_id
+LIMIT 1;
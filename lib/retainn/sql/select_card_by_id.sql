@@ -1,6 +1,7 @@
--- Select the best next card to show the user.
-SELECT c.card_id, c.score, c.front, c.back, d.deck_id, d.title
+-- Select a card (and the title of its deck) by its card_id.
+SELECT c.card_id, c.score, cc.front, cc.back, d.deck_id, d.title, c.last_seen
 FROM card c
 JOIN deck d USING (deck_id)
+JOIN card_content cc USING (hash)
 WHERE c.card_id = :card_id
 LIMIT 1;
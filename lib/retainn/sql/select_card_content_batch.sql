@@ -0,0 +1,6 @@
+-- Select a batch of card content, in rowid order, after the given rowid.
+SELECT cc.rowid, cc.hash, cc.front, cc.back
+FROM card_content cc
+WHERE cc.rowid > :after_rowid
+ORDER BY cc.rowid
+LIMIT :limit;
@@ -0,0 +1,7 @@
+-- Select a card (and the title of its deck) by its card_id, without its back.
+SELECT c.card_id, c.score, cc.front, d.deck_id, d.title, c.last_seen
+FROM card c
+JOIN deck d USING (deck_id)
+JOIN card_content cc USING (hash)
+WHERE c.card_id = :card_id
+LIMIT 1;
@@ -0,0 +1,7 @@
+-- Select the scheduling fields of every card after :after_card_id which hasn't
+-- been seen since the session started (see select_next_card.sql).
+SELECT c.card_id, c.score, c.last_seen
+FROM card c
+JOIN deck d USING (deck_id)
+WHERE c.card_id > :after_card_id
+AND ifnull(c.last_seen, 0) < :session_start;
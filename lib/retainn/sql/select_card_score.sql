@@ -0,0 +1,4 @@
+-- Select the score of a card.
+SELECT c.score
+FROM card c
+WHERE c.card_id = :card_id
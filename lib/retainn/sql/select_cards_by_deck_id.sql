@@ -0,0 +1,7 @@
+-- Select the front and back of each card of a deck, in the order they were
+-- inserted (which is deck order, apart from cards added by later updates).
+SELECT cc.front, cc.back
+FROM card c
+JOIN card_content cc USING (hash)
+WHERE c.deck_id = :deck_id
+ORDER BY c.card_id;
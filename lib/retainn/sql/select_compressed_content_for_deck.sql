@@ -0,0 +1,12 @@
+-- Select the compressed content which only the cards of a deck use, i.e. that
+-- deleting them would garbage-collect.
+SELECT cc.content_id, cc.front, cc.back
+FROM card_content cc
+WHERE cc.hash IN (SELECT hash FROM card WHERE deck_id = :deck_id)
+AND (
+    substr(cc.front, 1, 4) = X'00525A31'
+    OR substr(cc.back, 1, 4) = X'00525A31'
+)
+AND NOT EXISTS (
+    SELECT 1 FROM card c WHERE c.hash = cc.hash AND c.deck_id != :deck_id
+);
@@ -0,0 +1,6 @@
+-- Select a flashcard deck by its gist URL (or file path).
+SELECT
+    d.deck_id, d.gist_url, d.last_fetched, d.etag, d.hash, d.title, d.preamble
+FROM deck d
+WHERE d.gist_url = :gist_url
+LIMIT 1;
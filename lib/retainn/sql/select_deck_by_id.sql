@@ -0,0 +1,6 @@
+-- Select a flashcard deck by its deck_id.
+SELECT
+    d.deck_id, d.gist_url, d.last_fetched, d.etag, d.hash, d.title, d.preamble
+FROM deck d
+WHERE d.deck_id = :deck_id
+LIMIT 1;
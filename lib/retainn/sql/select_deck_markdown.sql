@@ -0,0 +1,5 @@
+-- Select the markdown of a deck as of its last import or update.
+SELECT m.markdown
+FROM deck_markdown m
+WHERE m.deck_id = :deck_id
+LIMIT 1;
@@ -0,0 +1,2 @@
+-- Select the greatest card_id, which grows as cards are added.
+SELECT ifnull(max(card_id), 0) FROM card;
@@ -1,7 +1,14 @@
--- Select the best next card to show the user.
-SELECT c.card_id, c.score, c.front, c.back, d.deck_id, d.title
+-- Select the best next card to show the user (without its back, which is
+-- only fetched when revealed).
+-- The WHERE clause is written so that sqlite walks the card_score_last_seen
+-- index in ORDER BY order and stops at the first card not seen this session,
+-- rather than sorting the whole card table.  (A NULL last_seen means
+-- "never seen", which always qualifies.)  Only the chosen card's content is
+-- read.
+SELECT c.card_id, c.score, cc.front, d.deck_id, d.title, c.last_seen
 FROM card c
 JOIN deck d USING (deck_id)
-WHERE last_seen < :session_start OR last_seen IS NULL
-ORDER BY score ASC, last_seen ASC, card_id ASC
+JOIN card_content cc USING (hash)
+WHERE ifnull(c.last_seen, 0) < :session_start
+ORDER BY c.score ASC, c.last_seen ASC, c.card_id ASC
 LIMIT 1;
@@ -0,0 +1,5 @@
+-- Select the review history of a card, oldest first.
+SELECT r.grade, r.score, r.reviewed_at
+FROM review_log r
+WHERE r.card_id = :card_id
+ORDER BY r.review_id;
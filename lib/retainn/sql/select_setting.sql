@@ -0,0 +1,5 @@
+-- Select the value of a setting.
+SELECT s.value
+FROM retainn_setting s
+WHERE s.name = :name
+LIMIT 1;
@@ -0,0 +1,6 @@
+-- Select a snippet of the best matching side of each search result.
+SELECT
+    rowid,
+    snippet(temp_card_snippet, -1, :mark_start, :mark_end, '...', 16)
+FROM temp_card_snippet
+WHERE temp_card_snippet MATCH :query;
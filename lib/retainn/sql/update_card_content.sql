@@ -0,0 +1,5 @@
+-- Replace the stored front and back of some card content (e.g. with their
+-- compressed form).
+UPDATE card_content
+SET front = :front, back = :back
+WHERE hash = :hash
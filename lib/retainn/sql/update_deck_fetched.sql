@@ -0,0 +1,7 @@
+-- Record that a deck was fetched again, unchanged.
+UPDATE deck
+SET
+    last_fetched = :last_fetched,
+    etag = :etag
+WHERE
+    deck_id = :deck_id
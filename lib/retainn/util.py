@@ -1,79 +1,525 @@
 """Retainn utility functions."""
 
+import mmap
+import multiprocessing
+import os
+import shutil
+import tempfile
+
 from . import curl
 from . import parse
 from . import db
+from . import py23
+from . import rdeck
+
+
+# Thanks to https://stackoverflow.com/q/4984647
+class Obj(dict):
+    def __getattr__(self, attr):
+        # raise AttributeError (not KeyError), so that pickle can probe for
+        # methods like __setstate__ when an Obj is sent between processes.
+        try:
+            return self[attr]
+        except KeyError:
+            raise AttributeError(attr)
+    def __setattr__(self, attr, value):
+        self[attr] = value
 
 
 def import_deck_url(db_conn, sql_templates, gist_url):
     """Download a deck and insert it into the database.
     Returns the deck_id of the newly inserted deck."""
-    (markdown, etag) = curl.http_get_deck_and_etag(gist_url)
-    return import_deck_md(db_conn, sql_templates, gist_url, etag, markdown)
+    (response, etag) = curl.http_open_deck(gist_url)
+    try:
+        deck_id = import_deck_stream(
+            db_conn, sql_templates, gist_url, etag, response
+        )
+    finally:
+        response.close()
+    return deck_id
 
 
 def import_deck_md(db_conn, sql_templates, gist_url, etag, markdown):
-    """Insert the deck into the database.
+    """Insert the deck into the database (see import_deck_buffer).
+    Returns the deck_id of the newly inserted deck."""
+    return import_deck_buffer(
+        db_conn, sql_templates, gist_url, etag, markdown
+    )
+
+
+def insert_deck_cards(
+    db_conn, sql_templates, gist_url, etag, hash, title, preamble_md, cards,
+    markdown=None
+):
+    """Insert a parsed deck and its cards into the database, replacing any
+    existing deck with the same gist URL.
+    cards is an iterable of (front, back, card hash) tuples, of which only the
+    first of any duplicates is inserted (see unique_cards).  If markdown is
+    given, it is recorded so that later updates can be diffed against it.
     Returns the deck_id of the newly inserted deck."""
     last_fetched = db.make_tstamp()
-    hash = db.md5(markdown)
-    tokens = parse.lex_deck(markdown)
-    (deck_ast, _) = parse.parse_deck(tokens)
-    assert deck_ast is not None
-    preamble_md = deck_ast.preamble.text
+    with db.transaction(db_conn):
+        db.delete_deck(db_conn, sql_templates, gist_url)
+        deck_id = db.insert_deck(
+            db_conn, sql_templates, gist_url, last_fetched, etag, hash, title,
+            preamble_md
+        )
+        assert deck_id is not None
+        # FIXME should we alert or prompt the user about this?
+        db.delete_cards_for_deck(db_conn, sql_templates, deck_id)
+        db.insert_cards_bulk(
+            db_conn, sql_templates, deck_id, unique_cards(cards)
+        )
+        if markdown is not None:
+            db.replace_deck_markdown(db_conn, sql_templates, deck_id, markdown)
+    return deck_id
+
+
+def unique_cards(cards):
+    """Yield the first of each distinct card (by card hash) from an iterable
+    of (front, back, card hash) tuples, computing any hashes which are None.
+    A deck holds one card per distinct front and back, both when imported and
+    when updated (see diff_cards), so that a card repeated in the markdown
+    is reviewed, and removed, as one."""
+    seen = set()
+    for (front, back, card_hash) in cards:
+        if card_hash is None:
+            card_hash = db.make_card_hash(front, back)
+        if card_hash not in seen:
+            seen.add(card_hash)
+            yield (front, back, card_hash)
+        continue
+
+
+def scan_deck_cards(markdown):
+    """Parse the deck markdown lazily (see parse.scan_deck), reading only its
+    preamble up front.
+    Returns (title, preamble markdown, cards), where cards is a generator of
+    (front, back, None) tuples which asserts if the rest of the deck fails to
+    parse."""
+    nodes = parse.scan_deck(markdown)
+    preamble = next(nodes)
+    assert preamble.type != 'ERROR', \
+        "Couldn't parse the deck markdown: %s" % preamble.message
+    # a copy, so that the deck row doesn't hold a slice of a mapped buffer.
+    preamble_md = py23.to_bytes(preamble.text)
     title = parse.extract_title(preamble_md)
-    db.delete_deck(db_conn, sql_templates, gist_url)
-    deck_id = db.insert_deck(
-        db_conn, sql_templates, gist_url, last_fetched, etag, hash, title,
-        preamble_md
-    )
-    assert deck_id is not None
-    # FIXME should we alert or prompt the user about this?
-    db.delete_cards_for_deck(db_conn, sql_templates, deck_id)
-    for card_ast in deck_ast.cards:
-        front = card_ast.front_text
-        back = card_ast.back_text
-        card_id = db.insert_card(db_conn, sql_templates, front, back, deck_id)
-        assert card_id is not None
+    return (title, preamble_md, iter_card_nodes(nodes))
+
+
+def iter_card_nodes(nodes):
+    """Yield a (front, back, None) tuple for each card node from
+    parse.scan_deck, asserting if the deck failed to parse."""
+    for card_ast in nodes:
+        assert card_ast.type != 'ERROR', \
+            "Couldn't parse the deck markdown: %s" % card_ast.message
+        yield (card_ast.front_text, card_ast.back_text, None)
         continue
+
+
+def is_url(source):
+    """Return whether a deck source is a URL (rather than a file path)."""
+    return '://' in source
+
+
+def deck_sources(args):
+    """Expand the 'import' command's arguments into a list of deck sources.
+    Each argument is a gist URL, a deck file, or a directory of '.md' (or
+    compiled '.rdeck') deck files."""
+    sources = []
+    for arg in args:
+        if not is_url(arg) and os.path.isdir(arg):
+            for fname in sorted(os.listdir(arg)):
+                path = os.path.join(arg, fname)
+                is_deck = fname.endswith('.md') or rdeck.is_rdeck_path(fname)
+                if is_deck and os.path.isfile(path):
+                    sources.append(path)
+                continue
+        else:
+            sources.append(arg)
+        continue
+    return sources
+
+
+def source_gist_url(source):
+    """Return the gist URL under which the deck at source (a gist URL or a
+    file path) is stored."""
+    if is_url(source):
+        return source
+    return os.path.abspath(source)
+
+
+def parse_deck_source(task):
+    """Fetch (if needed), parse and hash the deck at source (a gist URL or a
+    file path), given task, a (source, hash) pair where hash is that of the
+    deck already imported from source, if any.  This runs in the worker
+    processes of import_decks, so it doesn't touch the database.
+    Returns an object with keys: source, gist_url, etag, hash, title,
+    preamble, cards (a list of (front, back, card hash) tuples, or None if
+    the deck is unchanged, in which case it isn't parsed), markdown (None for
+    files) and error (None on success)."""
+    (source, old_hash) = task
+    result = Obj()
+    result.source = source
+    result.gist_url = source_gist_url(source)
+    result.cards = None
+    result.error = None
+    try:
+        if is_url(source):
+            (markdown, result.etag) = curl.http_get_deck_and_etag(source)
+            result.markdown = markdown
+        else:
+            result.etag = None
+            markdown = db.read_file_bytes(source)
+            result.markdown = None
+        result.hash = db.md5(markdown)
+        if result.hash == old_hash:
+            return result
+        (result.title, result.preamble, cards) = scan_deck_cards(markdown)
+        # the cards are sent back to this process, so they are gathered (and
+        # hashed) here.
+        result.cards = list(unique_cards(cards))
+    except Exception as e:
+        result.error = "%s: %s" % (type(e).__name__, e)
+    return result
+
+
+def import_decks(db_conn, sql_templates, sources, processes=None):
+    """Import many decks at once.  Fetching, parsing and hashing happen in a
+    pool of worker processes (one per CPU by default), while this process
+    does all of the database writes.  Compiled decks need no parsing, so they
+    are imported directly.
+    Yields (source, deck_id, error) as each deck is imported, where deck_id
+    is None and error is a message if the deck couldn't be imported."""
+    md_sources = []
+    for source in sources:
+        if is_url(source) or not rdeck.is_rdeck_path(source):
+            md_sources.append(source)
+            continue
+        try:
+            deck_id = import_deck_rdeck(db_conn, sql_templates, source)
+        except Exception as e:
+            yield (source, None, "%s: %s" % (type(e).__name__, e))
+        else:
+            yield (source, deck_id, None)
+        continue
+    if len(md_sources) == 0:
+        return
+    # this process is the only writer while importing, so the decks can't
+    # change under the workers.
+    decks = {}
+    for deck in db.select_decks(db_conn, sql_templates):
+        decks[deck.gist_url] = deck
+        continue
+    tasks = []
+    for source in md_sources:
+        deck = decks.get(source_gist_url(source))
+        if deck is None:
+            tasks.append((source, None))
+        else:
+            tasks.append((source, deck.hash))
+        continue
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(parse_deck_source, tasks):
+            if result.error is not None:
+                yield (result.source, None, result.error)
+                continue
+            if result.cards is None:
+                deck = decks[result.gist_url]
+                skip_unchanged_deck(
+                    db_conn, sql_templates, deck, result.etag, result.hash
+                )
+                yield (result.source, deck.deck_id, None)
+                continue
+            deck_id = insert_deck_cards(
+                db_conn, sql_templates, result.gist_url, result.etag,
+                result.hash, result.title, result.preamble, result.cards,
+                result.markdown
+            )
+            yield (result.source, deck_id, None)
+            continue
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def import_deck_stream(db_conn, sql_templates, gist_url, etag, stream):
+    """Insert the deck read from a file-like object into the database.
+    The stream is copied to a temporary file before the import's transaction
+    begins, so that a slow download doesn't hold the database's write lock.
+    The cards are then read lazily from a mapping of the file (see
+    import_deck_fd), so the deck is never read into memory whole.
+    Returns the deck_id of the newly inserted deck."""
+    with tempfile.TemporaryFile() as fd:
+        shutil.copyfileobj(stream, fd, 65536)
+        fd.flush()
+        return import_deck_fd(db_conn, sql_templates, gist_url, etag, fd)
+
+
+def import_deck_file(db_conn, sql_templates, path):
+    """Insert a local markdown deck file into the database (see
+    import_deck_fd).
+    Returns the deck_id of the newly inserted deck."""
+    gist_url = os.path.abspath(path)
+    with open(path, 'rb') as fd:
+        return import_deck_fd(db_conn, sql_templates, gist_url, None, fd)
+
+
+def import_deck_fd(db_conn, sql_templates, gist_url, etag, fd):
+    """Insert the markdown deck in an open file into the database.
+    The file is memory-mapped, and the card bodies (and the recorded markdown)
+    are handed to sqlite as slices of the mapping, without being copied.
+    Returns the deck_id of the newly inserted deck."""
+    if os.fstat(fd.fileno()).st_size == 0:
+        # mmap can't map an empty file.
+        return import_deck_md(db_conn, sql_templates, gist_url, etag, b'')
+    mapping = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        try:
+            markdown = memoryview(mapping)
+        except TypeError:
+            # Python 2's mmap doesn't support memoryview, and sqlite can't
+            # take it as a parameter, so read it as a string.
+            markdown = mapping[:]
+        try:
+            deck_id = import_deck_buffer(
+                db_conn, sql_templates, gist_url, etag, markdown
+            )
+        finally:
+            # the view must be released before the mapping can be closed.
+            if isinstance(markdown, memoryview):
+                markdown.release()
+    except BaseException:
+        # card slices held by the traceback may still pin the mapping, in
+        # which case it is unmapped once they are freed.  Either way, don't
+        # hide the original error.
+        try:
+            mapping.close()
+        except BufferError:
+            pass
+        raise
+    mapping.close()
+    return deck_id
+
+
+def import_deck_rdeck(db_conn, sql_templates, path):
+    """Insert a compiled deck file into the database, without parsing any
+    markdown.  Card bodies are passed to sqlite as slices of the mapping.
+    Returns the deck_id of the newly inserted deck."""
+    gist_url = os.path.abspath(path)
+    with rdeck.CompiledDeck(path) as compiled:
+        deck_id = insert_deck_cards(
+            db_conn, sql_templates, gist_url, None, compiled.hash,
+            compiled.title, compiled.preamble, compiled.cards()
+        )
     return deck_id
 
 
+def import_deck_buffer(db_conn, sql_templates, gist_url, etag, markdown):
+    """Insert the deck held in a buffer (e.g. a memoryview) into the database.
+    The cards are parsed lazily (see parse.scan_deck) as they are inserted,
+    and their bodies passed to sqlite as slices of the buffer, so no more
+    than a batch of cards is held in memory at once.
+    Returns the deck_id of the newly inserted deck."""
+    hash = db.md5(markdown)
+    deck = db.select_deck_by_gist_url(db_conn, sql_templates, gist_url)
+    if skip_unchanged_deck(db_conn, sql_templates, deck, etag, hash):
+        return deck.deck_id
+    (title, preamble_md, cards) = scan_deck_cards(markdown)
+    # a parse error part way through rolls back the whole import.
+    return insert_deck_cards(
+        db_conn, sql_templates, gist_url, etag, hash, title, preamble_md,
+        cards, markdown
+    )
+
+
+def skip_unchanged_deck(db_conn, sql_templates, deck, etag, hash):
+    """Check whether a deck (a db.Deck, or None) already has the given hash,
+    and if so, record that it was fetched again.
+    Returns True if the deck is unchanged, and so its markdown needn't be
+    parsed (and its cards keep their scores)."""
+    if deck is None or deck.hash != hash:
+        return False
+    db.update_deck_fetched(
+        db_conn, sql_templates, deck.deck_id, db.make_tstamp(), etag
+    )
+    return True
+
+
 def update_deck(db_conn, sql_templates, deck_id, markdown, etag):
-    # update the deck
-    last_fetched = db.make_tstamp()
+    """Update an existing deck to match the given markdown, removing the cards
+    which are no longer in the deck and inserting the new ones."""
     deck_hash = db.md5(markdown)
-    tokens = parse.lex_deck(markdown)
-    (deck_ast, _) = parse.parse_deck(tokens)
-    preamble_md = deck_ast.preamble.text
-    title = parse.extract_title(preamble_md)
-    db.update_deck(
-        db_conn, sql_templates, deck_id, last_fetched, etag, deck_hash, title,
-        preamble_md
+    deck = db.select_deck(db_conn, sql_templates, deck_id)
+    if skip_unchanged_deck(db_conn, sql_templates, deck, etag, deck_hash):
+        return
+    old_card_hashes = db.select_card_hashes_by_deck_id(
+        db_conn, sql_templates, deck_id
     )
+    changes = diff_deck_md(
+        db_conn, sql_templates, deck_id, markdown, old_card_hashes
+    )
+    if changes is None:
+        changes = full_diff_deck_md(markdown, old_card_hashes)
+    (title, preamble_md, to_be_removed, to_be_inserted) = changes
+    with db.transaction(db_conn):
+        apply_deck_update(
+            db_conn, sql_templates, deck_id, etag, deck_hash, title,
+            preamble_md, to_be_removed, to_be_inserted
+        )
+        db.replace_deck_markdown(db_conn, sql_templates, deck_id, markdown)
+    return
+
 
-    # then update the individual cards
-    old_card_hashes = set(
-        db.select_card_hashes_by_deck_id(db_conn, sql_templates, deck_id)
+def update_deck_rdeck(db_conn, sql_templates, deck_id, path):
+    """Update an existing deck to match a compiled deck file."""
+    old_card_hashes = db.select_card_hashes_by_deck_id(
+        db_conn, sql_templates, deck_id
     )
+    with rdeck.CompiledDeck(path) as compiled:
+        (to_be_removed, to_be_inserted) = diff_cards(
+            compiled.cards(), old_card_hashes
+        )
+        apply_deck_update(
+            db_conn, sql_templates, deck_id, None, compiled.hash,
+            compiled.title, compiled.preamble, to_be_removed, to_be_inserted
+        )
+        # release the card slices before the file is unmapped.
+        del to_be_inserted
+
+
+def apply_deck_update(
+    db_conn, sql_templates, deck_id, etag, deck_hash, title, preamble_md,
+    to_be_removed, to_be_inserted
+):
+    """Write a deck update to the database, in a single transaction: update
+    the deck itself, then remove and insert the changed cards."""
+    last_fetched = db.make_tstamp()
+    with db.transaction(db_conn):
+        # update the deck
+        db.update_deck(
+            db_conn, sql_templates, deck_id, last_fetched, etag, deck_hash,
+            title, preamble_md
+        )
+
+        # then update the individual cards
+        db.delete_cards_by_hash(db_conn, sql_templates, deck_id, to_be_removed)
+        db.insert_cards_bulk(db_conn, sql_templates, deck_id, to_be_inserted)
+
+
+def full_diff_deck_md(markdown, old_card_hashes):
+    """Parse the whole deck markdown and compare its cards against the cards
+    currently in the database.  Only the cards to insert are kept in memory.
+    Returns (title, preamble markdown, set of card hashes to remove, list of
+    (front, back, card hash) tuples to insert)."""
+    (title, preamble_md, cards) = scan_deck_cards(markdown)
+    (to_be_removed, to_be_inserted) = diff_cards(
+        unique_cards(cards), old_card_hashes
+    )
+    return (title, preamble_md, to_be_removed, to_be_inserted)
+
+
+def diff_cards(cards, old_card_hashes):
+    """Compare all of a deck's (front, back, card hash) tuples against the
+    card hashes currently in the database.
+    Returns (set of card hashes to remove, list of (front, back, card hash)
+    tuples to insert)."""
+    old_card_hashes = set(old_card_hashes)
     new_card_hashes = set()
-    for card_ast in deck_ast.cards:
-        front = card_ast.front_text
-        back = card_ast.back_text
-        card_hash = db.make_card_hash(front, back)
+    to_be_inserted = []
+    for (front, back, card_hash) in cards:
+        if card_hash not in old_card_hashes and \
+                card_hash not in new_card_hashes:
+            to_be_inserted.append((front, back, card_hash))
         new_card_hashes.add(card_hash)
         continue
-
     to_be_removed = old_card_hashes.difference(new_card_hashes)
-    db.delete_cards_by_hash(db_conn, sql_templates, deck_id, to_be_removed)
+    return (to_be_removed, to_be_inserted)
+
 
-    to_be_inserted = new_card_hashes.difference(old_card_hashes)
-    for card_ast in deck_ast.cards:
+def diff_deck_md(db_conn, sql_templates, deck_id, markdown, old_card_hashes):
+    """Compare the deck markdown against the deck's previous markdown, parsing
+    and hashing only the cards in the region which changed.
+    Returns (title, preamble markdown, set of card hashes to remove, list of
+    (front, back, card hash) tuples to insert), or None if the previous
+    markdown isn't available or the deck needs to be parsed in full."""
+    old_markdown = db.select_deck_markdown(db_conn, sql_templates, deck_id)
+    if old_markdown is None:
+        return None
+    diff = parse.diff_decks(old_markdown, markdown)
+    if diff is None:
+        return None
+    (preamble_ast, removed_cards, added_cards) = diff
+    preamble_md = preamble_ast.text
+    title = parse.extract_title(preamble_md)
+
+    old_card_hashes = set(old_card_hashes)
+    added = []
+    added_hashes = set()
+    for card_ast in added_cards:
         front = card_ast.front_text
         back = card_ast.back_text
         card_hash = db.make_card_hash(front, back)
-        if card_hash in to_be_inserted:
-            card_id = db.insert_card(db_conn, sql_templates, front, back, deck_id)
-            assert card_id is not None
+        if card_hash not in old_card_hashes and card_hash not in added_hashes:
+            added.append((front, back, card_hash))
+        added_hashes.add(card_hash)
+        continue
+    # a card removed from the changed region stays if it was re-added, or if
+    # it is repeated elsewhere in the deck.  The database holds one card per
+    # hash, so only the new markdown can tell.  A card whose front or back
+    # no longer appears anywhere in the markdown is certainly gone; otherwise
+    # the whole deck is hashed (once) to find out.
+    to_be_removed = set()
+    new_card_hashes = None
+    for card_ast in removed_cards:
+        front = card_ast.front_text
+        back = card_ast.back_text
+        card_hash = db.make_card_hash(front, back)
+        if card_hash in added_hashes or card_hash not in old_card_hashes:
+            continue
+        if front in markdown and back in markdown:
+            if new_card_hashes is None:
+                (_, _, cards) = scan_deck_cards(markdown)
+                new_card_hashes = set([h for (_, _, h) in unique_cards(cards)])
+            if card_hash in new_card_hashes:
+                continue
+        to_be_removed.add(card_hash)
+        continue
+    return (title, preamble_md, to_be_removed, added)
+
+
+def export_deck(db_conn, sql_templates, deck_id, fd):
+    """Write a deck from the database as markdown to the (binary) file object
+    fd, streaming its cards rather than building the whole deck in memory."""
+    deck = db.select_deck(db_conn, sql_templates, deck_id)
+    assert deck is not None, "No deck with deck_id %s." % deck_id
+    preamble_md = deck_preamble_bytes(deck)
+    cards = iter_card_bytes(db_conn, sql_templates, deck_id)
+    parse.write_cards(preamble_md, cards, fd)
+
+
+def export_deck_to_disk(db_conn, sql_templates, deck_id, outdir_path):
+    """Explode a deck from the database into a directory, as preamble.md and
+    a N-front.md and N-back.md per card."""
+    deck = db.select_deck(db_conn, sql_templates, deck_id)
+    assert deck is not None, "No deck with deck_id %s." % deck_id
+    db.mkdir_p(outdir_path)
+    preamble_md = deck_preamble_bytes(deck)
+    cards = iter_card_bytes(db_conn, sql_templates, deck_id)
+    parse.write_cards_to_disk(preamble_md, cards, outdir_path)
+
+
+def deck_preamble_bytes(deck):
+    """Return the preamble of a deck (from db.select_deck) as bytes."""
+    if deck.preamble is None:
+        return b''
+    return py23.to_bytes(deck.preamble)
+
+
+def iter_card_bytes(db_conn, sql_templates, deck_id):
+    """Yield the (front, back) of each card of a deck as bytes."""
+    cards = db.iter_cards_by_deck_id(db_conn, sql_templates, deck_id)
+    for (front, back) in cards:
+        yield (py23.to_bytes(front), py23.to_bytes(back))
         continue
-    return
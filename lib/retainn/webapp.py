@@ -1,6 +1,8 @@
 """The local Retainn WSGI webapp."""
 
 import re
+import threading
+import wsgiref.simple_server
 
 try:
     # Python 3
@@ -9,7 +11,25 @@ except ImportError:
     # Python 2
     from StringIO import StringIO
 
+try:
+    # Python 3
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+try:
+    # Python 3
+    from urllib.parse import parse_qs
+    from html import escape
+except ImportError:
+    # Python 2
+    from urlparse import parse_qs
+    from cgi import escape
+
 from . import db
+from . import py23
+from . import scheduler
 from . import util
 from .vendored import markdown2
 
@@ -111,7 +131,7 @@ def POST_did_recall(request, path_match, db_conn, sql_templates, session):
     a card."""
     card_id = int(path_match.group(1))
     response = Obj()
-    db.did_recall_card(db_conn, sql_templates, card_id)
+    session.scheduler.grade(db_conn, sql_templates, card_id, 'recall')
     response.status = '302 Found'
     response.headers = [
         ('Location', '/')
@@ -124,7 +144,7 @@ def POST_did_not_recall(request, path_match, db_conn, sql_templates, session):
     recall a card."""
     card_id = int(path_match.group(1))
     response = Obj()
-    db.did_not_recall_card(db_conn, sql_templates, card_id)
+    session.scheduler.grade(db_conn, sql_templates, card_id, 'not_recall')
     response.status = '302 Found'
     response.headers = [
         ('Location', '/')
@@ -136,7 +156,7 @@ def POST_skip(request, path_match, db_conn, sql_templates, session):
     """A user POSTs to this endpoint to skip a card."""
     card_id = int(path_match.group(1))
     response = Obj()
-    db.skip_card(db_conn, sql_templates, card_id)
+    session.scheduler.grade(db_conn, sql_templates, card_id, 'skip')
     response.status = '302 Found'
     response.headers = [
         ('Location', '/')
@@ -153,14 +173,14 @@ def GET_card(request, path_match, db_conn, sql_templates, session):
     else:
         card_id = int(path_match.group(1))
         card = db.select_card(db_conn, sql_templates, card_id)
-        bw(u"# Deck: %s\n" % card.deck_title)
+        bw(u"# Deck: %s\n" % py23.to_str(card.deck_title))
         bw(u"- card_id: %s, score: %s\n" % (card.card_id, card.score))
         bw(u"\n\n----\n\n")
         bw(u"\n## Front of card:\n\n")
-        bw(card.front)
+        bw(py23.to_str(card.front))
         bw(u"\n\n----\n\n")
         bw(u"\n## Back of card:\n\n")
-        bw(card.back)
+        bw(py23.to_str(card.back))
         bw(u"\n\n----\n\n")
         bw(u"\n\nWere you able to recall the answer?\n\n")
         bw(u"<form method=\"POST\" action=\"/cards/%s/did-recall\">\n <button>Yes</button>\n</form>\n\n" % card_id)
@@ -186,15 +206,15 @@ def GET_next_card_front(request, path_match, db_conn, sql_templates, session):
     if db.select_count_card(db_conn, sql_templates) == 0:
         bw(u"You have not imported any flashcard decks.\n")
     else:
-        card = db.select_next_card(db_conn, sql_templates, session.session_start)
+        card = session.scheduler.next_card(db_conn, sql_templates)
         if card is None:
             bw(u"No more cards left to review in this session.\n")
         else:
-            bw(u"# Deck: %s\n" % card.deck_title)
+            bw(u"# Deck: %s\n" % py23.to_str(card.deck_title))
             bw(u"- card_id: %s, score: %s\n" % (card.card_id, card.score))
             bw(u"\n\n----\n\n")
             bw(u"\n## Front of card:\n\n")
-            bw(card.front)
+            bw(py23.to_str(card.front))
             bw(u"\n\n----\n\n")
             bw(u"\n## Back of card:\n\n")
             back_url = "/cards/%s" % card.card_id
@@ -212,6 +232,44 @@ def GET_next_card_front(request, path_match, db_conn, sql_templates, session):
     return response
 
 
+def GET_search(request, path_match, db_conn, sql_templates, session):
+    """Search the cards for the words of the 'q' query parameter."""
+    response = Obj()
+    query = parse_qs(request.get('QUERY_STRING', ''))
+    text = py23.to_unicode(query.get('q', [''])[0])
+    buf = StringIO()
+    bw = buf.write
+    bw(u"# Search\n\n")
+    bw(u"<form method=\"GET\" action=\"/search\">\n")
+    bw(u" <input name=\"q\" value=\"%s\">\n" % escape(text, True))
+    bw(u" <button>Search</button>\n</form>\n\n")
+    if len(text.strip()) > 0:
+        results = db.search_cards(
+            db_conn, sql_templates, text, mark_start='<b>', mark_end='</b>'
+        )
+        if len(results) == 0:
+            bw(u"No cards match.\n")
+        for result in results:
+            # the snippet is card markdown, so it is shown as-is, on one line.
+            snippet = u' '.join(py23.to_str(result.snippet).split())
+            bw(u"- [card %s](/cards/%s) (%s): %s\n" % (
+                result.card_id, result.card_id,
+                py23.to_str(result.deck_title), snippet
+            ))
+            continue
+    md = buf.getvalue()
+    html = "<html>\n" \
+        + "<head><style>%s</style></head>\n" % (css,) \
+        + "<body>\n" + md2html(md) + "\n</body>\n" \
+        + "</html>\n"
+    response.body = html.encode('utf-8')
+    response.status = '200 OK'
+    response.headers = [
+        ('Content-type', 'text/html')
+    ]
+    return response
+
+
 def GET_404(request, _, db_conn, sql_templates, session):
     """An endpoint which returns a 404 response."""
     response = Obj()
@@ -226,6 +284,7 @@ def GET_404(request, _, db_conn, sql_templates, session):
 g_static_routes = {
     ('GET','/'): GET_next_card_front,
     ('GET','/404'): GET_404,
+    ('GET','/search'): GET_search,
 }
 
 g_dynamic_routes = [
@@ -278,17 +337,30 @@ def route(request):
     return (handler_func, path_regex_match)
 
 
-def make_application(db_conn, sql_templates, session_start):
-    """Return a WSGI application function which closes over db_conn,
-    sql_templates, and session_start."""
+def make_application(pool, sql_templates, session_start, journal=None):
+    """Return a WSGI application function which closes over the connection
+    pool (a db.ConnectionPool), sql_templates, and the review session (which
+    starts at session_start).  Each request uses its thread's connection.
+    Grades are written through journal (a journal.GradeJournal), if given,
+    which the caller must flush once the server has stopped."""
     class Context:
         # Python 2 lacks the 'nonlocal' keyword, so we use this class hack.
         # Thanks to https://stackoverflow.com/a/28433571
-        session = Obj({"session_start": session_start})
+        session = Obj({
+            "session_start": session_start,
+            # shared by the request threads.  It locks itself, but only
+            # while it uses its heap, not the database.
+            "scheduler": scheduler.Scheduler(
+                pool.connection(), sql_templates, session_start, journal
+            ),
+        })
     def application(request, start_response_fn):
         """A webapp request handler conforming to the WSGI interface."""
+        db_conn = pool.connection()
         (handler, path_regex_match) = route(request)
         response = handler(request, path_regex_match, db_conn, sql_templates, Context.session)
+        if journal is not None:
+            journal.poll(db_conn, sql_templates)
         body = response.get('body', b'')
         response.headers.append(
             ('Content-Length', str(len(body)))
@@ -296,3 +368,70 @@ def make_application(db_conn, sql_templates, session_start):
         start_response_fn(response.status, response.headers)
         return [body]
     return application
+
+
+# the number of request handling threads.
+default_threads = 4
+
+
+class PooledWSGIServer(wsgiref.simple_server.WSGIServer):
+    """A WSGI server which handles requests on a fixed set of worker threads,
+    so that each thread (and so each pooled database connection) serves many
+    requests."""
+    # Python 2's SocketServer classes are old-style, so no super() here.
+
+    def __init__(self, server_address, handler_class, threads=default_threads):
+        wsgiref.simple_server.WSGIServer.__init__(
+            self, server_address, handler_class
+        )
+        self.requests = queue.Queue()
+        self.workers = []
+        for _ in range(threads):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            self.workers.append(thread)
+            continue
+
+    def process_request(self, request, client_address):
+        """Queue a request for the worker threads."""
+        self.requests.put((request, client_address))
+
+    def server_close(self):
+        """Stop the worker threads, once they have handled the queued
+        requests, and close the server."""
+        for _ in self.workers:
+            self.requests.put(None)
+            continue
+        for thread in self.workers:
+            thread.join()
+            continue
+        self.workers = []
+        wsgiref.simple_server.WSGIServer.server_close(self)
+
+    def work(self):
+        """Handle queued requests, until server_close()."""
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+            (request, client_address) = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+            continue
+
+
+def make_server(host, port, application, threads=default_threads):
+    """Return a WSGI server for application, handling requests on the given
+    number of threads (or on the serving thread, if threads is 1)."""
+    if threads == 1:
+        return wsgiref.simple_server.make_server(host, port, application)
+    server = PooledWSGIServer(
+        (host, port), wsgiref.simple_server.WSGIRequestHandler, threads
+    )
+    server.set_app(application)
+    return server
@@ -2,25 +2,39 @@
 
 from __future__ import print_function
 
+import io
+import os
+import random
+import shutil
 import sqlite3
 import sys
+import tempfile
+import threading
+import time
+
+try:
+    # Python 3
+    from urllib.request import urlopen
+except ImportError:
+    # Python 2
+    from urllib2 import urlopen
 
 sys.path.insert(0, "./lib")
+from retainn import cli
 from retainn import db
 from retainn import curl
 from retainn import util
+from retainn import parse
+from retainn import rdeck
+from retainn import journal
+from retainn import scheduler
+from retainn import webapp
 from retainn import py23
 
 
 def make_memory_db():
     """Create an in-memory databse with our schema."""
-    # 'isolation_level=None' means autocommit mode.
-    db_conn = db.open_db(':memory:')
-    schema = db.read_file('lib/retainn/sql/schema.sql')
-    cursor = db_conn.cursor()
-    cursor.executescript(schema)
-    cursor.close()
-    return db_conn
+    return db.create_memory_db('lib/retainn/sql')
 
 
 def test_md5():
@@ -28,6 +42,41 @@ def test_md5():
     assert hash == '6cd3556deb0da54bca060b4c39479839'
 
 
+def test_lex_deck():
+    markdown = b"# Deck\n\n---\n\nfront\n\n%\n\nback\n\n---\n"
+    tokens = parse.lex_deck(markdown)
+    types = [tokens.type_name(i) for i in range(len(tokens))]
+    assert types == [
+        'TOK_OTHER', 'TOK_FRONT', 'TOK_OTHER', 'TOK_BACK', 'TOK_OTHER',
+        'TOK_LAST'
+    ], types
+    assert tokens.text(2) == b"front"
+    assert b"".join([tokens.text(i) for i in range(len(tokens))]) == markdown
+
+
+def test_flatten_deck():
+    markdown = open('sample-decks/1.md', 'rb').read()
+    tokens = parse.lex_deck(markdown)
+    (deck_ast, _) = parse.parse_deck(tokens)
+    assert deck_ast is not None
+    assert len(deck_ast.cards) == 1
+    assert parse.flatten_deck(deck_ast) == markdown
+
+
+def test_iter_deck():
+    markdown = open('sample-decks/1.md', 'rb').read()
+    (deck_ast, _) = parse.parse_deck(parse.lex_deck(markdown))
+    # a tiny chunk size forces delimiters to straddle chunk boundaries.
+    nodes = list(parse.iter_deck(io.BytesIO(markdown), chunk_size=3))
+    assert nodes[0].type == 'AST_PREAMBLE'
+    assert nodes[0].text == deck_ast.preamble.text
+    cards = [(card.front_text, card.back_text) for card in nodes[1:]]
+    assert cards == [(b"What is it?", b"chicken.")], cards
+
+    nodes = list(parse.iter_deck(io.BytesIO(b"# Deck\n\n---\n\nfront\n")))
+    assert nodes[-1].type == 'ERROR'
+
+
 def test_get_deck():
     url = "https://gist.github.com/cellularmitosis/fe539a6529d3787d94517f94def1bc4d"
     etag1 = None
@@ -37,6 +86,167 @@ def test_get_deck():
     assert etag3 is None, "etag3 should be None. etag1: %s, etag2: %s, etag3: %s" % (etag1, etag2, etag3)
 
 
+def test_grade_card():
+    db_conn = make_memory_db()
+    sql_templates = db.load_sql_templates(path='lib/retainn/sql')
+    card_id = db.insert_card(db_conn, sql_templates, 'front', 'back', 1)
+    grades = [
+        (db.did_recall_card, 1), (db.did_recall_card, 2),
+        (db.did_not_recall_card, -1), (db.did_not_recall_card, -2),
+        (db.did_recall_card, 1), (db.did_not_recall_card, 0),
+        (db.skip_card, 0),
+    ]
+    has_returning = db.sqlite_has_returning
+    try:
+        for returning in [True, False]:
+            db.sqlite_has_returning = returning and has_returning
+            db_conn.execute("UPDATE card SET score = 0")
+            for (grade, expected) in grades:
+                score = grade(db_conn, sql_templates, card_id)
+                assert score == expected, (grade, score, expected)
+                continue
+            continue
+    finally:
+        db.sqlite_has_returning = has_returning
+    result = db_conn.execute("SELECT last_seen FROM card")
+    assert result.fetchone()[0] is not None
+    reviews = db.select_reviews(db_conn, sql_templates, card_id)
+    assert [score for (_, score, _) in reviews] == \
+        [expected for (_, expected) in grades] * 2
+    # graded_score agrees with grade_card.sql.
+    score = 0
+    for (grade, expected, _) in reviews[:len(grades)]:
+        score = db.graded_score(score, grade)
+        assert score == expected, (grade, score, expected)
+        continue
+    db_conn.close()
+
+
+def test_grade_journal():
+    db_conn = make_memory_db()
+    sql_templates = db.load_sql_templates(path='lib/retainn/sql')
+    card_id = db.insert_card(db_conn, sql_templates, 'front', 'back', 1)
+    grade_journal = journal.GradeJournal(max_reviews=3, max_delay_ms=60000)
+    # scores build on the pending grades, not the (stale) database.
+    assert grade_journal.grade(db_conn, sql_templates, card_id, 'recall') == 1
+    assert grade_journal.grade(db_conn, sql_templates, card_id, 'recall') == 2
+    assert len(grade_journal) == 2
+    assert db.select_card_score(db_conn, sql_templates, card_id) == 0
+    assert db.select_reviews(db_conn, sql_templates, card_id) == []
+    # the third grade fills the batch, which is written in one go.
+    grade_journal.grade(db_conn, sql_templates, card_id, 'not_recall')
+    assert len(grade_journal) == 0
+    assert db.select_card_score(db_conn, sql_templates, card_id) == -1
+    reviews = db.select_reviews(db_conn, sql_templates, card_id)
+    assert [(grade, score) for (grade, score, _) in reviews] == \
+        [('recall', 1), ('recall', 2), ('not_recall', -1)]
+    # as are any stragglers, on flush.
+    grade_journal.grade(db_conn, sql_templates, card_id, 'skip')
+    grade_journal.flush(db_conn, sql_templates)
+    assert len(db.select_reviews(db_conn, sql_templates, card_id)) == 4
+    # grades made elsewhere while the journal's are pending aren't lost.
+    grade_journal.grade(db_conn, sql_templates, card_id, 'not_recall')
+    db.grade_card(db_conn, sql_templates, card_id, 'not_recall')
+    assert db.select_card_score(db_conn, sql_templates, card_id) == -2
+    grade_journal.flush(db_conn, sql_templates)
+    assert db.select_card_score(db_conn, sql_templates, card_id) == -3
+    reviews = db.select_reviews(db_conn, sql_templates, card_id)
+    assert [score for (_, score, _) in reviews][-2:] == [-2, -3]
+    db_conn.close()
+
+    # a FlushTimer writes the pending grades once they are due.
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir, 'db.sqlite3')
+        db_conn = db.create_db('lib/retainn/sql', fname)
+        card_id = db.insert_card(db_conn, sql_templates, 'front', 'back', 1)
+        pool = db.ConnectionPool(fname)
+        grade_journal = journal.GradeJournal(max_reviews=3, max_delay_ms=20)
+        timer = journal.FlushTimer(grade_journal, pool, sql_templates)
+        timer.start()
+        grade_journal.grade(db_conn, sql_templates, card_id, 'recall')
+        for _ in range(100):
+            if len(grade_journal) == 0:
+                break
+            time.sleep(0.01)
+            continue
+        timer.stop()
+        assert len(grade_journal) == 0
+        assert db.select_card_score(db_conn, sql_templates, card_id) == 1
+        pool.close()
+        db_conn.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_scheduler():
+    sql_templates = db.load_sql_templates(path='lib/retainn/sql')
+    session_start = db.make_tstamp()
+    rng = random.Random(0)
+    rows = []
+    for card_id in range(1, 301):
+        score = rng.randint(-3, 3)
+        last_seen = rng.choice([None, 1, 2, 3, session_start + 1])
+        rows.append((card_id, score, last_seen))
+        continue
+
+    # the scheduler must serve cards in the same order as select_next_card.
+    orders = []
+    for use_scheduler in [False, True]:
+        db_conn = make_memory_db()
+        db_conn.execute("INSERT INTO deck VALUES (1, 'url', 1, NULL, '', '', '')")
+        db_conn.execute(
+            "INSERT INTO card_content (hash, front, back)"
+            " VALUES ('hash', 'front', 'back')"
+        )
+        db_conn.executemany(
+            "INSERT INTO card VALUES (?, ?, ?, 'hash', 1)", rows
+        )
+        queue = scheduler.Scheduler(db_conn, sql_templates, session_start)
+        order = []
+        while True:
+            if use_scheduler:
+                card = queue.next_card(db_conn, sql_templates)
+            else:
+                card = db.select_next_card(db_conn, sql_templates, session_start)
+            if card is None:
+                break
+            order.append(card.card_id)
+            if use_scheduler:
+                queue.grade(db_conn, sql_templates, card.card_id, 'skip')
+            else:
+                db.skip_card(db_conn, sql_templates, card.card_id)
+            continue
+        orders.append(order)
+        db_conn.close()
+        continue
+    assert len(orders[0]) > 0
+    assert orders[0] == orders[1]
+
+    # cards graded out of order, or deleted, are skipped.
+    db_conn = make_memory_db()
+    db_conn.execute("INSERT INTO deck VALUES (1, 'url', 1, NULL, '', '', '')")
+    for card_id in [1, 2, 3]:
+        db.insert_card(db_conn, sql_templates, 'front', 'back', 1)
+        continue
+    queue = scheduler.Scheduler(db_conn, sql_templates, session_start)
+    queue.grade(db_conn, sql_templates, 2, 'recall')
+    db_conn.execute("DELETE FROM card WHERE card_id = 1")
+    assert queue.next_card(db_conn, sql_templates).card_id == 3
+
+    # cards added during the session (e.g. by importing a deck) are queued.
+    queue.grade(db_conn, sql_templates, 3, 'recall')
+    assert queue.next_card(db_conn, sql_templates) is None
+    db.insert_card(db_conn, sql_templates, 'new', 'back', 1)
+    db.insert_card(db_conn, sql_templates, 'newer', 'back', 1, score=-1)
+    assert queue.next_card(db_conn, sql_templates).card_id == 5
+    queue.grade(db_conn, sql_templates, 5, 'recall')
+    assert queue.next_card(db_conn, sql_templates).card_id == 4
+    queue.grade(db_conn, sql_templates, 4, 'recall')
+    assert queue.next_card(db_conn, sql_templates) is None
+    db_conn.close()
+
+
 def test_insert_deck():
     db_conn = make_memory_db()
     sql_templates = db.load_sql_templates(['insert_deck'], path='lib/retainn/sql')
@@ -56,7 +266,11 @@ def test_insert_deck():
 
 def test_insert_card():
     db_conn = make_memory_db()
-    sql_templates = db.load_sql_templates(['insert_card'], path='lib/retainn/sql')
+    sql_templates = db.load_sql_templates(
+        ['insert_card', 'insert_card_content', 'insert_card_fts',
+         'select_setting'],
+        path='lib/retainn/sql'
+    )
     front = 'front'
     back = 'back'
     deck_id = 1
@@ -65,12 +279,364 @@ def test_insert_card():
         db_conn, sql_templates, front, back, deck_id, last_seen
     )
     assert py23.is_int(card_id), "card_id: %s" % card_id
+    sql_templates = db.load_sql_templates(path='lib/retainn/sql')
+    db_conn.execute("INSERT INTO deck VALUES (1, 'url', 1, NULL, '', 'T', '')")
+    card = db.find_card(db_conn, sql_templates, card_id)
+    assert isinstance(card, db.Card)
+    assert (card.front, card.back, card.last_seen) == (front, back, last_seen)
+    assert card.deck_title == 'T'
+    assert db.find_card(db_conn, sql_templates, card_id + 1) is None
+    db_conn.close()
+
+
+def test_create_db():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir, 'sub', 'db.sqlite3')
+        db_conn = db.create_db('lib/retainn/sql', fname)
+        assert db.select_schema_version(db_conn) == db.schema_version
+        db_conn.close()
+        assert os.path.exists(fname)
+    finally:
+        shutil.rmtree(tmpdir)
+    # in-memory databases are independent of each other.
+    db_conn1 = make_memory_db()
+    db_conn2 = make_memory_db()
+    db_conn1.execute("INSERT INTO deck VALUES (1, 'url', 1, NULL, '', '', '')")
+    assert db_conn2.execute("SELECT count(*) FROM deck").fetchone()[0] == 0
+    db_conn1.close()
+    db_conn2.close()
+
+
+def test_connection_pool():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir, 'db.sqlite3')
+        db.create_db('lib/retainn/sql', fname).close()
+        pool = db.ConnectionPool(fname)
+        db_conn = pool.connection()
+        assert pool.connection() is db_conn
+        assert db.select_db_fname(db_conn) == os.path.realpath(fname)
+        # each thread gets its own connection to the same database.
+        others = []
+        def run():
+            other = pool.connection()
+            others.append((other, db.select_schema_version(other)))
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        assert others[0][0] is not db_conn
+        assert others[0][1] == db.schema_version
+        pool.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    # an in-memory database has only the one connection.
+    db_conn = make_memory_db()
+    assert db.select_db_fname(db_conn) is None
+    pool = db.ConnectionPool(None, db_conn=db_conn)
+    assert pool.connection() is db_conn
+    pool.close()
+    db_conn.close()
+
+
+def test_pooled_wsgi_server():
+    def application(request, start_response_fn):
+        start_response_fn('200 OK', [('Content-Length', '2')])
+        return [b'ok']
+    server = webapp.make_server('localhost', 0, application, threads=2)
+    assert isinstance(server, webapp.PooledWSGIServer)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        url = 'http://localhost:%d/' % server.server_address[1]
+        assert urlopen(url).read() == b'ok'
+    finally:
+        server.shutdown()
+        thread.join()
+        workers = list(server.workers)
+        server.server_close()
+    assert not any(worker.is_alive() for worker in workers)
+
+
+def test_backup_restore():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir, 'db.sqlite3')
+        backup_fname = os.path.join(tmpdir, 'backup.sqlite3')
+        db_conn = db.create_db('lib/retainn/sql', fname)
+        sql_templates = db.load_sql_templates(path='lib/retainn/sql')
+        db_conn.execute("INSERT INTO deck VALUES (1, 'url', 1, NULL, '', '', '')")
+        cards = [('front %d' % i, 'back %d' % i, None) for i in range(500)]
+        db.insert_cards_bulk(db_conn, sql_templates, 1, cards)
+        steps = []
+        def progress(remaining, total):
+            steps.append(remaining)
+        db.backup_db(db_conn, backup_fname, 2, progress)
+        assert not os.path.exists(backup_fname + '.tmp')
+        backup_conn = db.open_db(backup_fname)
+        assert db.check_integrity(backup_conn) == []
+        assert db.select_count_card(backup_conn, sql_templates) == 500
+        backup_conn.close()
+        if hasattr(db_conn, 'backup'):
+            # the backup went a few pages at a time.
+            assert len(steps) > 1 and steps[-1] == 0, steps
+            db.delete_cards_for_deck(db_conn, sql_templates, 1)
+            db.restore_db(db_conn, backup_fname)
+            assert db.select_count_card(db_conn, sql_templates) == 500
+            results = db.search_cards(db_conn, sql_templates, 'front')
+            assert len(results) == 20
+            # something which isn't a database is refused, untouched.
+            bad_fname = os.path.join(tmpdir, 'bad.sqlite3')
+            with open(bad_fname, 'wb') as fd:
+                fd.write(b'not a database' * 1000)
+            try:
+                db.restore_db(db_conn, bad_fname)
+                assert False, "restored a non-database"
+            except sqlite3.DatabaseError:
+                pass
+            assert db.select_count_card(db_conn, sql_templates) == 500
+        db_conn.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_storage_profiles():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir, 'db.sqlite3')
+        db.create_db('lib/retainn/sql', fname).close()
+        for (profile, synchronous) in [('durable', 2), ('bulk-import', 0)]:
+            db_conn = db.open_db(fname, profile)
+            result = db_conn.execute("PRAGMA journal_mode")
+            assert result.fetchone()[0] == 'wal'
+            result = db_conn.execute("PRAGMA synchronous")
+            assert result.fetchone()[0] == synchronous
+            db_conn.close()
+            continue
+    finally:
+        shutil.rmtree(tmpdir)
+    argv = ['retainn', '--profile', 'fast', 'decks']
+    assert cli.pop_profile_option(argv) == 'fast'
+    assert argv == ['retainn', 'decks']
+    argv = ['retainn', '--profile=fast', 'decks']
+    assert cli.pop_profile_option(argv) == 'fast'
+    assert argv == ['retainn', 'decks']
+    assert cli.pop_profile_option(argv) is None
+
+
+def test_insert_cards_bulk():
+    db_conn = make_memory_db()
+    sql_templates = db.load_sql_templates(
+        ['insert_card', 'insert_card_content', 'insert_card_fts',
+         'select_setting'],
+        path='lib/retainn/sql'
+    )
+    cards = [
+        ('front %d' % i, 'back %d' % i, None) for i in range(1000)
+    ] + [('front', 'back', 'precomputed')]
+    count = db.insert_cards_bulk(db_conn, sql_templates, 1, cards)
+    assert count == 1001
+    result = db_conn.execute("SELECT hash FROM card ORDER BY card_id")
+    hashes = [row[0] for row in result.fetchall()]
+    assert hashes[0] == db.make_card_hash('front 0', 'back 0')
+    assert hashes[-1] == 'precomputed'
+
+    # a failure part way through rolls back the whole transaction.
+    try:
+        with db.transaction(db_conn):
+            db.insert_cards_bulk(db_conn, sql_templates, 2, cards)
+            raise ValueError()
+    except ValueError:
+        pass
+    result = db_conn.execute("SELECT count(*) FROM card")
+    assert result.fetchone()[0] == 1001
+    db_conn.close()
+
+
+def test_delete_cards_by_hash():
+    db_conn = make_memory_db()
+    sql_templates = db.load_sql_templates(path='lib/retainn/sql')
+    # more hashes than fit in an 'IN (?,?,...)' list.
+    cards = [('front %d' % i, 'back', 'hash %d' % i) for i in range(40000)]
+    db.insert_cards_bulk(db_conn, sql_templates, 1, cards)
+    db.insert_cards_bulk(db_conn, sql_templates, 2, cards[:10])
+    db.delete_cards_by_hash(db_conn, sql_templates, 1, set())
+    assert db.select_count_card(db_conn, sql_templates) == 40010
+    to_be_removed = set(['hash %d' % i for i in range(1, 40000)])
+    db.delete_cards_by_hash(db_conn, sql_templates, 1, to_be_removed)
+    hashes = db.select_card_hashes_by_deck_id(db_conn, sql_templates, 1)
+    assert set(hashes) == set(['hash 0'])
+    # other decks are untouched.
+    hashes = db.select_card_hashes_by_deck_id(db_conn, sql_templates, 2)
+    assert len(hashes) == 10
+    db_conn.close()
+
+
+def test_card_content():
+    db_conn = make_memory_db()
+    sql_templates = db.load_sql_templates(path='lib/retainn/sql')
+    cards = [('front', 'back', None), ('front 2', 'back 2', None)]
+    db.insert_cards_bulk(db_conn, sql_templates, 1, cards)
+    db.insert_cards_bulk(db_conn, sql_templates, 2, cards[:1])
+    # identical cards share their content.
+    count_sql = "SELECT count(*) FROM card_content"
+    assert db_conn.execute(count_sql).fetchone()[0] == 2
+    db.delete_cards_for_deck(db_conn, sql_templates, 1)
+    assert db_conn.execute(count_sql).fetchone()[0] == 1
+    db.delete_cards_for_deck(db_conn, sql_templates, 2)
+    assert db_conn.execute(count_sql).fetchone()[0] == 0
+    db_conn.close()
+
+
+def test_compress_cards():
+    db_conn = make_memory_db()
+    sql_templates = db.load_sql_templates(path='lib/retainn/sql')
+    db_conn.execute("INSERT INTO deck VALUES (1, 'url', 1, NULL, '', '', '')")
+    back = b"```\n" + b"    x = x + 1;\n" * 100 + b"```"
+    card_id1 = db.insert_card(db_conn, sql_templates, b'front', back, 1)
+    compressed = db.compress_cards(db_conn, sql_templates)
+    assert compressed == 1
+    card_id2 = db.insert_card(db_conn, sql_templates, b'front 2', back, 1)
+    result = db_conn.execute("SELECT front, back FROM card_content")
+    for (stored_front, stored_back) in result.fetchall():
+        # short bodies are left as they are.
+        assert not db.is_compressed(stored_front)
+        assert db.is_compressed(stored_back)
+        assert len(stored_back) < len(back)
+        continue
+    for card_id in [card_id1, card_id2]:
+        assert db.select_card_back(db_conn, sql_templates, card_id) == back
+        continue
+    cards = list(db.iter_cards_by_deck_id(db_conn, sql_templates, 1))
+    assert cards == [(b'front', back), (b'front 2', back)]
+    db_conn.close()
+
+
+def test_migrate_db():
+    # a database created by the original (version 1) schema.
+    db_conn = db.open_db(':memory:')
+    db_conn.executescript("""
+        CREATE TABLE retainn_schema (schema_version TEXT NOT NULL);
+        INSERT INTO retainn_schema (schema_version) VALUES ('1');
+        CREATE TABLE card (
+            card_id INTEGER PRIMARY KEY AUTOINCREMENT, score INTEGER NOT NULL,
+            last_seen INTEGER, front TEXT NOT NULL, back TEXT NOT NULL,
+            hash TEXT NOT NULL, deck_id INTEGER NOT NULL
+        );
+        CREATE TABLE deck (
+            deck_id INTEGER PRIMARY KEY AUTOINCREMENT, gist_url TEXT NOT NULL,
+            last_fetched INTEGER NOT NULL, etag TEXT, hash TEXT NOT NULL,
+            title TEXT, preamble TEXT
+        );
+        INSERT INTO deck VALUES (1, 'url', 1, NULL, 'hash', 'title', '');
+        INSERT INTO card VALUES (1, 0, NULL, 'front', 'back', 'hash', 1);
+    """)
+    migrated = db.migrate_db(db_conn, 'lib/retainn/sql')
+    assert migrated == [2, 3, 4, 5, 6, 7], migrated
+    assert db.select_schema_version(db_conn) == db.schema_version
+    assert db.migrate_db(db_conn, 'lib/retainn/sql') == []
+    sql_templates = db.load_sql_templates(path='lib/retainn/sql')
+    card = db.select_next_card(db_conn, sql_templates, db.make_tstamp())
+    assert card.front == 'front'
+    # existing cards are indexed for search.
+    results = db.search_cards(db_conn, sql_templates, 'back')
+    assert [result.card_id for result in results] == [1]
+    # the migrated schema matches a freshly created one.
+    fresh_conn = make_memory_db()
+    sql = "SELECT type, name FROM sqlite_master ORDER BY name"
+    assert db_conn.execute(sql).fetchall() == fresh_conn.execute(sql).fetchall()
+    plan = db_conn.execute(
+        "EXPLAIN QUERY PLAN " + sql_templates['select_next_card'],
+        {'session_start': 0}
+    ).fetchall()
+    assert 'card_score_last_seen' in plan[0][-1], plan
     db_conn.close()
+    fresh_conn.close()
+
+
+def test_search_cards():
+    db_conn = make_memory_db()
+    sql_templates = db.load_sql_templates(path='lib/retainn/sql')
+    db_conn.execute("INSERT INTO deck VALUES (1, 'url', 1, NULL, '', 'Go', '')")
+    cards = [
+        ('What is a goroutine?', 'A lightweight thread.', None),
+        ('What is a channel?', 'A typed conduit between threads. ' * 4, None),
+        ('What does os.path.join do?', 'Joins paths.', None),
+    ]
+    db.insert_cards_bulk(db_conn, sql_templates, 1, cards)
+    results = db.search_cards(db_conn, sql_templates, 'threads')
+    assert sorted([r.card_id for r in results]) == [1, 2]
+    results = db.search_cards(db_conn, sql_templates, 'goroutine thread')
+    assert [(r.card_id, r.deck_title) for r in results] == [(1, 'Go')]
+    assert results[0].snippet == 'What is a [goroutine]?', results[0].snippet
+    # punctuation isn't query syntax, and '*' is a prefix search.
+    results = db.search_cards(db_conn, sql_templates, 'os.path.join')
+    assert [r.card_id for r in results] == [3]
+    results = db.search_cards(db_conn, sql_templates, 'condu*')
+    assert [r.card_id for r in results] == [2]
+    assert db.search_cards(db_conn, sql_templates, ' * ') == []
+    # deleted cards drop out of the index, compressed cards stay in it.
+    db.delete_cards_by_hash(
+        db_conn, sql_templates, 1, set([db.make_card_hash(*cards[0][:2])])
+    )
+    assert db.compress_cards(db_conn, sql_templates) == 1
+    results = db.search_cards(db_conn, sql_templates, 'threads')
+    assert [r.card_id for r in results] == [2]
+    # compressed content is indexed as it is inserted, and unindexed once no
+    # card uses it.
+    compressed = ('Which threads are green?', 'Goroutines. ' * 10, None)
+    db.insert_cards_bulk(db_conn, sql_templates, 1, [compressed])
+    db_conn.execute("INSERT INTO deck VALUES (2, 'url2', 1, NULL, '', '', '')")
+    db.insert_cards_bulk(db_conn, sql_templates, 2, [compressed])
+    results = db.search_cards(db_conn, sql_templates, 'threads')
+    assert sorted([r.card_id for r in results]) == [2, 4, 5]
+    snippets = dict((r.card_id, r.snippet) for r in results)
+    assert snippets[4] == 'Which [threads] are green?', snippets
+    # the index is by content, which is stored once.
+    result = db_conn.execute("SELECT rowid FROM card_fts ORDER BY rowid")
+    assert [row[0] for row in result.fetchall()] == [2, 3, 4]
+    db.delete_cards_for_deck(db_conn, sql_templates, 1)
+    results = db.search_cards(db_conn, sql_templates, 'threads')
+    assert [r.card_id for r in results] == [5]
+    db.delete_cards_for_deck(db_conn, sql_templates, 2)
+    result = db_conn.execute("SELECT rowid FROM card_fts")
+    assert result.fetchall() == []
+    db_conn.execute("INSERT INTO card_fts (card_fts) VALUES ('integrity-check')")
+    db_conn.close()
+
+    # the schema needs no functions of ours, so other clients (e.g. the
+    # sqlite3 shell) can insert and delete cards.
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir, 'db.sqlite3')
+        db_conn = db.create_db('lib/retainn/sql', fname)
+        db_conn.execute("INSERT INTO deck VALUES (1, 'url', 1, NULL, '', 'Go', '')")
+        db.insert_cards_bulk(db_conn, sql_templates, 1, cards)
+        db_conn.close()
+        other_conn = sqlite3.connect(fname)
+        other_conn.execute("DELETE FROM card WHERE card_id = 2")
+        other_conn.execute(
+            "INSERT INTO card_content (hash, front, back)"
+            " VALUES ('x', 'Are threads cheap?', 'No.')"
+        )
+        other_conn.execute(
+            "INSERT INTO card (score, hash, deck_id) VALUES (0, 'x', 1)"
+        )
+        other_conn.commit()
+        other_conn.close()
+        db_conn = db.open_db(fname)
+        results = db.search_cards(db_conn, sql_templates, 'threads')
+        assert sorted([r.card_id for r in results]) == [1, 4]
+        db_conn.close()
+    finally:
+        shutil.rmtree(tmpdir)
 
 
 def test_select_next_card():
     db_conn = make_memory_db()
-    sql_templates = db.load_sql_templates(['select_next_card'], path='lib/retainn/sql')
+    sql_templates = db.load_sql_templates(
+        ['select_next_card', 'select_card_back_by_id'], path='lib/retainn/sql'
+    )
     cursor = db_conn.cursor()
     cursor.execute("""
     INSERT INTO deck (gist_url, last_fetched, etag, hash, title, preamble)
@@ -79,8 +645,12 @@ def test_select_next_card():
     deck_id = cursor.lastrowid
     assert deck_id is not None
     cursor.execute("""
-    INSERT INTO card (score, last_seen, front, back, hash, deck_id)
-    VALUES (1, 1, 'front', 'back', 'hash', :deck_id);
+    INSERT INTO card_content (hash, front, back)
+    VALUES ('hash', 'front', 'back');
+    """)
+    cursor.execute("""
+    INSERT INTO card (score, last_seen, hash, deck_id)
+    VALUES (1, 1, 'hash', :deck_id);
     """, {'deck_id': deck_id})
     card_id = cursor.lastrowid
     assert card_id is not None
@@ -88,6 +658,9 @@ def test_select_next_card():
     session_start = 2
     obj = db.select_next_card(db_conn, sql_templates, session_start)
     assert obj.card_id == card_id
+    # the back is only fetched when it is revealed.
+    assert obj.front == 'front' and not hasattr(obj, 'back')
+    assert db.select_card_back(db_conn, sql_templates, card_id) == 'back'
     db_conn.close()
 
 
@@ -105,8 +678,12 @@ def test_update_card_score_last_seen():
     deck_id = cursor.lastrowid
     assert deck_id is not None
     cursor.execute("""
-    INSERT INTO card (score, last_seen, front, back, hash, deck_id)
-    VALUES (1, 1, 'front', 'back', 'hash', :deck_id);
+    INSERT INTO card_content (hash, front, back)
+    VALUES ('hash', 'front', 'back');
+    """)
+    cursor.execute("""
+    INSERT INTO card (score, last_seen, hash, deck_id)
+    VALUES (1, 1, 'hash', :deck_id);
     """, {'deck_id': deck_id})
     card_id = cursor.lastrowid
     assert card_id is not None
@@ -127,7 +704,11 @@ def test_update_card_score_last_seen():
 def test_import_deck_url():
     db_conn = make_memory_db()
     sql_templates = db.load_sql_templates(
-        ['insert_deck', 'delete_deck', 'insert_card', 'delete_cards_for_deck'],
+        ['insert_deck', 'delete_deck', 'select_deck_by_gist_url',
+        'update_deck_fetched', 'insert_card', 'insert_card_content',
+        'insert_card_fts', 'select_setting', 'delete_cards_for_deck',
+        'select_compressed_content_for_deck', 'delete_card_fts',
+        'update_deck'],
         path='lib/retainn/sql'
     )
     gist_url = "https://gist.github.com/cellularmitosis/fe539a6529d3787d94517f94def1bc4d"
@@ -136,12 +717,223 @@ def test_import_deck_url():
     db_conn.close()
 
 
+def test_import_deck_file():
+    db_conn = make_memory_db()
+    sql_templates = db.load_sql_templates(
+        ['insert_deck', 'delete_deck', 'select_deck_by_gist_url',
+        'update_deck_fetched', 'insert_card', 'insert_card_content',
+        'insert_card_fts', 'select_setting', 'delete_cards_for_deck',
+        'select_compressed_content_for_deck', 'delete_card_fts',
+        'select_decks', 'replace_deck_markdown', 'select_deck_markdown'],
+        path='lib/retainn/sql'
+    )
+    path = 'sample-decks/1.md'
+    deck_id = util.import_deck_file(db_conn, sql_templates, path)
+    assert deck_id is not None
+    decks = db.select_decks(db_conn, sql_templates)
+    assert decks[0].title == b"Foo"
+    markdown = open(path, 'rb').read()
+    assert decks[0].hash == db.md5(markdown)
+    result = db_conn.execute("SELECT cc.front, cc.back FROM card c JOIN card_content cc USING (hash)")
+    assert result.fetchall() == [(b"What is it?", b"chicken.")]
+    # the markdown is recorded, for later updates to be diffed against.
+    recorded = db.select_deck_markdown(db_conn, sql_templates, deck_id)
+    assert py23.to_bytes(py23.from_blob(recorded)) == markdown
+    # a stream (e.g. a download) is imported the same way.
+    stream_deck_id = util.import_deck_stream(
+        db_conn, sql_templates, 'url', None, io.BytesIO(markdown)
+    )
+    assert stream_deck_id != deck_id
+    recorded = db.select_deck_markdown(db_conn, sql_templates, stream_deck_id)
+    assert py23.to_bytes(py23.from_blob(recorded)) == markdown
+    # a parse error is raised as is, not masked by unmapping the file.
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'bad.md')
+        with open(path, 'wb') as fd:
+            fd.write(b"# Bad\n\n---\n\nfront\n\n%\n\nback\n\n---\n\nno back\n\n---\n")
+        try:
+            util.import_deck_file(db_conn, sql_templates, path)
+            assert False, "imported a broken deck"
+        except AssertionError as e:
+            assert "Couldn't parse" in str(e), e
+        # the error comes part way through inserting the cards, which are
+        # rolled back with the deck.
+        decks = db.select_decks(db_conn, sql_templates)
+        assert os.path.abspath(path) not in [deck.gist_url for deck in decks]
+        assert db_conn.execute("SELECT count(*) FROM card").fetchone()[0] == 2
+    finally:
+        shutil.rmtree(tmpdir)
+    db_conn.close()
+
+
+def test_diff_decks():
+    def make_deck(backs):
+        cards = [b"\n\n---\n\nfront %d\n\n%%\n\n%s" % (i, back)
+            for (i, back) in enumerate(backs)]
+        return b"# Deck" + b"".join(cards) + b"\n\n---\n"
+    backs = [b"back"] * 1000
+    old_md = make_deck(backs)
+    backs[500] = b"changed"
+    new_md = make_deck(backs)
+    (preamble, removed, added) = parse.diff_decks(old_md, new_md)
+    assert preamble.text == b"# Deck"
+    assert [card.front_text for card in removed] == [b"front 500"]
+    assert [card.back_text for card in removed] == [b"back"]
+    assert [card.front_text for card in added] == [b"front 500"]
+    assert [card.back_text for card in added] == [b"changed"]
+
+    backs.append(b"appended")
+    (_, removed, added) = parse.diff_decks(new_md, make_deck(backs))
+    assert [card.front_text for card in removed] == [b"front 999"]
+    added = [card.front_text for card in added]
+    assert added == [b"front 999", b"front 1000"], added
+    assert parse.diff_decks(old_md, b"# Changed" + old_md[6:]) is None
+
+
+def test_import_decks():
+    db_conn = make_memory_db()
+    sql_templates = db.load_sql_templates(path='lib/retainn/sql')
+    tmpdir = tempfile.mkdtemp()
+    try:
+        markdown = open('sample-decks/1.md', 'rb').read()
+        for i in range(3):
+            with open(os.path.join(tmpdir, '%d.md' % i), 'wb') as fd:
+                fd.write(markdown.replace(b"chicken", b"chicken %d" % i))
+        with open(os.path.join(tmpdir, 'bad.md'), 'wb') as fd:
+            fd.write(b"# No cards")
+        sources = util.deck_sources([tmpdir])
+        assert len(sources) == 4
+        results = list(util.import_decks(db_conn, sql_templates, sources, 2))
+        # importing them again keeps the (unchanged) decks.
+        again = list(util.import_decks(db_conn, sql_templates, sources, 2))
+    finally:
+        shutil.rmtree(tmpdir)
+    errors = [error for (_, deck_id, error) in results if deck_id is None]
+    assert len(errors) == 1, errors
+    assert len(db.select_decks(db_conn, sql_templates)) == 3
+    result = db_conn.execute("SELECT cc.back FROM card c JOIN card_content cc USING (hash) ORDER BY cc.back")
+    backs = [tup[0] for tup in result.fetchall()]
+    assert backs == [b"chicken 0.", b"chicken 1.", b"chicken 2."], backs
+    assert sorted(again) == sorted(results)
+    db_conn.close()
+
+
+def test_rdeck():
+    db_conn = make_memory_db()
+    sql_templates = db.load_sql_templates(path='lib/retainn/sql')
+    markdown = open('sample-decks/1.md', 'rb').read()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'deck.rdeck')
+        with open(path, 'wb') as fd:
+            rdeck.compile_deck(markdown, fd)
+        with rdeck.CompiledDeck(path) as compiled:
+            assert len(compiled) == 1
+            assert compiled.hash == db.md5(markdown)
+            assert compiled.title == b"Foo"
+            (front, back, card_hash) = compiled.card(0)
+            assert (bytes(front), bytes(back)) == (b"What is it?", b"chicken.")
+            assert card_hash == db.make_card_hash(b"What is it?", b"chicken.")
+            del front, back
+        deck_id = util.import_deck_rdeck(db_conn, sql_templates, path)
+
+        with open(path, 'wb') as fd:
+            rdeck.compile_deck(markdown.replace(b"chicken", b"egg"), fd)
+        util.update_deck_rdeck(db_conn, sql_templates, deck_id, path)
+
+        # a deck which doesn't parse leaves the compiled deck as it was.
+        md_path = os.path.join(tmpdir, 'bad.md')
+        with open(md_path, 'wb') as fd:
+            fd.write(b"## Q:\n")
+        try:
+            rdeck.compile_deck_file(md_path, path)
+            assert False, "expected the compile to fail"
+        except AssertionError as e:
+            assert "Couldn't parse" in str(e), e
+        assert sorted(os.listdir(tmpdir)) == ['bad.md', 'deck.rdeck']
+        with rdeck.CompiledDeck(path) as compiled:
+            assert len(compiled) == 1
+
+        # bad files are refused before they are mapped, and bad offsets
+        # before they are sliced.
+        good = open(path, 'rb').read()
+        bad_files = [
+            (b'', "Truncated"),
+            (b'x' * len(good), "bad magic"),
+            (good[:-rdeck.card_struct.size], "Truncated"),
+        ]
+        for (contents, message) in bad_files:
+            with open(path, 'wb') as fd:
+                fd.write(contents)
+            try:
+                rdeck.CompiledDeck(path)
+                assert False, "expected %r to be refused" % message
+            except AssertionError as e:
+                assert message in str(e), e
+            continue
+        # the card index is at the end of the file.
+        index_offset = len(good) - rdeck.card_struct.size
+        entry = rdeck.card_struct.pack(0, len(good) + 1, 0, 1, b'0' * 65)
+        with open(path, 'wb') as fd:
+            fd.write(good[:index_offset] + entry)
+        with rdeck.CompiledDeck(path) as compiled:
+            try:
+                compiled.card(0)
+                assert False, "expected the card to be refused"
+            except AssertionError as e:
+                assert "Truncated" in str(e), e
+    finally:
+        shutil.rmtree(tmpdir)
+    result = db_conn.execute("SELECT cc.back FROM card c JOIN card_content cc USING (hash)")
+    assert result.fetchall() == [(b"egg.",)]
+    db_conn.close()
+
+
+def test_export_deck():
+    db_conn = make_memory_db()
+    sql_templates = db.load_sql_templates(path='lib/retainn/sql')
+    markdown = open('sample-decks/1.md', 'rb').read()
+    (deck_ast, _) = parse.parse_deck(parse.lex_deck(markdown))
+    buf = io.BytesIO()
+    parse.write_deck(deck_ast, buf)
+    assert buf.getvalue() == markdown
+
+    deck_id = util.import_deck_md(db_conn, sql_templates, 'test', None, markdown)
+    buf = io.BytesIO()
+    util.export_deck(db_conn, sql_templates, deck_id, buf)
+    assert buf.getvalue() == markdown
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        util.export_deck_to_disk(db_conn, sql_templates, deck_id, tmpdir)
+        names = sorted(os.listdir(tmpdir))
+        assert names == ['0-back.md', '0-front.md', 'preamble.md'], names
+        back = open(os.path.join(tmpdir, '0-back.md'), 'rb').read()
+        assert back == b"chicken.\n"
+        # cards are written as they are read, from any iterable.
+        cards = [(b"front %d" % i, b"back %d" % i) for i in range(600)]
+        parse.write_cards_to_disk(b"# Deck", iter(cards), tmpdir)
+        assert len(os.listdir(tmpdir)) == 1 + 2 * 600
+        back = open(os.path.join(tmpdir, '599-back.md'), 'rb').read()
+        assert back == b"back 599\n"
+    finally:
+        shutil.rmtree(tmpdir)
+    db_conn.close()
+
+
 def test_update_deck():
     db_conn = make_memory_db()
     sql_templates = db.load_sql_templates(
-        ['insert_deck', 'delete_deck', 'insert_card', 'delete_cards_for_deck',
-        'select_decks', 'update_deck', 'select_card_hashes_by_deck_id',
-        'delete_cards_by_hash'],
+        ['insert_deck', 'delete_deck', 'select_deck_by_gist_url',
+        'update_deck_fetched', 'select_deck_by_id', 'insert_card',
+        'insert_card_content', 'insert_card_fts', 'select_setting',
+        'delete_cards_for_deck', 'select_decks', 'update_deck', 'select_card_hashes_by_deck_id',
+        'delete_cards_by_hash', 'create_temp_card_hash',
+        'insert_temp_card_hash', 'clear_temp_card_hash',
+        'select_compressed_content_for_deck',
+        'select_compressed_content_by_hash', 'delete_card_fts',
+        'select_deck_markdown', 'replace_deck_markdown'],
         path='lib/retainn/sql'
     )
     deck_md_1 = b"""format: md1
@@ -197,7 +989,7 @@ This is the back of card 2.
     assert deck_id is not None
     decks_before = db.select_decks(db_conn, sql_templates)
 
-    result = db_conn.execute("SELECT c.front FROM card c WHERE c.deck_id = ?", [deck_id])
+    result = db_conn.execute("SELECT cc.front FROM card c JOIN card_content cc USING (hash) WHERE c.deck_id = ? ORDER BY c.card_id", [deck_id])
     cards_before = [tup[0] for tup in result.fetchall()]
     assert len(cards_before) == 2
     assert cards_before[0] == b"This is the front of a card."
@@ -212,7 +1004,7 @@ This is the back of card 2.
     dafter = decks_after[0]
     assert dbefore.deck_id == dafter.deck_id
 
-    result = db_conn.execute("SELECT c.front FROM card c WHERE c.deck_id = ?", [deck_id])
+    result = db_conn.execute("SELECT cc.front FROM card c JOIN card_content cc USING (hash) WHERE c.deck_id = ? ORDER BY c.card_id", [deck_id])
     cards_after = [tup[0] for tup in result.fetchall()]
     assert len(cards_after) == 2
     assert cards_after[1] == b"UPDATED This is the front of a card."
@@ -220,12 +1012,103 @@ This is the back of card 2.
     db_conn.close()
 
 
+def test_unchanged_deck():
+    db_conn = make_memory_db()
+    sql_templates = db.load_sql_templates(path='lib/retainn/sql')
+    markdown = b"# Deck\n\n---\n\nfront\n\n%\n\nback\n\n---\n"
+    deck_id = util.import_deck_md(db_conn, sql_templates, 'url', None, markdown)
+    db.grade_card(db_conn, sql_templates, 1, 'recall')
+    # unchanged markdown isn't parsed again, and the cards keep their scores.
+    scan_deck_cards = util.scan_deck_cards
+    def fail(markdown):
+        assert False, "parsed unchanged markdown"
+    util.scan_deck_cards = fail
+    try:
+        assert util.import_deck_md(
+            db_conn, sql_templates, 'url', 'etag', markdown
+        ) == deck_id
+        util.update_deck(db_conn, sql_templates, deck_id, markdown, 'etag 2')
+    finally:
+        util.scan_deck_cards = scan_deck_cards
+    assert db.select_card_score(db_conn, sql_templates, 1) == 1
+    assert db.select_deck(db_conn, sql_templates, deck_id).etag == 'etag 2'
+    db_conn.close()
+
+def test_update_deck_duplicates():
+    db_conn = make_memory_db()
+    sql_templates = db.load_sql_templates(path='lib/retainn/sql')
+    def make_deck(fronts):
+        cards = [b"\n\n---\n\n%s\n\n%%\n\nback" % front for front in fronts]
+        return b"# Deck" + b"".join(cards) + b"\n\n---\n"
+    def select_fronts(deck_id):
+        result = db_conn.execute(
+            "SELECT c.card_id, cc.front FROM card c JOIN card_content cc"
+            " USING (hash) WHERE c.deck_id = ? ORDER BY c.card_id", [deck_id]
+        )
+        return result.fetchall()
+
+    # a repeated card is imported once.
+    markdown = make_deck([b"qa", b"qb", b"qa"])
+    deck_id = util.import_deck_md(db_conn, sql_templates, 'dups', None, markdown)
+    assert [front for (_, front) in select_fronts(deck_id)] == [b"qa", b"qb"]
+
+    markdown = make_deck([b"qa", b"qb", b"qc"])
+    deck_id = util.import_deck_md(db_conn, sql_templates, 'url', None, markdown)
+    before = select_fronts(deck_id)
+    db.did_recall_card(db_conn, sql_templates, before[0][0])
+    # removing one copy of a repeated card keeps the card (and its history),
+    # whether the copy is at the end of the deck or the start.
+    for fronts in [
+        [b"qa", b"qb", b"qc", b"qa"],
+        [b"qa", b"qb", b"qc"],
+        [b"qa", b"qb", b"qc", b"qa"],
+        [b"qb", b"qc", b"qa"],
+    ]:
+        old_markdown = markdown
+        markdown = make_deck(fronts)
+        assert parse.diff_decks(old_markdown, markdown) is not None
+        util.update_deck(db_conn, sql_templates, deck_id, markdown, None)
+        assert select_fronts(deck_id) == before, select_fronts(deck_id)
+        continue
+    assert len(db.select_reviews(db_conn, sql_templates, before[0][0])) == 1
+    # but removing the last copy removes it.
+    util.update_deck(
+        db_conn, sql_templates, deck_id, make_deck([b"qb", b"qc"]), None
+    )
+    assert select_fronts(deck_id) == before[1:]
+    db_conn.close()
+
+
 if __name__ == "__main__":
     test_md5()
+    test_lex_deck()
+    test_flatten_deck()
+    test_iter_deck()
     # test_get_deck()
+    test_card_content()
+    test_compress_cards()
+    test_migrate_db()
+    test_search_cards()
     test_select_next_card()
     test_update_card_score_last_seen()
+    test_grade_card()
+    test_grade_journal()
+    test_scheduler()
     test_insert_deck()
     test_insert_card()
+    test_create_db()
+    test_storage_profiles()
+    test_connection_pool()
+    test_pooled_wsgi_server()
+    test_backup_restore()
+    test_insert_cards_bulk()
+    test_delete_cards_by_hash()
     test_import_deck_url()
+    test_import_deck_file()
+    test_diff_decks()
+    test_import_decks()
+    test_rdeck()
+    test_export_deck()
     test_update_deck()
+    test_unchanged_deck()
+    test_update_deck_duplicates()